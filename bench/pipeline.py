@@ -0,0 +1,311 @@
+#!/usr/bin/python
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Benchmarks the sxc pipeline against synthetic source trees.
+
+Generates django and node.js source trees of the requested sizes and times
+each stage of the pipeline against them:
+
+    match       Aggregator matching and indexing of the source tree
+                (core.find_aggregator(), cold cache).
+    genimage    Image generation (aggregator.generate_image()).
+    stage       Staging the image files (extlib.stage_files()).
+    ir_json     Round-tripping the image through JSON.
+    ir_compact  Round-tripping the image through the compact IR format.
+    render      Rendering the image with StandardOutput.write_data().
+    proclib     Reading a child's output through proclib.run() (once per
+                run, it doesn't depend on the tree).
+
+Every stage is run --repeat times and the fastest time is reported.  Results
+are written as JSON, and if a baseline (a previous results file) is given,
+any stage that is more than --threshold slower than in the baseline is
+flagged as a regression and the exit status is non-zero.
+
+Usage:
+    PYTHONPATH=lib bench/pipeline.py [--kinds django,node.js]
+        [--files 1000,10000] [--depth 3] [--file-size 1024] [--repeat 3]
+        [--output results.json] [--baseline baseline.json]
+        [--threshold 0.2] [--tree-dir DIR]
+
+Generated trees are kept in --tree-dir (a temporary directory by default,
+which is deleted afterwards) and reused if they already exist there, so
+large trees only have to be generated once.
+"""
+
+import getopt
+import json
+import os
+import platform
+import shutil
+import StringIO
+import sys
+import tempfile
+import time
+
+from sxc import extlib
+from sxc.core import StandardCore, StandardOutput
+
+_ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# Number of files in each generated directory.
+_FILES_PER_DIR = 32
+
+# Number of subdirectories of each generated directory.
+_FANOUT = 16
+
+# Differences smaller than this many seconds are never regressions, they're
+# below the noise floor.
+_MIN_REGRESSION = 0.002
+
+# Megabytes of output pushed through proclib.run().
+_PROCLIB_MEGABYTES = 32
+
+# Emits the requested number of megabytes of 80 character lines.
+_CHILD_PROGRAM = """
+import sys
+block = ('x' * 79 + '\\n') * 13107
+for i in xrange(int(sys.argv[1])):
+    sys.stdout.write(block)
+"""
+
+# Files that make a tree recognizable to each aggregator, and the extension of
+# the generated source files.
+_SKELETONS = {
+    'django': ({'manage.py': ('#!/usr/bin/env python\n'
+                              'from django.core.management import '
+                              'execute_from_command_line\n'),
+                'requirements.txt': 'django\n'},
+               '.py'),
+    'node.js': ({'package.json': json.dumps({
+                     'name': 'bench', 'main': 'server.js',
+                     'dependencies': {'express': '*'}}),
+                 'server.js': 'require("express")();\n',
+                 '.gitignore': 'node_modules\n'},
+                '.js'),
+}
+
+
+def generate_tree(tree_dir, kind, files, depth, file_size):
+    """Generates a synthetic source tree.
+
+    Args:
+        tree_dir: (str) Directory to create the tree in.
+        kind: (str) Kind of tree, a key of _SKELETONS.
+        files: (int) Number of source files to generate.
+        depth: (int) Maximum depth of the directory hierarchy.
+        file_size: (int) Size of each source file.
+    """
+    skeleton, extension = _SKELETONS[kind]
+    os.makedirs(tree_dir)
+    for name, contents in skeleton.items():
+        with open(os.path.join(tree_dir, name), 'w') as f:
+            f.write(contents)
+
+    for dir_index in xrange((files + _FILES_PER_DIR - 1) // _FILES_PER_DIR):
+        components = []
+        index = dir_index
+        for level in range(depth):
+            if not index:
+                break
+            components.append('d{}'.format(index % _FANOUT))
+            index //= _FANOUT
+        dir_path = os.path.join(tree_dir, 'src', *components)
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        first = dir_index * _FILES_PER_DIR
+        for file_index in xrange(first, min(first + _FILES_PER_DIR, files)):
+            header = '// file {}\n'.format(file_index)
+            with open(os.path.join(dir_path, 'f{}{}'.format(file_index,
+                                                            extension)),
+                      'w') as f:
+                f.write(header.ljust(max(file_size - 1, len(header)), 'x'))
+                f.write('\n')
+
+    # Ignored content, which shouldn't cost anything.
+    if kind == 'node.js':
+        module_dir = os.path.join(tree_dir, 'node_modules', 'express')
+        os.makedirs(module_dir)
+        for i in range(min(files, 1000)):
+            with open(os.path.join(module_dir, 'm{}.js'.format(i)), 'w') as f:
+                f.write('module.exports = {};\n')
+
+
+class _Quiet(object):
+    """Context manager that discards everything written to sys.stdout."""
+
+    def __enter__(self):
+        self.__stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self.__stdout
+
+
+def _time(func, repeat, setup=None, teardown=None):
+    """Returns the fastest of 'repeat' timed calls to func()."""
+    best = None
+    for i in range(repeat):
+        state = setup() if setup else None
+        start = time.time()
+        func(state)
+        elapsed = time.time() - start
+        if teardown:
+            teardown(state)
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_tree(tree_dir, repeat):
+    """Times the stages of the pipeline for one tree.
+
+    Returns:
+        ({str: float}) a mapping from stage name to seconds.
+    """
+    results = {}
+    cwd = os.getcwd()
+    cache_root = tempfile.mkdtemp()
+    os.chdir(tree_dir)
+    try:
+        def new_core(state=None):
+            # A fresh cache directory, so that matching is never cached.
+            os.environ['SXC_CACHE_DIR'] = tempfile.mkdtemp(dir=cache_root)
+            return StandardCore(os.path.join(_ROOT_DIR, 'extensions'))
+
+        results['match'] = _time(lambda core: core.find_aggregator(), repeat,
+                                 setup=new_core)
+
+        core = new_core()
+        aggregator = core.find_aggregator()
+        images = []
+        with _Quiet():
+            results['genimage'] = _time(
+                lambda state: images.append(aggregator.generate_image(core)),
+                repeat)
+        image = images[-1]
+
+        results['stage'] = _time(
+            lambda staging_dir: extlib.stage_files(tree_dir, image,
+                                                   staging_dir=staging_dir),
+            repeat, setup=tempfile.mkdtemp, teardown=shutil.rmtree)
+
+        results['ir_json'] = _time(
+            lambda state: json.loads(json.dumps(image)), repeat)
+
+        def compact_round_trip(state):
+            out = StringIO.StringIO()
+            extlib.write_ir(tree_dir, image, out)
+            out.seek(0)
+            metadata, entries = extlib.read_ir(out)
+            for entry in entries:
+                pass
+        results['ir_compact'] = _time(compact_round_trip, repeat)
+
+        with _Quiet():
+            results['render'] = _time(
+                lambda state: StandardOutput().write_data(image), repeat)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(cache_root)
+    return results
+
+
+def bench_proclib(repeat):
+    """Returns the time taken to read _PROCLIB_MEGABYTES through proclib."""
+    from sxc import proclib
+    return _time(lambda state: proclib.run(
+        sys.executable, '-c', _CHILD_PROGRAM, str(_PROCLIB_MEGABYTES),
+        stdout_batch_callback=lambda lines: None), repeat)
+
+
+def find_regressions(results, baseline, threshold):
+    """Compares results with a baseline.
+
+    Returns:
+        ([(str, float, float), ...]) the (name, baseline seconds, seconds)
+        of every result that is more than 'threshold' (a fraction) and
+        _MIN_REGRESSION slower than its baseline.
+    """
+    regressions = []
+    for name, seconds in sorted(results.items()):
+        base = baseline.get(name)
+        if (base is not None and seconds > base * (1 + threshold) and
+            seconds - base >= _MIN_REGRESSION):
+            regressions.append((name, base, seconds))
+    return regressions
+
+
+def main(argv):
+    opts, args = getopt.getopt(argv[1:], '', [
+        'kinds=', 'files=', 'depth=', 'file-size=', 'repeat=', 'output=',
+        'baseline=', 'threshold=', 'tree-dir='])
+    opts = dict(opts)
+    kinds = opts.get('--kinds', 'django,node.js').split(',')
+    file_counts = [int(count) for count in
+                   opts.get('--files', '1000,10000').split(',')]
+    depth = int(opts.get('--depth', 3))
+    file_size = int(opts.get('--file-size', 1024))
+    repeat = int(opts.get('--repeat', 3))
+    threshold = float(opts.get('--threshold', 0.2))
+    tree_root = opts.get('--tree-dir')
+    delete_tree_root = not tree_root
+    if delete_tree_root:
+        tree_root = tempfile.mkdtemp()
+
+    results = {}
+    try:
+        for kind in kinds:
+            for files in file_counts:
+                tree_dir = os.path.join(tree_root, '{}-{}-{}-{}'.format(
+                    kind, files, depth, file_size))
+                if not os.path.isdir(tree_dir):
+                    start = time.time()
+                    generate_tree(tree_dir, kind, files, depth, file_size)
+                    print >>sys.stderr, 'generated {} in {:.2f}s'.format(
+                        tree_dir, time.time() - start)
+                for stage, seconds in bench_tree(tree_dir, repeat).items():
+                    results['{}/{}/{}'.format(kind, files, stage)] = seconds
+        results['proclib/{}MB'.format(_PROCLIB_MEGABYTES)] = bench_proclib(
+            repeat)
+    finally:
+        if delete_tree_root:
+            shutil.rmtree(tree_root)
+
+    for name, seconds in sorted(results.items()):
+        print '{:40} {:10.4f}s'.format(name, seconds)
+
+    if '--output' in opts:
+        with open(opts['--output'], 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'depth': depth, 'file_size': file_size,
+                       'repeat': repeat, 'results': results},
+                      f, indent=2, sort_keys=True)
+
+    if '--baseline' in opts:
+        with open(opts['--baseline']) as f:
+            baseline = json.load(f)['results']
+        regressions = find_regressions(results, baseline, threshold)
+        for name, base, seconds in regressions:
+            print 'REGRESSION {}: {:.4f}s -> {:.4f}s ({:+.0%})'.format(
+                name, base, seconds, seconds / base - 1)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Micro-benchmark for proclib.run() output handling.
+
+Pushes a large volume of line-oriented output from a child process through
+proclib.run() using per-line and batched callbacks and reports throughput.
+
+Usage:
+    PYTHONPATH=lib bench/proclib_throughput.py [megabytes]
+"""
+
+import sys
+import time
+
+from sxc import proclib
+
+# Emits the requested number of megabytes of 80 character lines.
+_CHILD_PROGRAM = """
+import sys
+block = ('x' * 79 + '\\n') * 13107
+for i in xrange(int(sys.argv[1])):
+    sys.stdout.write(block)
+"""
+
+
+def bench(megabytes, **callbacks):
+    start = time.time()
+    proclib.run(sys.executable, '-c', _CHILD_PROGRAM, str(megabytes),
+                **callbacks)
+    return time.time() - start
+
+
+def main(argv):
+    megabytes = int(argv[1]) if len(argv) > 1 else 128
+    counts = [0]
+
+    def on_line(line):
+        counts[0] += 1
+
+    def on_lines(lines):
+        counts[0] += len(lines)
+
+    for name, callbacks in [('per-line', {'stdout_callback': on_line}),
+                            ('batched', {'stdout_batch_callback': on_lines})]:
+        counts[0] = 0
+        elapsed = bench(megabytes, **callbacks)
+        print '{:10} {:6} MB {:10} lines {:8.2f}s {:8.1f} MB/s'.format(
+            name, megabytes, counts[0], elapsed, megabytes / elapsed)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
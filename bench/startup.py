@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Benchmarks the startup time of the sxc command.
+
+Runs cheap sxc commands repeatedly and reports the fastest and median wall
+clock times.  By default the extension registry is cached (as it would be
+after the first run), with --cold it is rebuilt for every run.
+
+Usage:
+    bench/startup.py [--runs 20] [--cold] [command ...]
+
+The commands default to 'help' and 'list_aggregators'.
+"""
+
+import getopt
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+_ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+_SXC = os.path.join(_ROOT_DIR, 'scripts', 'sxc')
+
+
+def time_command(command, runs, cold, env):
+    """Returns the run times of 'sxc <command>' in seconds, sorted."""
+    registry = os.path.join(env['SXC_CACHE_DIR'], 'registry.json')
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            if cold and os.path.exists(registry):
+                os.unlink(registry)
+            start = time.time()
+            subprocess.check_call([sys.executable, _SXC] + command.split(),
+                                  stdout=devnull, env=env)
+            times.append(time.time() - start)
+    return sorted(times)
+
+
+def main(argv):
+    opts, commands = getopt.getopt(argv[1:], '', ['runs=', 'cold'])
+    opts = dict(opts)
+    runs = int(opts.get('--runs', 20))
+    cold = '--cold' in opts
+    commands = commands or ['help', 'list_aggregators']
+
+    env = dict(os.environ)
+    env['SXC_CACHE_DIR'] = tempfile.mkdtemp()
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [os.path.join(_ROOT_DIR, 'lib'), env.get('PYTHONPATH')]))
+    try:
+        # Python's startup time, for reference.
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', 'pass'])
+        print '{:20} {:8.1f}ms'.format('(python)',
+                                       (time.time() - start) * 1000)
+        for command in commands:
+            times = time_command(command, runs, cold, env)
+            print '{:20} {:8.1f}ms min {:8.1f}ms median'.format(
+                command, times[0] * 1000, times[len(times) // 2] * 1000)
+    finally:
+        shutil.rmtree(env['SXC_CACHE_DIR'])
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,146 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Generation of the docker build context of a Managed VM image.
+
+The push hook in bin/ is a thin wrapper around this module.
+"""
+
+import os
+import posixpath
+
+from sxc import deps
+
+# Files that describe the dependencies of an application, used for images
+# that don't come with a dependency graph.
+DEP_MANIFESTS = ['package.json', 'package-lock.json', 'npm-shrinkwrap.json',
+                 'requirements.txt']
+
+# The ecosystems of the manifests that dependencies are installed from.  The
+# install commands match the install hooks emitted by the aggregators.
+MANIFEST_ECOSYSTEMS = {
+    'package.json': 'npm',
+    'requirements.txt': 'pypi',
+}
+
+
+def write_if_changed(path, contents):
+    """Writes 'contents' to 'path' unless the file already contains it.
+
+    Files get a fixed mtime so that the docker build cache only depends on
+    their contents.
+    """
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == contents:
+                return
+    except IOError:
+        pass
+    with open(path, 'wb') as f:
+        f.write(contents)
+    os.utime(path, (0, 0))
+
+
+def get_dep_manifests(image):
+    """Returns the files that the dependencies of an image are installed from.
+
+    These are all of the files that its dependency graph was resolved from,
+    including those included by other manifests (requirements files named
+    by "-r" or "-c", for instance), so that installing the dependencies
+    doesn't need anything else from the application.  Files outside of the
+    source directory are left out.
+
+    Args:
+        image: (dict) The image.
+
+    Returns:
+        ([str, ...]) Sorted paths relative to the source directory.
+    """
+    manifests = set((image.get('packages') or {}).get('manifests', ()))
+    files = set(image['files'])
+    manifests.update(name for name in DEP_MANIFESTS if name in files)
+    return sorted(name for name in manifests
+                  if not posixpath.isabs(name) and
+                  not posixpath.normpath(name).startswith('../'))
+
+
+def stage_dep_manifests(file_source, staging_dir, manifests):
+    """Copies the dependency manifests to the 'deps' directory of a context.
+
+    Files that are already staged are left alone if they haven't changed, so
+    that the docker build cache can reuse the dependencies layer.  Anything
+    else in the directory is removed.
+
+    Args:
+        file_source: (str) The directory to copy the files from.
+        staging_dir: (str) The staging directory.
+        manifests: ([str, ...]) As returned by get_dep_manifests().
+    """
+    deps_dir = os.path.join(staging_dir, 'deps')
+    wanted = set(manifests)
+    for dir_path, dir_names, file_names in os.walk(deps_dir, topdown=False):
+        for name in file_names:
+            path = os.path.join(dir_path, name)
+            if os.path.relpath(path, deps_dir) not in wanted:
+                os.unlink(path)
+        if dir_path != deps_dir and not os.listdir(dir_path):
+            os.rmdir(dir_path)
+    for name in manifests:
+        path = os.path.join(deps_dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(os.path.join(file_source, name), 'rb') as f:
+            write_if_changed(path, f.read())
+
+
+def get_dep_installs(image, manifests):
+    """Returns the commands that install the dependencies of an image."""
+    return [deps.install_command(MANIFEST_ECOSYSTEMS[name],
+                                 image.get('packages'))
+            for name in manifests if name in MANIFEST_ECOSYSTEMS]
+
+
+def make_dockerfile(image, manifests):
+    """Returns the contents of the Dockerfile of an image.
+
+    Layers are ordered from the least to the most volatile: system packages,
+    then the application's dependencies (installed from the manifests alone,
+    staged in the 'deps' directory of the context), then the application
+    itself and its install hooks.
+
+    Args:
+        image: (dict) The image.
+        manifests: ([str, ...]) As returned by get_dep_manifests().
+    """
+    packages = set(deps.system_packages(image['deps'])[0])
+    dep_installs = get_dep_installs(image, manifests)
+    if 'requirements.txt' in manifests:
+        packages.add('python-pip')
+
+    dockerfile = ['FROM ubuntu']
+    install = 'apt-get -y update && apt-get -y upgrade'
+    if packages:
+        install += ' && apt-get install -y ' + ' '.join(sorted(packages))
+    dockerfile.append('RUN ' + install)
+    if manifests:
+        dockerfile.append('COPY deps /app')
+        dockerfile.extend('RUN ' + command for command in dep_installs)
+    dockerfile.append('COPY app /app')
+    for install_hook in image.get('on_install', []):
+        # Don't repeat the installation of the dependencies.
+        if install_hook not in dep_installs:
+            dockerfile.append('RUN {}'.format(install_hook))
+    dockerfile.append('CMD {}'.format(image['run']))
+    return '\n'.join(dockerfile) + '\n'
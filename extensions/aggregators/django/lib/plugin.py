@@ -0,0 +1,64 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""In-process implementation of the django aggregator.
+
+The hook programs in bin/ are thin wrappers around this module.
+"""
+
+from sxc import aggregator
+from sxc import deps
+from sxc import extlib
+
+# The django version used when the project doesn't pin one.
+DEFAULT_DJANGO_VERSION = '1.6.1'
+
+
+def make_image(source_dir):
+    """Returns the intermediate representation for 'source_dir'.
+
+    The 'files' entry is an iterator over the files in the source tree.
+    """
+    packages = deps.resolve(source_dir, 'pypi')
+    manifest = {}
+    manifest['files'] = (rel_path for rel_path, entry in
+                         extlib.walk_source_tree(source_dir))
+    manifest['deps'] = [{
+        'name': 'django',
+        'version': (deps.get_version(packages, 'django') or
+                    DEFAULT_DJANGO_VERSION)}]
+    if packages:
+        manifest['packages'] = packages
+    # TODO: The path to the python binary needs to be abstracted out.
+    manifest['run'] = '/usr/bin/python /app/manage.py runserver 0.0.0.0:8080'
+    manifest['on_install'] = ['/usr/bin/python /app/manage.py syncdb']
+    return manifest
+
+
+class DjangoAggregator(aggregator.AggregatorPlugin):
+
+    def dump(self, core):
+        # The files are rendered as they're found.
+        core.get_output().write_data(make_image(core.get_source_directory()))
+
+    def generate_image(self, core):
+        image = make_image(core.get_source_directory())
+        image['files'] = list(image['files'])
+        aggregator.save_image(core, image)
+        return image
+
+
+def create(extension_root_dir):
+    return DjangoAggregator(extension_root_dir)
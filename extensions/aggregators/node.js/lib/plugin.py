@@ -0,0 +1,80 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""In-process implementation of the node.js aggregator.
+
+The hook programs in bin/ are thin wrappers around this module.
+"""
+
+import json
+import os
+import re
+
+from sxc import aggregator
+from sxc import deps
+from sxc import extlib
+
+# The node.js version used when package.json doesn't require an exact one.
+DEFAULT_NODE_VERSION = 'v0.12.0'
+
+
+def make_image(source_dir):
+    """Returns the intermediate representation for 'source_dir'.
+
+    The 'files' entry is an iterator over the files in the source tree.
+    """
+    with open(os.path.join(source_dir, 'package.json')) as f:
+        package_json = json.load(f)
+
+    manifest = {}
+    manifest['files'] = (rel_path for rel_path, entry in
+                         extlib.walk_source_tree(source_dir))
+    # package.json isn't validated by npm, 'engines' may be anything.
+    engines = package_json.get('engines')
+    node_version = engines.get('node') if isinstance(engines, dict) else None
+    if not isinstance(node_version, basestring):
+        node_version = ''
+    node_version = node_version.strip()
+    if re.match(r'^v?\d+\.\d+\.\d+$', node_version):
+        node_version = 'v' + node_version.lstrip('v')
+    else:
+        node_version = DEFAULT_NODE_VERSION
+    manifest['deps'] = [{'name': 'node.js', 'version': node_version}]
+    packages = manifest['packages'] = deps.resolve(source_dir, 'npm')
+    # TODO: The path to the nodejs binary needs to be abstracted out.
+    manifest['run'] = '/usr/bin/nodejs /app/{}'.format(package_json['main'])
+
+    # node_modules is usually ignored, so install the packages on the target.
+    if package_json.get('dependencies'):
+        manifest['deps'].append({'name': 'npm'})
+        manifest['on_install'] = [deps.install_command('npm', packages)]
+    return manifest
+
+
+class NodeJSAggregator(aggregator.AggregatorPlugin):
+
+    def dump(self, core):
+        # The files are rendered as they're found.
+        core.get_output().write_data(make_image(core.get_source_directory()))
+
+    def generate_image(self, core):
+        image = make_image(core.get_source_directory())
+        image['files'] = list(image['files'])
+        aggregator.save_image(core, image)
+        return image
+
+
+def create(extension_root_dir):
+    return NodeJSAggregator(extension_root_dir)
@@ -24,6 +24,26 @@ class Actuator(object):
         """Push an image to a target."""
         raise NotImplementedError()
 
+    def push_async(self, core, image, args, label=None, env=None):
+        """Start pushing an image to a target without waiting for it.
+
+        The default implementation just calls push().
+
+        Args:
+            core: (.core.Core)
+            image: (object) The intermediate representation object.
+            args: ([str, ...]) Actuator arguments.
+            label: (str or None) If provided, messages from the push are
+                prefixed with this label.
+            env: (dict or None) Environment for any processes that are run.
+
+        Returns:
+            (.core.HookCall) whose result() is the result of the push.
+        """
+        from sxc.core import HookCall
+        result = self.push(core, image, args)
+        return HookCall(None, lambda: result, returncode=0)
+
 
 class ActuatorExtension(Actuator):
     """Actuator extension consisting of hook programs."""
@@ -32,8 +52,36 @@ class ActuatorExtension(Actuator):
         self.root = actuator_root_dir
         self.name = os.path.basename(actuator_root_dir)
 
+        # The names of the hook programs, None if unknown.
+        self.hooks = None
+
+    def set_registry_entry(self, entry):
+        """Provides the extension's entry in the core's extension registry.
+
+        Args:
+            entry: (dict) The registry entry, with the extension's 'info'
+                (None if it couldn't be parsed) and 'hooks'.
+        """
+        self.hooks = entry['hooks']
+
     def push(self, core, image, args):
         result = core.get_utils().run_hook(
             self.root, 'push', core.get_source_directory(), *args,
             input=json.dumps(image))
         return result
+
+    def push_async(self, core, image, args, label=None, env=None):
+        return core.get_utils().run_hook_async(
+            self.root, 'push', core.get_source_directory(), *args,
+            input=json.dumps(image), label=label, env=env)
+
+
+class ActuatorPlugin(ActuatorExtension):
+    """Base class for in-process actuator implementations.
+
+    An extension provides an in-process implementation by naming a python
+    module in the 'plugin' key of its data/info.json file.  The module must
+    define a create(extension_root_dir) function that returns the actuator
+    object, typically an instance of a subclass of this class.  Methods that
+    aren't overridden fall back to the extension's hook programs.
+    """
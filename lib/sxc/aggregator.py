@@ -18,6 +18,94 @@
 import os
 import json
 
+from sxc import extlib
+from sxc import match
+
+def _stat_key(path):
+    """Returns a cheap key representing the state of the file at 'path'."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+def save_image(core, image):
+    """Writes the image to the .sxc file in the source directory.
+
+    The file is written in the compact IR format (see extlib.IRWriter),
+    reusing the file hashes of the previous version of the file where
+    possible.  On return, image['ir'] is the path of the file so that
+    actuators can get the file details from it.
+
+    Args:
+        core: (.core.Core)
+        image: (object) The intermediate representation object.
+    """
+    source_dir = core.get_source_directory()
+    ir_file = os.path.join(source_dir, '.sxc')
+    previous = extlib.load_ir_entries({'ir': ir_file})
+    with open(ir_file + '.tmp', 'w') as f:
+        extlib.write_ir(source_dir, image, f, previous)
+    os.rename(ir_file + '.tmp', ir_file)
+    image['ir'] = ir_file
+
+
+class Match(object):
+    """A matches() check that may still be in progress.
+
+    This base class represents a check that has already completed.
+    """
+
+    def __init__(self, matched):
+        """Constructor.
+
+        Args:
+            matched: (bool) The result of the check.
+        """
+        self.__matched = matched
+
+    def poll(self):
+        """Returns the result of the check, None if it is still running."""
+        return self.__matched
+
+    def wait(self):
+        """Waits for the check to complete and returns its result."""
+        return self.__matched
+
+    def cancel(self):
+        """Abandons the check if it is still running."""
+        pass
+
+
+class _HookMatch(Match):
+    """A matches() check being performed by a running hook process."""
+
+    def __init__(self, proc):
+        """Constructor.
+
+        Args:
+            proc: (.proclib.Process) The hook process.
+        """
+        self.__proc = proc
+
+    def poll(self):
+        status = self.__proc.poll()
+        return None if status is None else status == 0
+
+    def wait(self):
+        return self.__proc.wait() == 0
+
+    def cancel(self):
+        if self.__proc.poll() is None:
+            try:
+                self.__proc.kill()
+            except OSError:
+                # Already gone.
+                pass
+            self.__proc.wait()
+
+
 class Aggregator(object):
 
     def matches(self, core):
@@ -28,6 +116,19 @@ class Aggregator(object):
         """
         raise NotImplementedError()
 
+    def start_matching(self, core):
+        """Starts a matches() check without waiting for it to complete.
+
+        The default implementation just calls matches().
+
+        Args:
+            core: (.core.Core)
+
+        Returns:
+            (Match)
+        """
+        return Match(self.matches(core))
+
     def dump(self, core):
         """Dump debug information on the source directory.
 
@@ -42,11 +143,32 @@ class Aggregator(object):
         Keys include:
             name: (str) name of the aggregator.
             desc: (str) description of the aggregator.
+            priority: (int) aggregators with higher priorities are tried
+                first.  Defaults to 0.
+            match_files: ([str, ...]) paths relative to the source directory
+                that the matches() check looks at.
+            match: ([dict, ...]) declarative rules that replace the matches()
+                check, see sxc.match.
 
         All keys should be treated as optional.
         """
         raise NotImplementedError()
 
+    def get_fingerprint(self, core):
+        """Returns a string identifying everything matches() depends on.
+
+        The core caches the result of matches() until the fingerprint of the
+        source directory changes.  It should be cheap to compute.
+
+        Args:
+            core: (.core.Core)
+
+        Returns:
+            (str) The fingerprint, None if the result of matches() can not be
+            cached.
+        """
+        return None
+
     def generate_image(self, core):
         """Generate the SourceXCloud image files for the source directory.
 
@@ -59,33 +181,100 @@ class Aggregator(object):
         raise NotImplementedError()
 
 
-class AggregatorExtension(object):
+class AggregatorExtension(Aggregator):
     """Aggregator implementation consisting of hook programs."""
 
     def __init__(self, extension_root_dir):
         self.root = extension_root_dir
+        self.name = os.path.basename(extension_root_dir)
+        self.__info = None
+
+        # The names of the hook programs, None if unknown.
+        self.hooks = None
+
+    def set_registry_entry(self, entry):
+        """Provides the extension's entry in the core's extension registry.
+
+        This saves reading the info file and looking for hooks.
+
+        Args:
+            entry: (dict) The registry entry, with the extension's 'info'
+                (None if it couldn't be parsed) and 'hooks'.
+        """
+        if entry['info'] is not None:
+            self.__info = entry['info']
+        self.hooks = entry['hooks']
 
     def matches(self, core):
+        rules = self.get_info(core).get('match')
+        if rules is not None:
+            return match.check_rules(
+                rules, match.SourceScan(core.get_source_directory()))
+        if self.hooks is not None and 'matches' not in self.hooks:
+            return False
         return core.get_utils().call_hook(self.root, 'matches',
                                           core.get_source_directory())
 
+    def start_matching(self, core):
+        if self.get_info(core).get('match') is not None:
+            return Match(self.matches(core))
+        if self.hooks is not None and 'matches' not in self.hooks:
+            return Match(False)
+        proc = core.get_utils().start_hook(self.root, 'matches',
+                                           core.get_source_directory())
+        return _HookMatch(proc) if proc else Match(False)
+
     def dump(self, core):
         output = core.get_utils().get_hook_output(self.root, 'dump',
                                                   core.get_source_directory())
         core.get_output().write_data(output)
 
     def get_info(self, core):
-        info_file = os.path.join(self.root, 'data', 'info.json')
-        if os.path.isfile(info_file):
-            return json.load(open(info_file))
-        else:
-            return {'name': os.path.basename(self.root)}
+        if self.__info is None:
+            info_file = os.path.join(self.root, 'data', 'info.json')
+            if os.path.isfile(info_file):
+                self.__info = json.load(open(info_file))
+            else:
+                self.__info = {'name': self.name}
+        return self.__info
+
+    def get_fingerprint(self, core):
+        # The extension version is represented by its info file and matches
+        # hook, followed by the state of the files that the hook looks at.
+        info = self.get_info(core)
+        parts = [_stat_key(os.path.join(self.root, 'data', 'info.json')),
+                 _stat_key(os.path.join(self.root, 'bin', 'matches'))]
+        if info.get('worker'):
+            parts.append(_stat_key(os.path.join(self.root, 'bin', 'worker')))
+        if info.get('plugin'):
+            parts.append(_stat_key(os.path.join(self.root, info['plugin'])))
+        source_dir = core.get_source_directory()
+        for name in match.get_match_files(info):
+            parts.append(_stat_key(os.path.join(source_dir, name)))
+        for name in match.get_match_dirs(info):
+            parts.append(_stat_key(os.path.join(source_dir, name)))
+        return repr(parts)
 
     def generate_image(self, core):
         output = core.get_utils().get_hook_output(self.root, 'genimage',
                                                   core.get_source_directory())
         if output is None:
             raise Exception('Unable to create image.')
-        f = open(os.path.join(core.get_source_directory(), '.sxc'), 'w')
-        json.dump(output, f)
+        save_image(core, output)
         return output
+
+
+class AggregatorPlugin(AggregatorExtension):
+    """Base class for in-process aggregator implementations.
+
+    An extension provides an in-process implementation by naming a python
+    module in the 'plugin' key of its data/info.json file.  The module must
+    define a create(extension_root_dir) function that returns the aggregator
+    object, typically an instance of a subclass of this class.
+
+    Subclasses override the Aggregator methods that they implement directly,
+    anything else falls back to the extension's hook programs.
+    """
+
+    def start_matching(self, core):
+        return Match(self.matches(core))
@@ -0,0 +1,187 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Running sxc over many projects at once.
+
+A batch covers every project found under a root directory, such as the
+services of a monorepo.  The projects are handed out to a pool of worker
+processes.  Each worker loads the extensions once and reuses its core for
+all of the projects that it gets, and the extension registry and detection
+cache in the sxc cache directory are shared by all of them.
+"""
+
+import json
+import multiprocessing
+import os
+import time
+
+from sxc import extlib
+from sxc.core import StandardCore
+
+# Name of the summary file written to the root directory of a batch.
+SUMMARY_NAME = '.sxc-batch.json'
+
+# Directories that are never searched for projects, in addition to those
+# ignored by the root directory's ignore files.
+_SKIP_PATTERNS = ['.*/']
+
+# How long to block waiting for a result.  Waiting without a timeout can't
+# be interrupted with Ctrl-C in python 2.
+_RESULT_WAIT = 1.0
+
+# The core of a worker process, see _init_worker().
+_core = None
+
+
+def find_projects(root, match_files):
+    """Returns the directories under 'root' that look like projects.
+
+    A directory looks like a project if it contains any of the files that
+    the aggregators' matches() checks look at.  Project directories are
+    searched too, so projects nested in other projects (the services of a
+    monorepo that has a package.json of its own, for instance) are found.
+    Directories are skipped if they're ignored by the ignore files of the
+    root or of the directories above them, or are hidden.
+
+    Args:
+        root: (str) The directory to search.
+        match_files: ([str, ...]) Paths relative to a project directory, as
+            returned by sxc.match.get_match_files().
+
+    Returns:
+        ([str, ...]) The project directories, sorted.
+    """
+    ignore = extlib.IgnoreRules.for_source_dir(root)
+    for pattern in _SKIP_PATTERNS:
+        ignore.add(pattern)
+
+    projects = []
+    stack = [('', root)]
+    while stack:
+        prefix, dir_path = stack.pop()
+        if any(os.path.exists(os.path.join(dir_path, name))
+               for name in match_files):
+            projects.append(dir_path)
+        try:
+            names = os.listdir(dir_path)
+        except OSError:
+            continue
+        if prefix:
+            for name in extlib.IGNORE_FILES:
+                if name in names:
+                    ignore.add_file(os.path.join(dir_path, name), prefix)
+        for name in names:
+            path = os.path.join(dir_path, name)
+            if (os.path.isdir(path) and not os.path.islink(path) and
+                not ignore.is_ignored(prefix + name, True) and
+                not ignore.has_marker(path)):
+                stack.append((prefix + name + '/', path))
+    return sorted(projects)
+
+
+def _init_worker(extensions_dir):
+    """Creates the core of a worker process."""
+    global _core
+
+    # The pool provides the parallelism, don't run matches() checks
+    # concurrently within a worker too.
+    _core = StandardCore(extensions_dir, max_match_workers=1)
+    _core.get_aggregators()
+    _core.get_actuators()
+
+
+def _run_project(task):
+    """Runs the batch function for a project in a worker.
+
+    Args:
+        task: ((function, args, source_dir)) The function to call with the
+            worker's core (switched to 'source_dir') and 'args'.
+
+    Returns:
+        ((source_dir, summary)) where 'summary' is the dictionary returned
+        by the function with the 'time' taken added, or the 'error' it
+        raised.
+    """
+    function, args, source_dir = task
+    start = time.time()
+    try:
+        _core.set_source_directory(source_dir)
+        summary = function(_core, *args)
+    except Exception as ex:
+        summary = {'status': 'error',
+                   'error': '{}: {}'.format(ex.__class__.__name__, ex)}
+    summary['time'] = round(time.time() - start, 3)
+    return source_dir, summary
+
+
+def run(extensions_dir, projects, function, args=(), jobs=None):
+    """Calls a function for every project, in a pool of worker processes.
+
+    Args:
+        extensions_dir: (str) The extensions directory for the worker cores.
+        projects: ([str, ...]) The project directories.
+        function: (callable(.core.Core, *args)) A module level function
+            (so that it can be sent to the workers) that does the work for
+            the project that the core is switched to and returns a
+            dictionary summarizing it, including its 'status'.
+        args: (tuple) Additional arguments of the function.
+        jobs: (int or None) The number of worker processes, defaults to the
+            number of CPUs.
+
+    Yields:
+        (source_dir, summary) for every project, in the order that they
+        complete.
+    """
+    tasks = [(function, args, source_dir) for source_dir in projects]
+    jobs = min(jobs or multiprocessing.cpu_count(), len(tasks))
+    if jobs <= 1:
+        _init_worker(extensions_dir)
+        for task in tasks:
+            yield _run_project(task)
+        return
+
+    pool = multiprocessing.Pool(jobs, _init_worker, (extensions_dir,))
+    try:
+        results = pool.imap_unordered(_run_project, tasks)
+        for i in range(len(tasks)):
+            while True:
+                try:
+                    yield results.next(_RESULT_WAIT)
+                    break
+                except multiprocessing.TimeoutError:
+                    pass
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def write_summary(root, summaries):
+    """Writes the summary of a batch to SUMMARY_NAME in its root directory.
+
+    Args:
+        root: (str) The root directory of the batch.
+        summaries: ({str: dict}) The project summaries by project path
+            relative to the root.
+
+    Returns:
+        (str) The path of the summary file.
+    """
+    path = os.path.join(root, SUMMARY_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'root': root, 'projects': summaries}, f, indent=2,
+                  sort_keys=True)
+    os.rename(path + '.tmp', path)
+    return path
@@ -0,0 +1,107 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent on-disk state shared between sxc invocations.
+"""
+
+import errno
+import json
+import os
+
+
+def get_cache_root():
+    """Returns the root directory for all sxc caches.
+
+    This is $SXC_CACHE_DIR if set, otherwise $XDG_CACHE_HOME/sxc, otherwise
+    ~/.cache/sxc.
+    """
+    root = os.environ.get('SXC_CACHE_DIR')
+    if not root:
+        base = (os.environ.get('XDG_CACHE_HOME') or
+                os.path.join(os.path.expanduser('~'), '.cache'))
+        root = os.path.join(base, 'sxc')
+    return root
+
+
+def get_cache_dir(*components):
+    """Returns the path to a cache directory, creating it if necessary.
+
+    Args:
+        *components: ([str, ...]) Path components relative to the cache root.
+
+    Returns:
+        (str) the directory path.
+    """
+    path = os.path.join(get_cache_root(), *components)
+    try:
+        os.makedirs(path)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST:
+            raise
+    return path
+
+
+class JSONStore(object):
+    """A JSON document persisted in the cache directory.
+
+    Writes are atomic, so concurrent sxc processes will never see a partially
+    written document (although the last writer wins).
+    """
+
+    def __init__(self, name):
+        """Constructor.
+
+        Args:
+            name: (str) File name of the document relative to the cache root.
+        """
+        self.path = os.path.join(get_cache_root(), name)
+
+    def load(self):
+        """Returns the contents of the document, an empty dict if missing."""
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save(self, data):
+        """Replaces the contents of the document with 'data'."""
+        get_cache_dir(os.path.dirname(self.path))
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_path, self.path)
+
+    def update(self, function):
+        """Modifies the document without losing concurrent updates.
+
+        An exclusive lock is held while the document is loaded, modified
+        and saved, so updates from several processes (such as the workers
+        of a batch) are all kept.
+
+        Args:
+            function: (callable(dict)) Modifies the contents of the document
+                in place.
+
+        Returns:
+            (dict) the new contents of the document.
+        """
+        import fcntl
+        get_cache_dir(os.path.dirname(self.path))
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            data = self.load()
+            function(data)
+            self.save(data)
+        return data
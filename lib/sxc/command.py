@@ -15,14 +15,24 @@
 """The SourceXCloud main command.
 """
 
+import getopt
 import os
 
+from sxc import extlib
+from sxc import trace
 from sxc.core import StandardCore
 
+# Number of items of each list shown by inspect, unless it's asked for all.
+_INSPECT_MAX_ITEMS = 50
+
+# Push argument that separates the endpoints of a push.
+TARGET_SEP = '+'
+
 # Command functions.  Each of these must accept the following arguments:
 #   core: (sxc.core.Core)
 #   args: ([str, ...]) Command arguments (excluding the command and
 #       subcommand, so with "crep foo bar baz" args would be ['bar', 'baz']
+# They may return a non-zero exit code to indicate failure.
 
 def help(core, args=None):
     """Show this help message."""
@@ -33,13 +43,23 @@ def help(core, args=None):
 
 
 def inspect(core, args):
-    """Inspect the aggregator data for the current directory."""
-    for aggregator in core.get_ordered_aggregators():
-        if aggregator.matches(core):
-            aggregator.dump(core)
-            return
+    """[--all]
+    Inspect the aggregator data for the current directory.  Long lists are
+    truncated unless --all is given.
+    """
+    try:
+        opts, args = getopt.getopt(args, '', ['all'])
+    except getopt.GetoptError as ex:
+        core.get_output().error('{}', ex)
+        return 1
+    if not opts:
+        core.get_output().set_max_items(_INSPECT_MAX_ITEMS)
+    aggregator = core.find_aggregator()
+    if aggregator:
+        aggregator.dump(core)
     else:
         core.get_output().error('Unknown directory type')
+        return 1
 
 
 def list_aggregators(core, args):
@@ -50,47 +70,319 @@ def list_aggregators(core, args):
         out.write_row(agg_info.get('name', ''), agg_info.get('desc', ''))
 
 
-def genimage(core, args):
-    """Generate the manifest for the source directory."""
-    for aggregator in core.get_ordered_aggregators():
-        if aggregator.matches(core):
-            image = aggregator.generate_image(core)
-            return image
+def _generate_image(core):
+    """Returns the image for the source directory, None if it's unknown."""
+    with trace.span('match'):
+        aggregator = core.find_aggregator()
+    if aggregator:
+        # Only recognized projects are worth indexing.
+        core.index_source_tree()
+        with trace.span('genimage', aggregator=aggregator.get_info(core).get(
+                'name', '')):
+            return aggregator.generate_image(core)
     else:
         core.get_output().error('Unknown directory type')
+        return None
+
+
+def genimage(core, args):
+    """[--batch <root> [-j <jobs>]]
+    Generate the manifest for the source directory.  With --batch, generate
+    the manifests of all projects found under <root> using <jobs> processes
+    (defaults to the number of CPUs) and write a summary to
+    <root>/.sxc-batch.json.
+    """
+    out = core.get_output()
+    try:
+        opts, args = getopt.getopt(args, 'j:', ['batch=', 'jobs='])
+        batch_root, jobs = _get_batch_opts(opts)
+    except (getopt.GetoptError, ValueError) as ex:
+        out.error('{}', ex)
+        return 1
+    if args:
+        out.write_markdown('genimage ' + genimage.__doc__)
+        return 1
+    if batch_root:
+        return _run_batch(core, batch_root, jobs, _batch_genimage)
+    if _generate_image(core) is None:
+        return 1
+
+
+def _get_batch_opts(opts):
+    """Returns (root, jobs) from the --batch and -j/--jobs options.
+
+    Raises:
+        ValueError: if the number of jobs isn't a number.
+    """
+    batch_root = jobs = None
+    for opt, val in opts:
+        if opt == '--batch':
+            batch_root = os.path.abspath(val)
+        elif opt in ('-j', '--jobs'):
+            jobs = int(val)
+    return batch_root, jobs
+
+
+def _batch_image(core):
+    """Generates the image of a project in a batch.
+
+    Returns:
+        (image, summary) where 'image' is None if no aggregator matches.
+    """
+    aggregator = core.find_aggregator()
+    if aggregator is None:
+        return None, {'status': 'unknown'}
+    core.index_source_tree()
+    image = aggregator.generate_image(core)
+    return image, {'status': 'ok',
+                   'aggregator': aggregator.get_info(core).get('name'),
+                   'image': image.get('ir'),
+                   'files': len(image.get('files', []))}
+
+
+def _batch_genimage(core):
+    return _batch_image(core)[1]
+
+
+def _batch_push(core, root, targets):
+    image, summary = _batch_image(core)
+    if image is None:
+        return summary
+    prefix = os.path.relpath(core.get_source_directory(), root) + ':'
+    targets = [(label, core.get_actuator(name), actuator_args)
+               for label, name, actuator_args in targets]
+    summary['results'], status = _push_targets(core, image, targets,
+                                               label_prefix=prefix)
+    if status:
+        summary['status'] = 'failed'
+    return summary
+
+
+def _run_batch(core, root, jobs, function, *args):
+    """Runs a batch function over all projects under 'root'.
+
+    See sxc.batch.run().  Writes a line for every project as it completes
+    and the summary file at the end.
+
+    Returns:
+        (int or None) the exit status, non-zero if any project failed.
+    """
+    from sxc import batch
+    from sxc import match
+    out = core.get_output()
+    match_files = set()
+    for aggregator in core.get_aggregators():
+        match_files.update(match.get_match_files(aggregator.get_info(core)))
+    projects = batch.find_projects(root, match_files)
+    if not projects:
+        out.error('No projects found under {}', root)
+        return 1
+
+    summaries = {}
+    for source_dir, summary in batch.run(core.root, projects, function, args,
+                                         jobs=jobs):
+        name = os.path.relpath(source_dir, root)
+        summaries[name] = summary
+        if summary['status'] == 'error':
+            out.error('{}: {}', name, summary['error'])
+        else:
+            out.write_row(name, summary['status'])
+
+    counts = {}
+    for summary in summaries.itervalues():
+        counts[summary['status']] = counts.get(summary['status'], 0) + 1
+    out.info('{} projects ({}), summary written to {}', len(summaries),
+             ', '.join('{} {}'.format(count, status)
+                       for status, count in sorted(counts.iteritems())),
+             batch.write_summary(root, summaries))
+    if set(counts) - set(['ok', 'unknown']):
+        return 1
+
+
+def _parse_targets(core, args):
+    """Splits push arguments into (label, actuator, actuator_args) tuples.
+
+    The first argument names the actuator of the first target and the
+    arguments that follow it are its actuator arguments, up to a TARGET_SEP
+    argument that starts the next target.  Any other argument is passed to
+    the actuator as is, even if it happens to be the name of an actuator.
+    Returns None if a target doesn't start with the name of an actuator.
+    """
+    targets = []
+    groups = [[]]
+    for arg in args:
+        if arg == TARGET_SEP:
+            groups.append([])
+        else:
+            groups[-1].append(arg)
+    for group in groups:
+        actuator = group and core.get_actuator(group[0])
+        if not actuator:
+            core.get_output().error(
+                'No actuator named {}'.format(group[0]) if group else
+                'Expected an actuator after {}'.format(TARGET_SEP))
+            return None
+        # Make labels unique when pushing with the same actuator twice.
+        count = sum(1 for target in targets if target[1] is actuator)
+        label = '{}#{}'.format(group[0], count + 1) if count else group[0]
+        targets.append((label, actuator, group[1:]))
+    return targets
 
 
 def push(core, args):
-    """<directory> <endpoint> [endpoint-args]
-    Push the project in the source directory to the specified endpoint.
+    """[--trace <file>] <directory> <endpoint> [endpoint-args]
+        [+ <endpoint> [endpoint-args]...]
+    or: --batch <root> [-j <jobs>] <endpoint> [endpoint-args]
+        [+ <endpoint> [endpoint-args]...]
+    Push the project in the source directory to the specified endpoints.
+    Separate endpoints with a "+" argument.  When there is more than one
+    endpoint, the image is generated and staged once and all endpoints are
+    pushed to concurrently.  With --trace, a trace of the push is written to
+    <file> in the Chrome trace event format.
+    With --batch, every project found under <root> is pushed, see genimage.
     """
     out = core.get_output()
+    try:
+        opts, args = getopt.getopt(args, 'j:', ['trace=', 'batch=', 'jobs='])
+        batch_root, jobs = _get_batch_opts(opts)
+    except (getopt.GetoptError, ValueError) as ex:
+        out.error('{}', ex)
+        return 1
+    if batch_root:
+        targets = args and _parse_targets(core, args)
+        if not targets:
+            out.write_markdown('push ' + push.__doc__)
+            return 1
+        return _run_batch(core, batch_root, jobs, _batch_push, batch_root,
+                          [(label, actuator.name, actuator_args)
+                           for label, actuator, actuator_args in targets])
     if len(args) < 2:
         out.write_markdown('push ' + push.__doc__)
+        return 1
+
+    trace_file = dict(opts).get('--trace')
+    if trace_file:
+        trace.enable()
+    try:
+        with trace.span('push', args=args):
+            return _push(core, args)
+    finally:
+        if trace_file:
+            trace.write(trace_file)
+            trace.disable()
+            out.info('Trace written to {}', trace_file)
+
+
+def _push(core, args):
+    out = core.get_output()
+    targets = _parse_targets(core, args[1:])
+    if not targets:
+        return 1
+    image = _generate_image(core)
+    if image is None:
+        return 1
+
+    if len(targets) == 1:
+        # Invoke the actuator with the specified arguments.
+        label, actuator, actuator_args = targets[0]
+        out.write_data(actuator.push(core, image, actuator_args))
         return
-    image = genimage(core, args[0])
-    actuator = core.get_actuator(args[1])
-    if actuator is None:
-        out.error('No actuator named {}'.format(args[1]))
-        return
 
-    # Invoke the actuator with the specified arguments.
-    out.write_data(actuator.push(core, image, args[2:]))
+    results, status = _push_targets(core, image, targets)
+    out.write_data(results)
+    return status
+
+
+def _push_targets(core, image, targets, label_prefix=''):
+    """Pushes an image to several targets concurrently.
+
+    When there is more than one target, the files are staged once for all
+    of them: they're copied into a shared staging directory, a snapshot
+    that the actuators stage from.  Each target is named by its label in
+    $SXC_TARGET_LABEL so that actuators keep separate state for targets that
+    use the same actuator.
+
+    Args:
+        core: (sxc.core.Core)
+        image: (dict) The image.
+        targets: ([(label, actuator, args), ...]) As from _parse_targets().
+        label_prefix: (str) Prefix for the labels of the messages from the
+            pushes.
+
+    Returns:
+        (results, status) where 'results' maps target labels to the results
+        of the pushes and 'status' is 1 if any of them failed.
+    """
+    env = None
+    if len(targets) > 1:
+        source_dir = core.get_source_directory()
+        shared_staging_dir = extlib.persistent_staging_dir(source_dir,
+                                                           'shared')
+        with trace.span('stage'):
+            extlib.sync_files(source_dir, image, shared_staging_dir)
+        env = dict(os.environ)
+        env[extlib.SHARED_STAGING_ENV] = shared_staging_dir
+
+    calls = []
+    for label, actuator, actuator_args in targets:
+        target_env = None
+        if env:
+            target_env = dict(env)
+            target_env[extlib.TARGET_LABEL_ENV] = label
+        calls.append((label, actuator.push_async(core, image, actuator_args,
+                                                 label=label_prefix + label,
+                                                 env=target_env)))
+    results = {}
+    status = None
+    for label, call in calls:
+        results[label] = call.result()
+        if call.returncode != 0:
+            core.get_output().error('Push to {}{} failed', label_prefix,
+                                    label)
+            status = 1
+    return results, status
+
+
+def serve(core, args):
+    """[--socket <path>]
+    Run the sxc server.  While the server is running, sxc commands are
+    forwarded to it and start without reloading sxc or its extensions.
+    The socket defaults to $SXC_SERVER_SOCKET or server.sock in the sxc
+    cache directory.  Set SXC_NO_SERVER to run a command without the server.
+    """
+    from sxc import server
+    try:
+        opts, args = getopt.getopt(args, '', ['socket='])
+    except getopt.GetoptError as ex:
+        core.get_output().error('{}', ex)
+        return 1
+    if args:
+        core.get_output().write_markdown('serve ' + serve.__doc__)
+        return 1
+    return server.serve(dict(opts).get('--socket'))
 
 
 # Build the set of commands from the command functions.
 _commands = {}
-for cmd in [help, inspect, list_aggregators, genimage, push]:
+for cmd in [help, inspect, list_aggregators, genimage, push, serve]:
     _commands[cmd.__name__] = cmd
 
 
-def main(argv):
+def get_extensions_dir(argv):
+    """Returns the extensions directory for the sxc script named by argv[0].
+    """
     # We're temporarily assuming that extensions and this script are all in the
     # same tree.  This works for a demo but we'll need to change it long-term.
     root_dir = os.path.dirname(os.path.dirname(os.path.realpath(argv[0])))
-    extensions_dir = os.path.join(root_dir, 'extensions')
+    return os.path.join(root_dir, 'extensions')
+
+
+def run(core, argv):
+    """Runs the command named by argv[1] with the rest of argv as arguments.
 
-    core = StandardCore(extensions_dir)
+    Returns:
+        (int or None) the exit status of the command.
+    """
     if len(argv) < 2:
         help(core)
         return 1
@@ -103,5 +395,9 @@ def main(argv):
         return 1
 
     # Call the command with the remaining user-provided arguments.
-    command(core, argv[2:])
+    return command(core, argv[2:])
+
+
+def main(argv):
+    return run(StandardCore(get_extensions_dir(argv)), argv)
 
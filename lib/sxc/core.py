@@ -15,15 +15,65 @@
 """SourceXCloud core context.
 """
 
+import collections
+import functools
+import hashlib
+import imp
 import json
 import os
-import subprocess
+import re
 import sys
-import yaml
+import time
 
 from sxc import aggregator as agg
 from sxc import actuator as acc
+from sxc import cache
+from sxc import extlib
+from sxc import match as match_rules
 from sxc import proclib
+from sxc import trace
+from sxc import worker
+
+# Interval (in seconds) at which find_aggregator() polls running checks.
+_MATCH_POLL_INTERVAL = 0.005
+
+
+# Version of the format of the extension registry.
+_REGISTRY_VERSION = 1
+
+# The most source directories that the detection state remembers the result
+# for.  The least recently used ones are forgotten first.
+_MAX_DETECTION_DIRS = 1000
+
+# A cached detection result is marked as used again (which costs a write of
+# the detection state) when it was last marked this long (in seconds) ago.
+_DETECTION_TOUCH_INTERVAL = 3600
+
+# Tree indexes (see StandardCore.index_source_tree()) that haven't been
+# rewritten for this long (in seconds) are deleted.
+_INDEX_MAX_AGE = 7 * 24 * 3600
+
+
+def _stamp(path):
+    """Returns [path, mtime] for 'path', the mtime is None if it's missing."""
+    try:
+        return [path, os.stat(path).st_mtime]
+    except OSError:
+        return [path, None]
+
+
+def _is_stale(registry):
+    """Returns true if the extension registry needs to be rebuilt."""
+    return (registry.get('version') != _REGISTRY_VERSION or
+            any(_stamp(path) != [path, mtime]
+                for path, mtime in registry['stamps']))
+
+
+def _cpu_count():
+    try:
+        return os.sysconf('SC_NPROCESSORS_ONLN')
+    except (AttributeError, ValueError):
+        return 2
 
 class Output(object):
     """Encapsulates all output to the user.
@@ -76,8 +126,25 @@ class Output(object):
         """Write a row of tabular data."""
         raise NotImplementedError()
 
-    def write_data(self, object):
-        """Write a raw data object in pretty-printed yaml-like format."""
+    def write_data(self, object, max_items=None):
+        """Write a raw data object in pretty-printed yaml-like format.
+
+        Args:
+            object: The data object.  Lists may be replaced by iterators.
+            max_items: (int or None) If provided, only this many items of
+                any list are written, followed by the number of items that
+                were left out (iterators aren't consumed any further, so
+                their count is unknown).  Defaults to the output's own
+                limit.
+        """
+        raise NotImplementedError()
+
+    def set_max_items(self, max_items):
+        """Sets the default item limit of write_data().
+
+        Args:
+            max_items: (int or None) The limit, None for no limit.
+        """
         raise NotImplementedError()
 
 
@@ -99,6 +166,83 @@ class Utils(object):
         """
         raise NotImplementedError()
 
+    def start_hook(self, prefix, hook_name, *args):
+        """Start the specified hook without waiting for it to complete.
+
+        Args:
+            prefix: (str) The root directory of the bundle.
+            hook_name: (str) The name of the hook program.
+            *args: ([str, ...]) List of arguments to pass to the hook.
+
+        Returns:
+            (.proclib.Process or .worker.WorkerCall) The hook process (or
+            the call, if the hook is served by a worker), None if the hook
+            doesn't exist.
+        """
+        raise NotImplementedError()
+
+    def add_worker(self, prefix, hook_names):
+        """Has hooks of an extension served by its worker program.
+
+        See sxc.worker.  Calls to these hooks are sent to $prefix/bin/worker,
+        which is started on first use and kept running.
+
+        Args:
+            prefix: (str) The root directory of the bundle.
+            hook_names: ([str, ...]) The names of the hooks that the worker
+                serves.
+        """
+        raise NotImplementedError()
+
+
+class HookError(Exception):
+    """A hook failed to produce its output."""
+
+
+class HookCall(object):
+    """A hook invocation that may still be in progress.
+
+    Waiting for the result of a call runs the hook event loop, so all other
+    hooks that are running concurrently make progress too.
+    """
+
+    def __init__(self, process, get_result, returncode=None):
+        """Constructor.
+
+        Args:
+            process: (.proclib.Process or None) The hook process, None if
+                there is no hook or the call was completed in-process.
+            get_result: (callable()) Returns the result of the call once the
+                process has completed.
+            returncode: (int or None) The exit code to report if there is no
+                process.
+        """
+        self.process = process
+        self.__get_result = get_result
+        self.__returncode = returncode
+
+    @property
+    def returncode(self):
+        """The exit code of the hook, None if it is missing or running."""
+        if self.process:
+            return self.process.returncode
+        return self.__returncode
+
+    def done(self):
+        """Returns true if the hook has completed."""
+        return self.process is None or self.process.poll() is not None
+
+    def cancel(self):
+        """Kills the hook if it is still running."""
+        if self.process:
+            self.process.cancel()
+
+    def result(self):
+        """Waits for the hook to complete and returns its result."""
+        if self.process:
+            self.process.wait()
+        return self.__get_result()
+
 
 class Core(object):
     """Encapsulates the crepusucular framework's core context information.
@@ -126,6 +270,27 @@ class Core(object):
         """Returns the list of aggregators in the order preferred by the user."""
         raise NotImplementedError()
 
+    def find_aggregator(self):
+        """Returns the aggregator for the source directory.
+
+        If more than one aggregator matches, the one that comes first in
+        get_ordered_aggregators() wins.  Implementations may cache the result
+        for as long as the fingerprints of the aggregators don't change.
+
+        Returns:
+            (.aggregator.Aggregator) The matching aggregator, None if there is
+            none.
+        """
+        raise NotImplementedError()
+
+    def index_source_tree(self):
+        """Makes an index of the source directory available to hooks.
+
+        Commands call this before generating an image, see
+        extlib.get_tree_index().  Cores that don't index do nothing.
+        """
+        pass
+
     def get_utils(self):
         """Returns a Utils object for the system."""
         raise NotImplementedError()
@@ -135,40 +300,95 @@ class Core(object):
         raise NotImplementedError()
 
 
-def _write_dict(object, indent, written):
-    sys.stdout.write('\n')
-    for key, val in object.iteritems():
-        sys.stdout.write('  ' * indent)
-        sys.stdout.write('\033[36;40m{}: '.format(key))
-        _write_object(val, indent + 1, written)
+# Colors of the keys, list items, values and errors in data objects.
+_DATA_COLORS = ('\033[36;40m', '\033[33;40m', '\033[37;40m', '\033[31;40m')
 
+# write_data() writes its output in pieces of about this size.
+_OUTPUT_BUFFER_SIZE = 65536
 
-def _write_list(object, indent, written):
-    sys.stdout.write('\n')
-    for item in object:
-        sys.stdout.write('  ' * indent)
-        sys.stdout.write('\033[33;40m- ')
-        _write_object(item, indent + 1, written)
+# Kinds of entries on the stack of _render_data().
+_TEXT, _VALUE, _ITEMS, _LEAVE = range(4)
 
 
-def _write_object(object, indent, written):
+def _render_data(object, color, max_items=None):
+    """Generates the pretty-printed form of a data object.
 
-    # Check for a cycle.
-    obj_id = id(object)
-    if obj_id in written:
-        sys.stdout.write('\033[31;40mCYCLE!')
-        return
-    written.add(obj_id)
+    The object is walked with an explicit stack, so there is no limit to its
+    depth.  Lists and iterators with more than 'max_items' items are
+    truncated and followed by a note of the remaining items.  That note
+    counts them for lists only: iterators are left alone once the limit is
+    reached, since they may be expensive (walking a source tree, say).
 
-    # Write based on the specific object type.
-    if isinstance(object, dict):
-        _write_dict(object, indent, written)
-    elif isinstance(object, list):
-        _write_list(object, indent, written)
-    else:
-        sys.stdout.write('\033[37;40m{}\n'.format(object))
+    Args:
+        object: The data object, made of dicts, lists, iterators and
+            scalars.
+        color: (bool) Whether to use ANSI colors.
+        max_items: (int or None) Maximum number of items to show for any
+            list or iterator, None for no limit.
 
-    written.remove(obj_id)
+    Returns:
+        (iterator of str) the pieces of the output.
+    """
+    if color:
+        key_color, item_color, value_color, error_color = _DATA_COLORS
+    else:
+        key_color = item_color = value_color = error_color = ''
+
+    # Entries are (_TEXT, text), (_VALUE, object, indent, noun),
+    # (_ITEMS, iterator, indent, noun, shown, total) and (_LEAVE, id).
+    # 'noun' is what the items of a list are called in its summary, the key
+    # of the list if it's a dict value.
+    stack = [(_VALUE, object, 0, None)]
+
+    # The ids of the containers that we're in the middle of, to detect
+    # cycles.
+    path = set()
+
+    while stack:
+        entry = stack.pop()
+        kind = entry[0]
+        if kind == _TEXT:
+            yield entry[1]
+        elif kind == _LEAVE:
+            path.discard(entry[1])
+        elif kind == _ITEMS:
+            kind, items, indent, noun, shown, total = entry
+            for item in items:
+                break
+            else:
+                continue
+            if max_items is not None and shown >= max_items:
+                if total is None:
+                    rest = ''
+                else:
+                    rest = '{:,} '.format(total - shown)
+                yield '{}{}... {}more {}\n'.format(
+                    '  ' * indent, item_color, rest, noun or 'items')
+                continue
+            stack.append((_ITEMS, items, indent, noun, shown + 1, total))
+            stack.append((_VALUE, item, indent + 1, None))
+            yield '{}{}- '.format('  ' * indent, item_color)
+        else:
+            kind, object, indent, noun = entry
+            if not isinstance(object, (dict, list, collections.Iterator)):
+                yield '{}{}\n'.format(value_color, object)
+                continue
+
+            obj_id = id(object)
+            if obj_id in path:
+                yield '{}CYCLE!\n'.format(error_color)
+                continue
+            path.add(obj_id)
+            stack.append((_LEAVE, obj_id))
+            yield '\n'
+            if isinstance(object, dict):
+                for key, val in reversed(object.items()):
+                    stack.append((_VALUE, val, indent + 1, key))
+                    stack.append((_TEXT, '{}{}{}: '.format('  ' * indent,
+                                                           key_color, key)))
+            else:
+                total = len(object) if isinstance(object, list) else None
+                stack.append((_ITEMS, iter(object), indent, noun, 0, total))
 
 
 def _nl_terminate(line):
@@ -190,37 +410,114 @@ def _nl_terminate(line):
 class StandardOutput(Output):
     """Standard implementation of Output.
 
-    Writes colored text to stdout/stderr.
+    Writes text to stdout/stderr, colored if they are terminals.
     """
 
+    def __init__(self, color=None, max_items=None):
+        """Constructor.
+
+        Args:
+            color: (bool or None) Whether to use ANSI colors.  By default,
+                colors are used for the streams that are terminals.
+            max_items: (int or None) Default item limit of write_data().
+        """
+        self.__color = color
+        self.__max_items = max_items
+
+    def __use_color(self, stream):
+        if self.__color is not None:
+            return self.__color
+        try:
+            return stream.isatty()
+        except AttributeError:
+            return False
+
+    def __write(self, stream, color, text):
+        if self.__use_color(stream):
+            stream.write('{}{}\033[m'.format(color, text))
+        else:
+            stream.write(text)
+
     def error(self, fmt, *args, **kwargs):
         assert not (args and kwargs), (
             "error() method can accept either args or kwargs, but not both.")
         content = fmt.format(*args) if args else fmt.format(**kwargs)
-        sys.stderr.write('\033[31;40m{}\033[m'.format(_nl_terminate(content)))
+        self.__write(sys.stderr, '\033[31;40m', _nl_terminate(content))
 
     def info(self, fmt, *args, **kwargs):
         assert not (args and kwargs), (
             "info() method can accept either args or kwargs, but not both.")
         content = fmt.format(*args) if args else fmt.format(**kwargs)
-        sys.stderr.write('\033[32;40m{}\033[m'.format(_nl_terminate(content)))
+        self.__write(sys.stderr, '\033[32;40m', _nl_terminate(content))
 
     def warn(self, fmt, *args, **kwargs):
         assert not (args and kwargs), (
             "warn() method can accept either args or kwargs, but not both.")
         content = fmt.format(*args) if args else fmt.format(**kwargs)
-        sys.stderr.write('\033[33;40m{}\033[m'.format(_nl_terminate(content)))
+        self.__write(sys.stderr, '\033[33;40m', _nl_terminate(content))
 
     def write_markdown(self, document):
-        sys.stdout.write('\033[36;40m')
-        sys.stdout.write(document)
-        sys.stdout.write('\033[m')
+        self.__write(sys.stdout, '\033[36;40m', document)
 
     def write_row(self, *columns):
-        sys.stdout.write('\033[37;40m{}\n'.format(' '.join(columns)))
+        self.__write(sys.stdout, '\033[37;40m',
+                     '{}\n'.format(' '.join(columns)))
+
+    def write_data(self, object, max_items=None):
+        if max_items is None:
+            max_items = self.__max_items
+        color = self.__use_color(sys.stdout)
+
+        # Collect the output into large writes.
+        buffer = []
+        size = 0
+        for piece in _render_data(object, color, max_items):
+            buffer.append(piece)
+            size += len(piece)
+            if size >= _OUTPUT_BUFFER_SIZE:
+                sys.stdout.write(''.join(buffer))
+                buffer = []
+                size = 0
+        if color:
+            buffer.append('\033[m')
+        sys.stdout.write(''.join(buffer))
+
+    def set_max_items(self, max_items):
+        self.__max_items = max_items
+
+
+class _TracedHook(object):
+    """A started hook that calls a function once it has completed.
+
+    This has the interface of the hook process (or worker call) that it
+    wraps.
+    """
+
+    def __init__(self, process, on_complete):
+        """Constructor.
+
+        Args:
+            process: (.proclib.Process or .worker.WorkerCall) The hook.
+            on_complete: (callable(process)) Called with 'process' the first
+                time that it's found to have completed.
+        """
+        self.__process = process
+        self.__on_complete = on_complete
+
+    def __getattr__(self, name):
+        return getattr(self.__process, name)
 
-    def write_data(self, object):
-        _write_object(object, 0, set())
+    def __check(self, returncode):
+        if returncode is not None and self.__on_complete:
+            on_complete, self.__on_complete = self.__on_complete, None
+            on_complete(self.__process)
+        return returncode
+
+    def poll(self):
+        return self.__check(self.__process.poll())
+
+    def wait(self):
+        return self.__check(self.__process.wait())
 
 
 class StandardUtils(Utils):
@@ -233,10 +530,89 @@ class StandardUtils(Utils):
         """
         self.out = out
 
-    def call_hook(self, prefix, hook_name, *args):
+        # All hooks are run from a single runner so that any that are
+        # running concurrently share its event loop.  It's created on first
+        # use so that a core can be built before forking (see sxc.server)
+        # without the processes sharing an epoll instance.
+        self.__runner = None
+
+        # The hooks served by workers and the running workers, by prefix.
+        self.__worker_hooks = {}
+        self.__workers = {}
+
+    def __get_runner(self):
+        if self.__runner is None:
+            self.__runner = proclib.Runner()
+        return self.__runner
+
+    def add_worker(self, prefix, hook_names):
+        self.__worker_hooks[prefix] = frozenset(hook_names)
+
+    def __get_worker(self, prefix, hook_name):
+        """Returns the worker serving a hook, None if it isn't served by one.
+        """
+        if hook_name not in self.__worker_hooks.get(prefix, ()):
+            return None
+        hook_worker = self.__workers.get(prefix)
+        if hook_worker is None or not hook_worker.is_running():
+            worker_path = os.path.join(prefix, 'bin', 'worker')
+            if not os.path.exists(worker_path):
+                return None
+            def on_error(line):
+                self.out.error('{}', line)
+            hook_worker = self.__workers[prefix] = worker.Worker(
+                self.__get_runner(), worker_path, error_callback=on_error)
+        return hook_worker
+
+    def __spawn(self, prefix, hook_name, args, **kwargs):
+        """Starts a hook with the keyword arguments of proclib.Runner.spawn().
+
+        Returns:
+            (.proclib.Process or .worker.WorkerCall) The hook process, or
+            the call if the hook is served by a worker.  None if the hook
+            doesn't exist.
+        """
+        hook_worker = self.__get_worker(prefix, hook_name)
+        if hook_worker:
+            # The worker may have been started before the source tree was
+            # indexed, give the call our current environment.
+            if (kwargs.get('env') is None and
+                extlib.TREE_INDEX_ENV in os.environ):
+                kwargs = dict(kwargs, env=dict(os.environ))
+            return hook_worker.call(hook_name, args, **kwargs)
         full_hook_name = os.path.join(prefix, 'bin', hook_name)
-        return (os.path.exists(full_hook_name) and
-                not subprocess.call([full_hook_name,] + list(args)))
+        if not os.path.exists(full_hook_name):
+            return None
+        return self.__get_runner().spawn(full_hook_name, *args, **kwargs)
+
+    def __trace_hook(self, process, prefix, hook_name, label=None):
+        """Records the span of a completed hook process when tracing."""
+        if not trace.is_enabled():
+            return
+        name = '{}:{}'.format(os.path.basename(prefix), hook_name)
+        trace.set_track_name(process.pid, label or name)
+        trace.add_span(name, process.start_time,
+                       process.end_time or time.time(), track=process.pid,
+                       args={'args': list(process.args[1:]),
+                             'returncode': process.returncode})
+
+    def call_hook(self, prefix, hook_name, *args):
+        process = self.start_hook(prefix, hook_name, *args)
+        if process is None:
+            return False
+        return process.wait() == 0
+
+    def start_hook(self, prefix, hook_name, *args):
+        """See Utils.start_hook().
+
+        When tracing, the span of the hook is recorded as soon as polling
+        or waiting finds that it has completed.
+        """
+        process = self.__spawn(prefix, hook_name, args)
+        if process is None or not trace.is_enabled():
+            return process
+        return _TracedHook(process, lambda process: self.__trace_hook(
+            process, prefix, hook_name))
 
     def get_hook_output(self, prefix, hook_name, *args, **kwargs):
         """Returns an object representing the output of a hook.
@@ -251,24 +627,61 @@ class StandardUtils(Utils):
             **kwargs: keyword arguments:
                 input: (str) If provided, this is the input to pass to the
                     hook.
+                timeout: (float) If provided, the hook is killed after this
+                    many seconds.
+                env: (dict) Environment of the hook process.
 
         Returns:
             The python representation of the JSON document output by the hook
             or None if the hook doesn't exist.
+
+        Raises:
+            HookError: The hook timed out, or failed without producing a
+                JSON document.
         """
+        return self.get_hook_output_async(prefix, hook_name, *args,
+                                          **kwargs).result()
 
+    def get_hook_output_async(self, prefix, hook_name, *args, **kwargs):
+        """Starts a hook without waiting for its output.
+
+        Like get_hook_output(), but returns immediately.  Any number of hooks
+        can be running at once.
+
+        Returns:
+            (HookCall) The result() of the call is the value that would have
+            been returned by get_hook_output().
+        """
         full_hook_name = os.path.join(prefix, 'bin', hook_name)
-        if not os.path.exists(full_hook_name):
-            return None
+        output = []
+        err = []
+        process = self.__spawn(prefix, hook_name, args,
+                               stdin=kwargs.get('input'),
+                               stdout_batch_callback=output.extend,
+                               stderr_batch_callback=err.extend,
+                               timeout=kwargs.get('timeout'),
+                               env=kwargs.get('env'))
+        if process is None:
+            return HookCall(None, lambda: None)
+
+        def get_result():
+            self.__trace_hook(process, prefix, hook_name)
+            if err:
+                self.out.error('Error output from {}:\n', full_hook_name)
+                self.out.error('  {}', '  \n'.join(''.join(err).split('\n')))
+            # The output of a hook that was killed is incomplete.
+            if process.timed_out:
+                raise HookError('{} timed out after {} seconds'.format(
+                    full_hook_name, kwargs.get('timeout')))
+            try:
+                return json.loads(''.join(output))
+            except ValueError as ex:
+                if not process.returncode:
+                    raise
+                raise HookError('{} failed with exit status {}: {}'.format(
+                    full_hook_name, process.returncode, ex))
 
-        proc = subprocess.Popen([full_hook_name] + list(args),
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                stdin=subprocess.PIPE)
-        output, err = proc.communicate(kwargs.get('input'))
-        if err:
-            self.out.error('Error output from {}:\n', full_hook_name)
-            self.out.error('  {}', '  \n'.join(err.split('\n')))
-        return json.loads(output)
+        return HookCall(process, get_result)
 
     def run_hook(self, prefix, hook_name, *args, **kwargs):
         """Returns an object representing the final result of a hook.
@@ -283,15 +696,34 @@ class StandardUtils(Utils):
             **kwargs: keyword arguments:
                 input: (str) If provided, this is the input to pass to the
                     hook.
+                timeout: (float) If provided, the hook is killed after this
+                    many seconds.
+                label: (str) If provided, messages from the hook are
+                    prefixed with this label.
+                env: (dict) Environment of the hook process.
 
         Returns:
             The python representation of the JSON document output by the hook
             or None if the hook doesn't exist.
         """
+        return self.run_hook_async(prefix, hook_name, *args, **kwargs).result()
+
+    def run_hook_async(self, prefix, hook_name, *args, **kwargs):
+        """Starts a hook without waiting for its result.
+
+        Like run_hook(), but returns immediately.  Any number of hooks can be
+        running at once, their messages are relayed as they arrive.
+
+        Returns:
+            (HookCall) The result() of the call is the value that would have
+            been returned by run_hook().
+        """
 
         result = []
+        label = kwargs.get('label')
+        tag = '[{}] '.format(label) if label else ''
         def on_error(line):
-            self.out.error('{}:{} {}', prefix, hook_name, line)
+            self.out.error('{}{}:{} {}', tag, prefix, hook_name, line)
 
         def on_stdout_line(line):
             try:
@@ -300,11 +732,15 @@ class StandardUtils(Utils):
                 if type == 'result':
                     result.append(obj)
                 elif type == 'error':
-                    self.out.error('{}', obj.get('error'))
+                    self.out.error('{}{}', tag, obj.get('error'))
                 elif type == 'info':
-                    self.out.info('{}', obj.get('message'))
+                    self.out.info('{}{}', tag, obj.get('message'))
                 elif type == 'warn':
-                    self.out.warn('{}', obj.get('message'))
+                    self.out.warn('{}{}', tag, obj.get('message'))
+                elif type == 'span':
+                    trace.add_span(obj.get('name'), obj.get('start'),
+                                   obj.get('end'), track=process.pid,
+                                   args=obj.get('args'))
                 else:
                     self.out.error('Unrecognized object:\n')
                     self.out.write_data(obj)
@@ -315,46 +751,231 @@ class StandardUtils(Utils):
             self.out.error('Error reading from {} of hook {}:{}',
                            pipe_name, prefix, hook_name)
 
-        full_hook_name = os.path.join(prefix, 'bin', hook_name)
-        if not os.path.exists(full_hook_name):
-            return None
+        process = self.__spawn(prefix, hook_name, args,
+                               stdin=kwargs.get('input'),
+                               stdout_callback=on_stdout_line,
+                               stderr_callback=on_error,
+                               pipe_error_callback=on_pipe_error,
+                               timeout=kwargs.get('timeout'),
+                               env=kwargs.get('env'))
+        if process is None:
+            return HookCall(None, lambda: None)
 
-        proclib.run(*[full_hook_name] + list(args),
-                    stdin=kwargs.get('input'),
-                    stdout_callback=on_stdout_line,
-                    stderr_callback=on_error,
-                    pipe_error_callback=on_pipe_error)
+        def get_result():
+            self.__trace_hook(process, prefix, hook_name, label)
+            return result[0] if result else None
 
-        return result[0] if result else None
+        return HookCall(process, get_result)
+
+
+class _LazyPlugin(object):
+    """Stands in for an extension with an in-process implementation.
+
+    The plugin module is only loaded when the extension is used for more
+    than its info and fingerprint (which come from the extension's files,
+    like those of the hook based extension): typically once the aggregator
+    has been chosen or the actuator is pushed to.  If the plugin can't be
+    loaded, the hook based extension is used instead.
+    """
+
+    # Attributes that are always taken from the hook based extension.
+    _FALLBACK_ATTRS = frozenset(['get_info', 'get_fingerprint', 'hooks'])
+
+    def __init__(self, fallback, load):
+        """Constructor.
+
+        Args:
+            fallback: (.aggregator.AggregatorExtension or
+                .actuator.ActuatorExtension) The hook based extension.
+            load: (callable()) Returns the plugin object, None if it can't be
+                loaded.
+        """
+        self.root = fallback.root
+        self.name = fallback.name
+        self.__fallback = fallback
+        self.__load = load
+        self.__plugin = None
+
+    def load(self):
+        """Returns the plugin (or the fallback), loading it if necessary."""
+        if self.__plugin is None:
+            self.__plugin = self.__load() or self.__fallback
+        return self.__plugin
+
+    def __getattr__(self, name):
+        if name in self._FALLBACK_ATTRS:
+            return getattr(self.__fallback, name)
+        return getattr(self.load(), name)
 
 
 class StandardCore(Core):
     """Standard implementation of Core."""
 
-    def __init__(self, sxc_root):
+    def __init__(self, sxc_root, max_match_workers=None, source_dir=None):
         """Constructor.
 
         Args:
             sxc_root: (basestring) Root of the SourceXCloud distribution.
+            max_match_workers: (int or None) Maximum number of aggregator
+                matches checks to run at the same time.  Defaults to the
+                number of CPUs.
+            source_dir: (basestring or None) The user's source directory,
+                defaults to the current directory.
         """
         self.root = sxc_root
+        self.__max_match_workers = max_match_workers or _cpu_count()
         self.__output = StandardOutput()
         self.__aggregators = None
+        self.__ordered_aggregators = None
         self.__actuators = None
+        self.__detection_store = cache.JSONStore('detection.json')
+        self.__registry_store = cache.JSONStore('registry.json')
+        self.__registry = None
+        self.__detection_state = None
+        self.__indexed_dir = None
         self.__utils = StandardUtils(self.__output)
-        self.__source_dir = os.getcwd()
+        self.__source_dir = source_dir or os.getcwd()
 
     def get_output(self):
         return self.__output
 
+    def __build_registry(self):
+        """Builds the extension registry by scanning the extension dirs.
+
+        See __get_registry() for the format.
+        """
+        stamps = []
+        extensions = {}
+        for plugin_type in ('aggregators', 'actuators'):
+            type_dir = os.path.join(self.root, plugin_type)
+            stamps.append(_stamp(type_dir))
+            extensions[plugin_type] = entries = []
+            for name in sorted(os.listdir(type_dir)):
+                extension_root = os.path.join(type_dir, name)
+                data_dir = os.path.join(extension_root, 'data')
+                bin_dir = os.path.join(extension_root, 'bin')
+                info_file = os.path.join(data_dir, 'info.json')
+                stamps.extend(_stamp(path) for path in
+                              (extension_root, data_dir, bin_dir, info_file))
+                try:
+                    with open(info_file) as f:
+                        info = json.load(f)
+                except IOError:
+                    info = {'name': name}
+                except ValueError:
+                    # Let the extension report the error if it's used.
+                    info = None
+                try:
+                    hooks = sorted(os.listdir(bin_dir))
+                except OSError:
+                    hooks = []
+                entries.append({'root': extension_root, 'info': info,
+                                'hooks': hooks})
+        return {'version': _REGISTRY_VERSION, 'stamps': stamps,
+                'extensions': extensions}
+
+    def __get_registry(self):
+        """Returns the extension registry.
+
+        The registry is a dictionary containing:
+            version: the version of the registry format.
+            stamps: [path, mtime] pairs for the directories and files that
+                the registry was built from.
+            extensions: maps 'aggregators' and 'actuators' to lists of
+                dictionaries describing each extension: its 'root' directory,
+                its parsed 'info' file (None if it's invalid) and the names
+                of its 'hooks'.
+
+        It is cached and only rebuilt when any of the stamps change, so most
+        commands never have to read the extension directories.
+        """
+        if self.__registry is None:
+            registries = self.__registry_store.load()
+            registry = registries.get(self.root)
+            if not registry or _is_stale(registry):
+                registry = self.__build_registry()
+                registries[self.root] = registry
+                self.__registry_store.save(registries)
+            self.__registry = registry
+        return self.__registry
+
+    def refresh(self):
+        """Drops in-memory state that may be out of date.
+
+        Long-lived cores (see sxc.server) call this between commands.  The
+        extensions are reloaded if they have changed and the detection state
+        is re-read.
+        """
+        if self.__registry is not None and _is_stale(self.__registry):
+            self.__registry = None
+            self.__aggregators = None
+            self.__actuators = None
+        self.__ordered_aggregators = None
+        self.__detection_state = None
+        self.__indexed_dir = None
+
+    def __load_python_plugin(self, plugin_type, entry):
+        """Loads the in-process implementation of an extension.
+
+        The module is compiled from source without writing bytecode to the
+        extension directory.
+
+        Args:
+            plugin_type: (str) 'aggregators' or 'actuators'.
+            entry: (dict) The extension's registry entry.
+
+        Returns:
+            The object returned by the create() function of the module named
+            in the 'plugin' key of the extension's info file, None if it
+            could not be loaded.
+        """
+        extension_root = entry['root']
+        module_name = 'sxc_plugin_{}_{}'.format(
+            plugin_type,
+            re.sub(r'\W', '_', os.path.basename(extension_root)))
+        dont_write_bytecode = sys.dont_write_bytecode
+        sys.dont_write_bytecode = True
+        try:
+            module = imp.load_source(
+                module_name,
+                os.path.join(extension_root, entry['info']['plugin']))
+            plugin = module.create(extension_root)
+        except Exception as ex:
+            self.__output.warn('Unable to load plugin {}, falling back to '
+                               'hooks: {}', extension_root, ex)
+            return None
+        finally:
+            sys.dont_write_bytecode = dont_write_bytecode
+        plugin.set_registry_entry(entry)
+        return plugin
+
     def __build_plugin_list(self, plugin_type, plugin_factory):
         plugins = []
-        type_dir = os.path.join(self.root, plugin_type)
-        for dir in os.listdir(type_dir):
-            full_name = os.path.join(type_dir, dir)
-            plugins.append(plugin_factory(full_name))
+        for entry in self.__get_registry()['extensions'][plugin_type]:
+            # Hooks served by a worker count as hooks of the extension.
+            worker_hooks = (entry['info'] or {}).get('worker')
+            if worker_hooks and 'worker' in entry['hooks']:
+                self.__utils.add_worker(entry['root'], worker_hooks)
+                entry = dict(entry, hooks=sorted(set(entry['hooks']) |
+                                                 set(worker_hooks)))
+            plugin = plugin_factory(entry['root'])
+            plugin.set_registry_entry(entry)
+            if (entry['info'] or {}).get('plugin'):
+                plugin = _LazyPlugin(plugin, functools.partial(
+                    self.__load_python_plugin, plugin_type, entry))
+            plugins.append(plugin)
         return plugins
 
+    def load_plugins(self):
+        """Loads the in-process implementations of all extensions now.
+
+        They are otherwise loaded as they're needed.  Long-lived cores (see
+        sxc.server) call this so that the commands they run don't have to.
+        """
+        for plugin in self.get_aggregators() + self.get_actuators():
+            if isinstance(plugin, _LazyPlugin):
+                plugin.load()
+
     def get_aggregators(self):
         if self.__aggregators is None:
             self.__aggregators = self.__build_plugin_list(
@@ -374,12 +995,227 @@ class StandardCore(Core):
                 return actuator
         return None
 
+    def __get_detection_state(self):
+        """Returns the persistent detection state.
+
+        This is a dictionary containing:
+            dirs: maps source directories to a dictionary containing the
+                'fingerprint' of the directory, the name of the 'aggregator'
+                that matched it and when the result was last 'used' (see
+                _DETECTION_TOUCH_INTERVAL).  There are at most
+                _MAX_DETECTION_DIRS of them.
+            hits: maps aggregator names to the number of times that they
+                have matched a source directory.
+        """
+        if self.__detection_state is None:
+            self.__detection_state = self.__detection_store.load()
+        return self.__detection_state
+
+    def __get_source_fingerprint(self):
+        """Returns the fingerprint of the source directory for detection.
+
+        This covers the top-level entries of the source directory and the
+        per-aggregator fingerprints (which in turn cover the extension
+        versions and the files that they look at).  Returns None if any
+        aggregator can not be cached.
+        """
+        try:
+            parts = [os.stat(self.get_source_directory()).st_mtime]
+        except OSError:
+            return None
+        for aggregator in self.get_aggregators():
+            fingerprint = aggregator.get_fingerprint(self)
+            if fingerprint is None:
+                return None
+            parts.append((aggregator.get_info(self).get('name'), fingerprint))
+        return hashlib.sha1(repr(parts)).hexdigest()
+
     def get_ordered_aggregators(self):
-        # Not really ordered at this time.
-        return self.get_aggregators()
+        # Aggregators are ordered by their declared priority and then by
+        # name, so the aggregator that wins never depends on past results.
+        if self.__ordered_aggregators is None:
+            def sort_key(aggregator):
+                info = aggregator.get_info(self)
+                return (-info.get('priority', 0), info.get('name') or '')
+            self.__ordered_aggregators = sorted(self.get_aggregators(),
+                                                key=sort_key)
+        return self.__ordered_aggregators
+
+    def __get_launch_order(self):
+        """Returns the aggregators in the order that their checks start.
+
+        Among aggregators of the same priority, the ones that have matched
+        most often in the past are tried first, so the winner is usually
+        known after the first few checks.  This only changes how soon the
+        result is known, not which aggregator wins.
+        """
+        hits = self.__get_detection_state().get('hits', {})
+        def sort_key(aggregator):
+            info = aggregator.get_info(self)
+            return (-info.get('priority', 0), -hits.get(info.get('name'), 0))
+        return sorted(self.get_ordered_aggregators(), key=sort_key)
+
+    def index_source_tree(self):
+        """Scans the source directory into the index shared with hooks.
+
+        This is done once per invocation (and source directory), see
+        extlib.get_tree_index().  Every source directory has its own index
+        file, those of directories that haven't been indexed for
+        _INDEX_MAX_AGE are deleted.
+        """
+        source_dir = self.get_source_directory()
+        if self.__indexed_dir == source_dir:
+            return
+        index_dir = cache.get_cache_dir('index')
+        key = hashlib.sha1(os.path.abspath(source_dir)).hexdigest()
+        path = os.path.join(index_dir, key)
+        with trace.span('index'):
+            extlib.write_tree_index(source_dir, path)
+        os.environ[extlib.TREE_INDEX_ENV] = path
+        self.__indexed_dir = source_dir
+
+        expired = time.time() - _INDEX_MAX_AGE
+        for name in os.listdir(index_dir):
+            stale_path = os.path.join(index_dir, name)
+            try:
+                if os.stat(stale_path).st_mtime < expired:
+                    os.unlink(stale_path)
+            except OSError:
+                # Removed by another invocation.
+                pass
+
+    def find_aggregator(self):
+        source_dir = self.get_source_directory()
+        state = self.__get_detection_state()
+        fingerprint = self.__get_source_fingerprint()
+
+        # Use the last result for the directory if nothing has changed.
+        now = int(time.time())
+        cached = state.get('dirs', {}).get(source_dir)
+        if fingerprint and cached and cached['fingerprint'] == fingerprint:
+            for aggregator in self.get_aggregators():
+                name = aggregator.get_info(self).get('name')
+                if name == cached['aggregator']:
+                    self.__touch_detection(source_dir, cached, now)
+                    return aggregator
+
+        aggregator = self.__detect_aggregator()
+        if aggregator and fingerprint:
+            name = aggregator.get_info(self).get('name')
+            def record(state):
+                dirs = state.setdefault('dirs', {})
+                dirs[source_dir] = {
+                    'fingerprint': fingerprint,
+                    'aggregator': name,
+                    'used': now
+                }
+                if len(dirs) > _MAX_DETECTION_DIRS:
+                    lru = sorted(dirs, key=lambda path: dirs[path].get('used'))
+                    for path in lru[:len(dirs) - _MAX_DETECTION_DIRS]:
+                        del dirs[path]
+                hits = state.setdefault('hits', {})
+                hits[name] = hits.get(name, 0) + 1
+            self.__detection_state = self.__detection_store.update(record)
+        return aggregator
+
+    def __touch_detection(self, source_dir, cached, now):
+        """Marks the cached detection result of a directory as used.
+
+        To save writes, this is only done every _DETECTION_TOUCH_INTERVAL.
+        """
+        if now - cached.get('used', 0) < _DETECTION_TOUCH_INTERVAL:
+            return
+        def touch(state):
+            cached = state.get('dirs', {}).get(source_dir)
+            if cached:
+                cached['used'] = now
+        self.__detection_state = self.__detection_store.update(touch)
+
+    def __detect_aggregator(self):
+        """Runs the matches() checks to find the aggregator.
+
+        Declarative match rules are evaluated in-process against a single
+        scan of the source directory, only the remaining aggregators run
+        their matches hooks.
+        """
+        ordered = self.get_ordered_aggregators()
+        rank = dict((aggregator, i) for i, aggregator in enumerate(ordered))
+        pending = self.__get_launch_order()
+        scan = match_rules.SourceScan(self.get_source_directory())
+
+        # The results of the completed checks, and (aggregator, match)
+        # pairs for the checks that are still running.
+        results = {}
+        running = []
+        try:
+            while True:
+                for aggregator, match in list(running):
+                    matched = match.poll()
+                    if matched is not None:
+                        results[aggregator] = matched
+                        running.remove((aggregator, match))
+
+                # The first aggregator in order that matches wins, once all
+                # of the aggregators before it are known not to match.
+                for aggregator in ordered:
+                    matched = results.get(aggregator)
+                    if matched is None:
+                        break
+                    elif matched:
+                        return aggregator
+                else:
+                    return None
+
+                # Start as many checks as our worker limit allows.
+                progressed = False
+                while pending and len(running) < self.__max_match_workers:
+                    aggregator = pending.pop(0)
+                    rules = aggregator.get_info(self).get('match')
+                    if rules is None:
+                        running.append((aggregator,
+                                        aggregator.start_matching(self)))
+                        continue
+                    results[aggregator] = matched = self.__check_match_rules(
+                        aggregator, rules, scan)
+                    progressed = True
+                    if matched:
+                        # Aggregators after this one can't win.
+                        pending = [other for other in pending
+                                   if rank[other] < rank[aggregator]]
+
+                if progressed or not running:
+                    continue
+                elif pending:
+                    # Poll so we can start new checks as workers free up.
+                    time.sleep(_MATCH_POLL_INTERVAL)
+                else:
+                    # Nothing left to start, wait for the check that comes
+                    # first in order.
+                    min(running, key=lambda item: rank[item[0]])[1].wait()
+        finally:
+            # Anything still running can't win anymore.
+            for aggregator, match in running:
+                match.cancel()
+
+    def __check_match_rules(self, aggregator, rules, scan):
+        try:
+            return match_rules.check_rules(rules, scan)
+        except ValueError as ex:
+            self.__output.warn('Ignoring aggregator {}: {}',
+                               aggregator.get_info(self).get('name'), ex)
+            return False
 
     def get_utils(self):
         return self.__utils
 
     def get_source_directory(self):
         return self.__source_dir
+
+    def set_source_directory(self, source_dir):
+        """Switches to another source directory.
+
+        This lets a single core, with its extensions loaded, work on many
+        projects (see sxc.batch).
+        """
+        self.__source_dir = source_dir
+        self.refresh()
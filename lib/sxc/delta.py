@@ -0,0 +1,476 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Delta transfer of images to remote hosts.
+
+This implements the rsync algorithm on top of a plain command transport
+(usually ssh): the remote host computes block checksums of the files that
+may have changed, and only the blocks that it doesn't already have are sent
+to it.  What was last deployed to every host is recorded in the sxc cache so
+that files that haven't changed since then aren't even checksummed.
+
+The remote end is a small python script passed on the command line, so the
+only requirement on the remote host is a python interpreter.
+"""
+
+import binascii
+import hashlib
+import json
+import mmap
+import os
+import pipes
+import stat
+import zlib
+
+from sxc import cache
+from sxc import extlib
+
+# Name of the file (relative to the transfer root) identifying the last
+# deployment to a host.  If it doesn't match our record of the host, the
+# record is ignored.
+DEPLOY_ID_NAME = '.sxc-deploy-id'
+
+# Name of the python interpreter on the remote host.
+REMOTE_PYTHON = 'python'
+
+_MIN_BLOCK_SIZE = 2048
+_MAX_BLOCK_SIZE = 131072
+
+# Maximum size of literal data in a single operation.
+_LITERAL_SIZE = 65536
+
+# Number of unmatched bytes we roll the checksum over before falling back to
+# checking block aligned positions only.  Rolling is done a byte at a time in
+# python, this bounds the cost of files that have changed completely.
+_ROLL_LIMIT = 1 << 18
+
+# The remote end of the protocol, compatible with python 2 and 3.
+#
+# 'sign' reads a JSON request {"id": <expected deployment id>,
+# "changed": {<path>: <block size>}, "others": {<path>: <block size>}} and
+# writes {"id": <deployment id>, "signatures": {<path>: <signature>}} where
+# the signature is null for missing files and otherwise
+# {"size": <size>, "mode": <permission bits>, "sha1": <hex digest>,
+#  "blocks": [[<adler32>, <md5>], ...]}.
+# The files in "others" are only signed if the deployment id doesn't match.
+#
+# 'apply' reads a stream of operations, one per line:
+#   F <octal mode> <JSON path>  - Start rebuilding a file, followed by:
+#     C <offset> <length>       - Copy a range of the current file.
+#     L <length>                - Copy the <length> bytes that follow.
+#     E                         - End of file.
+#   D <JSON path>               - Delete a file.
+#   I <deployment id>           - Record the deployment id.
+_REMOTE_SCRIPT = r'''
+import hashlib, json, os, sys, zlib
+mode, root = sys.argv[1:3]
+inp = getattr(sys.stdin, 'buffer', sys.stdin)
+out = getattr(sys.stdout, 'buffer', sys.stdout)
+id_path = os.path.join(root, '%(id_name)s')
+
+def sign(path, block_size):
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    whole = hashlib.sha1()
+    blocks = []
+    size = 0
+    with f:
+        file_mode = os.fstat(f.fileno()).st_mode & 0o7777
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            size += len(block)
+            whole.update(block)
+            blocks.append([zlib.adler32(block) & 0xffffffff,
+                           hashlib.md5(block).hexdigest()])
+    return {'size': size, 'mode': file_mode, 'sha1': whole.hexdigest(),
+            'blocks': blocks}
+
+def copy(src, dst, length):
+    while length:
+        data = src.read(min(length, 65536))
+        if not data:
+            raise IOError('unexpected end of data')
+        dst.write(data)
+        length -= len(data)
+
+try:
+    deploy_id = open(id_path).read().strip()
+except IOError:
+    deploy_id = None
+
+if mode == 'sign':
+    request = json.loads(inp.read().decode('utf-8'))
+    files = dict(request['changed'])
+    if deploy_id != request['id']:
+        files.update(request['others'])
+    signatures = {}
+    for name, block_size in files.items():
+        signatures[name] = sign(os.path.join(root, name), block_size)
+    out.write(json.dumps({'id': deploy_id,
+                          'signatures': signatures}).encode('utf-8'))
+else:
+    while True:
+        line = inp.readline().decode('utf-8')
+        if not line:
+            break
+        op, arg = line[0], line[2:-1]
+        if op == 'F':
+            file_mode, name = arg.split(' ', 1)
+            path = os.path.join(root, json.loads(name))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            old = open(path, 'rb') if os.path.isfile(path) else None
+            tmp_path = path + '.sxc-tmp'
+            with open(tmp_path, 'wb') as new:
+                while True:
+                    fields = inp.readline().decode('utf-8').split()
+                    if fields[0] == 'C':
+                        old.seek(int(fields[1]))
+                        copy(old, new, int(fields[2]))
+                    elif fields[0] == 'L':
+                        copy(inp, new, int(fields[1]))
+                    else:
+                        break
+            if old:
+                old.close()
+            os.chmod(tmp_path, int(file_mode, 8))
+            os.rename(tmp_path, path)
+        elif op == 'D':
+            try:
+                os.unlink(os.path.join(root, json.loads(arg)))
+            except OSError:
+                pass
+        elif op == 'I':
+            with open(id_path + '.sxc-tmp', 'w') as f:
+                f.write(arg + '\n')
+            os.rename(id_path + '.sxc-tmp', id_path)
+''' % {'id_name': DEPLOY_ID_NAME}
+
+
+def get_deploy_record(target, host):
+    """Returns the record of what was last deployed to a host.
+
+    Args:
+        target: (str) Name of the deployment target (usually the actuator).
+        host: (str) Host name or address.
+
+    Returns:
+        (cache.JSONStore) the record.  The document has the keys 'id' (the
+        deployment id) and 'files' (a manifest as returned by scan_files()).
+    """
+    return cache.JSONStore(os.path.join('deployed', target,
+                                        '{}.json'.format(host)))
+
+
+def new_deploy_id():
+    """Returns a new random deployment id."""
+    return binascii.hexlify(os.urandom(16))
+
+
+def scan_files(source_dir, image, previous=None):
+    """Builds a manifest of the regular files in an image.
+
+    Args:
+        source_dir: (str) Source directory.
+        image: (object) The intermediate representation object.
+        previous: (dict or None) A previous manifest.  Files whose size and
+            mtime match their entry in it (or in the image's IR) aren't read.
+
+    Returns:
+        (dict) a mapping from path to [size, mtime, mode, SHA-1 hex digest].
+    """
+    previous = previous or {}
+    file_source = extlib.get_file_source(source_dir)
+    ir_entries = (extlib.load_ir_entries(image)
+                  if file_source == source_dir else {})
+    index = extlib.get_tree_index(file_source)
+    manifest = {}
+    for file in image['files']:
+        try:
+            source_path, st = extlib.stat_source_file(file_source, file, index)
+        except OSError:
+            continue
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        mode = stat.S_IMODE(st.st_mode)
+        prev = previous.get(file)
+        ir_entry = ir_entries.get(file)
+        if prev and prev[0] == st.st_size and prev[1] == st.st_mtime:
+            digest = prev[3]
+        elif (ir_entry and ir_entry.size == st.st_size and
+              ir_entry.mtime == st.st_mtime):
+            digest = ir_entry.hash
+        else:
+            digest = extlib.hash_file(source_path)
+        manifest[file] = [st.st_size, st.st_mtime, mode, digest]
+    return manifest
+
+
+def _block_size(size):
+    block_size = _MIN_BLOCK_SIZE
+    while block_size * block_size < size and block_size < _MAX_BLOCK_SIZE:
+        block_size *= 2
+    return block_size
+
+
+def _remote_command(mode, root):
+    return '{} -c {} {} {}'.format(REMOTE_PYTHON, pipes.quote(_REMOTE_SCRIPT),
+                                   mode, pipes.quote(root))
+
+
+def _roll(weak, out_byte, in_byte, block_size):
+    """Rolls an adler32 checksum forward by one byte."""
+    a = weak & 0xffff
+    b = weak >> 16
+    a = (a - out_byte + in_byte) % 65521
+    b = (b - block_size * out_byte + a - 1) % 65521
+    return (b << 16) | a
+
+
+class _FileDelta(object):
+    """Computes the difference between a local file and a remote one.
+
+    Iterating over the object generates the 'C' and 'L' operations to rebuild
+    the local file from the remote file.  Afterwards, 'matched' is the number
+    of bytes that didn't have to be sent.
+    """
+
+    def __init__(self, path, signature, block_size):
+        """Constructor.
+
+        Args:
+            path: (str) The local file.
+            signature: (dict or None) The signature of the remote file as
+                produced by the remote 'sign' command, None if it doesn't
+                exist.
+            block_size: (int) The block size of the signature.
+        """
+        self.path = path
+        self.block_size = block_size
+        self.matched = 0
+
+        # Only full blocks can be matched.
+        self.__blocks = {}
+        if signature:
+            full_blocks = signature['size'] // block_size
+            for index, (weak, strong) in enumerate(
+                    signature['blocks'][:full_blocks]):
+                self.__blocks.setdefault(weak, {}).setdefault(strong, index)
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return
+            data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                for op in self.__diff(data, size):
+                    yield op
+            finally:
+                data.close()
+
+    def __literal(self, data, start, end):
+        while start < end:
+            length = min(end - start, _LITERAL_SIZE)
+            yield 'L {}\n'.format(length) + data[start:start + length]
+            start += length
+
+    def __diff(self, data, size):
+        block_size = self.block_size
+        blocks = self.__blocks
+        pos = 0
+        literal_start = 0
+        copy = None
+        weak = None
+        rolled = 0
+        while pos + block_size <= size:
+            if weak is None:
+                weak = zlib.adler32(data[pos:pos + block_size]) & 0xffffffff
+            index = None
+            candidates = blocks.get(weak)
+            if candidates:
+                index = candidates.get(
+                    hashlib.md5(data[pos:pos + block_size]).hexdigest())
+
+            if index is not None:
+                if literal_start < pos:
+                    if copy:
+                        yield 'C {} {}\n'.format(*copy)
+                        copy = None
+                    for op in self.__literal(data, literal_start, pos):
+                        yield op
+                offset = index * block_size
+                if copy and copy[0] + copy[1] == offset:
+                    copy[1] += block_size
+                else:
+                    if copy:
+                        yield 'C {} {}\n'.format(*copy)
+                    copy = [offset, block_size]
+                self.matched += block_size
+                pos += block_size
+                literal_start = pos
+                weak = None
+                rolled = 0
+            elif rolled < _ROLL_LIMIT and pos + block_size < size:
+                weak = _roll(weak, ord(data[pos]), ord(data[pos + block_size]),
+                             block_size)
+                pos += 1
+                rolled += 1
+            else:
+                pos += block_size
+                weak = None
+
+            # Don't let unmatched data pile up.
+            if pos - literal_start >= _LITERAL_SIZE:
+                if copy:
+                    yield 'C {} {}\n'.format(*copy)
+                    copy = None
+                for op in self.__literal(data, literal_start, pos):
+                    yield op
+                literal_start = pos
+
+        if copy:
+            yield 'C {} {}\n'.format(*copy)
+        for op in self.__literal(data, literal_start, size):
+            yield op
+
+
+def _operations(source_dir, manifest, signatures, deleted, extra_files,
+                prefix, deploy_id, stats):
+    file_source = extlib.get_file_source(source_dir)
+    index = extlib.get_tree_index(file_source)
+    for file, signature in sorted(signatures.items()):
+        size, mtime, mode, digest = manifest[file]
+        name = '/'.join((prefix, file)) if prefix else file
+        yield 'F {:o} {}\n'.format(mode, json.dumps(name))
+        source_path = extlib.stat_source_file(file_source, file, index)[0]
+        delta = _FileDelta(source_path, signature, _block_size(size))
+        for op in delta:
+            yield op
+        yield 'E\n'
+        stats['matched_bytes'] += delta.matched
+        stats['literal_bytes'] += size - delta.matched
+
+    for name, mode, contents in extra_files or []:
+        yield 'F {:o} {}\n'.format(mode, json.dumps(name))
+        yield 'L {}\n'.format(len(contents)) + contents
+        yield 'E\n'
+
+    for file in deleted:
+        name = '/'.join((prefix, file)) if prefix else file
+        yield 'D {}\n'.format(json.dumps(name))
+
+    yield 'I {}\n'.format(deploy_id)
+
+
+def push(transport, source_dir, image, record, root='/', prefix='app',
+         extra_files=None, threads=None, relay=None):
+    """Transfers the files of an image to a remote host.
+
+    Only the parts of the image that have changed since the deployment
+    described by 'record' are sent.  If the host doesn't have that deployment
+    (e.g. because the record is missing or out of date) the remote host
+    checksums all of the files instead, so existing files are still reused.
+    Nothing is ever deleted that isn't in the record.  The record is updated
+    if the transfer succeeds.
+
+    Args:
+        transport: (extlib.Transport or [str, ...]) Runs shell commands on
+            the remote host, usually an extlib.SSHTransport.  A list is a
+            command prefix for an extlib.CommandTransport, for example
+            ['sh', '-c'] transfers to the local host.
+        source_dir: (str) Source directory.
+        image: (object) The intermediate representation object.
+        record: (cache.JSONStore) The deployment record for the host, from
+            get_deploy_record().
+        root: (str) Directory on the remote host that files are stored
+            relative to.
+        prefix: (str) Directory relative to 'root' for the image files.
+        extra_files: ([(str, int, str), ...] or None) Additional files to
+            send in full as (name relative to 'root', mode, contents) tuples.
+        threads: (int or None) Number of compression threads.
+        relay: (extlib.OutputRelay or None) If provided, the error output of
+            the remote commands is relayed through it.
+
+    Returns:
+        (dict) A summary of the transfer with the keys 'returncode' (non-zero
+        on failure), 'changed' and 'deleted' (lists of paths that were sent
+        or deleted), 'unchanged' (the number of files that weren't sent) and
+        'matched_bytes' and 'literal_bytes' (the amount of data reused on
+        the remote host and sent over the transport respectively).
+    """
+    if isinstance(transport, list):
+        transport = extlib.CommandTransport(transport)
+    previous = record.load()
+    previous_files = previous.get('files', {})
+    manifest = scan_files(source_dir, image, previous_files)
+
+    def remote_name(file):
+        return '/'.join((prefix, file)) if prefix else file
+
+    # Ask the remote host for the signatures of everything that has changed
+    # since the last deployment (or everything, if that's not what's there).
+    changed = {}
+    others = {}
+    for file, entry in manifest.items():
+        prev = previous_files.get(file)
+        target = others if prev and prev[2:] == entry[2:] else changed
+        target[remote_name(file)] = _block_size(entry[0])
+    output = []
+    error_output = {}
+    if relay:
+        error_output = {'stderr_callback': relay.stderr_callback}
+    returncode = transport.run(
+        _remote_command('sign', root),
+        stdin=json.dumps({'id': previous.get('id'), 'changed': changed,
+                          'others': others}),
+        stdout_batch_callback=output.extend, **error_output)
+    if returncode:
+        return {'returncode': returncode, 'changed': [], 'deleted': [],
+                'unchanged': 0, 'matched_bytes': 0, 'literal_bytes': 0}
+    response = json.loads(''.join(output))
+    if response['id'] != previous.get('id'):
+        previous_files = {}
+
+    # Skip the files that the remote host already has, with the same mode.
+    signatures = {}
+    for file, entry in manifest.items():
+        name = remote_name(file)
+        if name not in response['signatures']:
+            continue
+        signature = response['signatures'][name]
+        if (signature and signature['sha1'] == entry[3] and
+            signature['mode'] == entry[2]):
+            continue
+        signatures[file] = signature
+    deleted = sorted(set(previous_files) - set(manifest))
+
+    stats = {'matched_bytes': 0, 'literal_bytes': 0}
+    deploy_id = new_deploy_id()
+    returncode = extlib.send_archive(
+        _operations(source_dir, manifest, signatures, deleted, extra_files,
+                    prefix, deploy_id, stats),
+        transport.argv('gzip -dc | ' + _remote_command('apply', root)),
+        codec='gzip', threads=threads, relay=relay)
+    if not returncode:
+        record.save({'id': deploy_id, 'files': manifest})
+
+    stats.update(returncode=returncode, changed=sorted(signatures),
+                 deleted=deleted, unchanged=len(manifest) - len(signatures))
+    return stats
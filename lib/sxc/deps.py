@@ -0,0 +1,358 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Dependency resolution.
+
+Aggregators use resolve() to turn the dependency manifests and lockfiles of a
+project into a versioned dependency graph, which goes into the 'packages'
+entry of the image:
+
+    ecosystem: 'npm' or 'pypi'.
+    manifests: maps the manifests and lockfiles that the graph was resolved
+        from (paths relative to the source directory) to their SHA-1.
+    locked: true if the versions come from a lockfile (or, for pypi, every
+        requirement is pinned), so the graph is complete.
+    direct: maps the names of the declared dependencies to their version
+        specifications.
+    roots: the ids of the packages that are declared dependencies.
+    packages: maps package ids to dictionaries with the 'name' and
+        'version' (None if unknown) of the package and the ids of its
+        'dependencies'.  For npm, ids are the install paths from the
+        lockfile ('node_modules/a/node_modules/b'), since several versions
+        of a package may be installed.  For pypi, they're the normalized
+        package names.
+
+Resolving is cached in the sxc cache, so it's skipped entirely for projects
+whose manifests haven't changed.  There is one cache entry per project and
+ecosystem, replaced whenever the manifests change.
+"""
+
+import hashlib
+import json
+import os
+import re
+
+from sxc import cache
+
+# Version of the resolved graph format, part of the cache key.
+_FORMAT_VERSION = 1
+
+# The top level manifests and lockfiles of each ecosystem.
+MANIFESTS = {
+    'npm': ['package.json', 'npm-shrinkwrap.json', 'package-lock.json'],
+    'pypi': ['requirements.txt', 'Pipfile.lock'],
+}
+
+# The system packages (for apt-get) that provide the runtime dependencies
+# named in the 'deps' entry of images.
+SYSTEM_PACKAGES = {
+    'node.js': ['nodejs'],
+    'npm': ['npm'],
+    'django': ['python-django'],
+}
+
+# The commands that install the packages of each ecosystem in /app from its
+# manifests, without and with a lockfile.
+INSTALL_COMMANDS = {
+    'npm': ('cd /app && npm install --production',
+            'cd /app && npm ci --production'),
+    'pypi': ('pip install -r /app/requirements.txt',
+             'pip install -r /app/requirements.txt'),
+}
+
+# Splits a requirement into the project name, extras and the rest.
+_REQUIREMENT_RE = re.compile(
+    r'^([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?\s*(.*)$')
+
+
+def _hash_file(path):
+    """Returns the hex SHA-1 of a file, None if it doesn't exist."""
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except IOError:
+        return None
+
+
+def normalize_name(name):
+    """Returns the normalized form of a python package name (PEP 503)."""
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+class _ManifestReader(object):
+    """Reads the files of a project, recording their hashes."""
+
+    def __init__(self, source_dir):
+        self.source_dir = source_dir
+        self.hashes = {}
+
+    def read(self, name):
+        """Returns the contents of a file, None if it doesn't exist."""
+        try:
+            with open(os.path.join(self.source_dir, name), 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        self.hashes[name] = hashlib.sha1(data).hexdigest()
+        return data
+
+    def read_json(self, name):
+        data = self.read(name)
+        return json.loads(data) if data is not None else None
+
+
+def _find_npm_package(packages, path, name):
+    """Finds the package that 'name' resolves to from the package at 'path'.
+
+    This follows node's module lookup: the node_modules directory of the
+    package, then those of the packages that it's nested in.
+    """
+    while True:
+        candidate = (path + '/' if path else '') + 'node_modules/' + name
+        if candidate in packages:
+            return candidate
+        if not path:
+            return None
+        index = path.rfind('/node_modules/')
+        path = path[:index] if index >= 0 else ''
+
+
+def _add_npm_v1_packages(packages, dependencies, prefix):
+    """Adds the packages of a version 1 lockfile, which are nested."""
+    for name, entry in dependencies.iteritems():
+        if entry.get('dev'):
+            continue
+        path = prefix + 'node_modules/' + name
+        packages[path] = {'name': name, 'version': entry.get('version'),
+                          'requires': entry.get('requires', {})}
+        _add_npm_v1_packages(packages, entry.get('dependencies', {}),
+                             path + '/')
+
+
+def _resolve_npm(reader):
+    package_json = reader.read_json('package.json') or {}
+    direct = dict(package_json.get('dependencies', {}))
+    direct.update(package_json.get('optionalDependencies', {}))
+
+    lock = None
+    for name in ('npm-shrinkwrap.json', 'package-lock.json'):
+        lock = reader.read_json(name)
+        if lock is not None:
+            break
+
+    packages = {}
+    if lock is None:
+        # Without a lockfile, only the declared ranges are known.
+        for name, spec in direct.iteritems():
+            packages['node_modules/' + name] = {
+                'name': name, 'version': None, 'requires': {}}
+    elif 'packages' in lock:
+        # Lockfile versions 2 and 3 list every installed package by path.
+        for path, entry in lock['packages'].iteritems():
+            if not path or entry.get('dev') or entry.get('link'):
+                continue
+            requires = dict(entry.get('dependencies', {}))
+            requires.update(entry.get('optionalDependencies', {}))
+            packages[path] = {
+                'name': entry.get('name') or
+                        path.rsplit('node_modules/', 1)[-1],
+                'version': entry.get('version'), 'requires': requires}
+    else:
+        _add_npm_v1_packages(packages, lock.get('dependencies', {}), '')
+
+    for path, package in packages.iteritems():
+        package['dependencies'] = sorted(
+            filter(None, (_find_npm_package(packages, path, name)
+                          for name in package.pop('requires'))))
+    return {'locked': lock is not None, 'direct': direct,
+            'roots': sorted(filter(None, (_find_npm_package(packages, '', name)
+                                          for name in direct))),
+            'packages': packages}
+
+
+def _requirement_lines(reader, name, seen):
+    """Yields the logical lines of a requirements file and its includes."""
+    if name in seen:
+        return
+    seen.add(name)
+    data = reader.read(name)
+    if data is None:
+        return
+    for line in data.replace('\\\n', '').splitlines():
+        line = re.sub(r'(^|\s)#.*', '', line).strip()
+        if not line:
+            continue
+        option = re.match(r'^(-r|--requirement|-c|--constraint)[\s=]+(\S+)',
+                          line)
+        if option:
+            include = os.path.normpath(os.path.join(os.path.dirname(name),
+                                                    option.group(2)))
+            if option.group(1) in ('-r', '--requirement'):
+                for line in _requirement_lines(reader, include, seen):
+                    yield line
+            else:
+                # Constraints aren't requirements, but installing them needs
+                # the file, so record it with the manifests.
+                reader.read(include)
+        else:
+            yield line
+
+
+def _parse_requirement(line):
+    """Returns (name, spec, pinned version) for a requirement line.
+
+    Returns None for lines that aren't requirements (options, editable
+    installs and URLs, which can't be resolved without fetching them).
+    """
+    if line.startswith('-'):
+        return None
+    line = line.split(';', 1)[0]
+    line = re.sub(r'\s--\S+', '', line).strip()
+    match = _REQUIREMENT_RE.match(line)
+    if not match or '://' in match.group(1):
+        return None
+    name, extras, spec = match.groups()
+    spec = spec.replace(' ', '')
+    version = None
+    if (spec.startswith('==') and ',' not in spec and '*' not in spec and
+        not spec.startswith('===')):
+        version = spec[2:]
+    return name, spec, version
+
+
+def _resolve_pypi(reader):
+    packages = {}
+    lock = reader.read_json('Pipfile.lock')
+    if lock is not None:
+        for name, entry in lock.get('default', {}).iteritems():
+            version = entry.get('version', '')
+            packages[normalize_name(name)] = {
+                'name': name,
+                'version': version[2:] if version.startswith('==') else None,
+                'dependencies': []}
+
+    direct = {}
+    pinned = True
+    for line in _requirement_lines(reader, 'requirements.txt', set()):
+        requirement = _parse_requirement(line)
+        if requirement is None:
+            continue
+        name, spec, version = requirement
+        direct[name] = spec
+        pinned = pinned and version is not None
+        packages.setdefault(normalize_name(name), {
+            'name': name, 'version': version, 'dependencies': []})
+    if lock is not None:
+        direct.update((name, entry.get('version', ''))
+                      for name, entry in lock.get('default', {}).iteritems()
+                      if name not in direct)
+    return {'locked': lock is not None or bool(direct) and pinned,
+            'direct': direct,
+            'roots': sorted(normalize_name(name) for name in direct),
+            'packages': packages}
+
+
+_RESOLVERS = {
+    'npm': _resolve_npm,
+    'pypi': _resolve_pypi,
+}
+
+
+def resolve(source_dir, ecosystem):
+    """Returns the dependency graph of a project.
+
+    Args:
+        source_dir: (str) The source directory.
+        ecosystem: (str) 'npm' or 'pypi'.
+
+    Returns:
+        (dict or None) The graph (see the module docstring), None if the
+        project has none of the MANIFESTS of the ecosystem.
+    """
+    hashes = {}
+    for name in MANIFESTS[ecosystem]:
+        digest = _hash_file(os.path.join(source_dir, name))
+        if digest:
+            hashes[name] = digest
+    if not hashes:
+        return None
+
+    key = hashlib.sha1(json.dumps([_FORMAT_VERSION,
+                                   sorted(hashes.items())])).hexdigest()
+    store = cache.JSONStore(os.path.join('deps', '{}-{}.json'.format(
+        ecosystem, hashlib.sha1(os.path.abspath(source_dir)).hexdigest())))
+    entry = store.load()
+
+    # The graph may also depend on included files, check those too.
+    if entry and entry['key'] == key and all(
+            (hashes.get(name) or
+             _hash_file(os.path.join(source_dir, name))) == digest
+            for name, digest in entry['graph']['manifests'].iteritems()):
+        return entry['graph']
+
+    reader = _ManifestReader(source_dir)
+    graph = _RESOLVERS[ecosystem](reader)
+    graph['ecosystem'] = ecosystem
+    graph['manifests'] = reader.hashes
+    store.save({'key': key, 'graph': graph})
+    return graph
+
+
+def get_version(graph, name):
+    """Returns the resolved version of a direct dependency, None if unknown.
+    """
+    if not graph:
+        return None
+    for root in graph['roots']:
+        package = graph['packages'].get(root)
+        if package and normalize_name(package['name']) == normalize_name(name):
+            return package['version']
+    return None
+
+
+def install_command(ecosystem, graph=None):
+    """Returns the command that installs the packages of an application.
+
+    With a lockfile, npm packages are installed with "npm ci", which
+    installs exactly the locked versions without resolving the tree again.
+
+    Args:
+        ecosystem: (str) 'npm' or 'pypi'.
+        graph: (dict or None) The 'packages' entry of the image.
+    """
+    locked = bool(graph and graph['ecosystem'] == ecosystem and
+                  graph['locked'])
+    return INSTALL_COMMANDS[ecosystem][locked]
+
+
+def system_packages(deps):
+    """Returns the system packages that provide runtime dependencies.
+
+    Args:
+        deps: ([dict, ...]) The 'deps' entry of an image.
+
+    Returns:
+        (packages, unknown) where 'packages' is the sorted list of system
+        package names and 'unknown' lists the names of the dependencies that
+        there are no system packages for.
+    """
+    packages = set()
+    unknown = []
+    for dep in deps:
+        if dep['name'] in SYSTEM_PACKAGES:
+            packages.update(SYSTEM_PACKAGES[dep['name']])
+        else:
+            unknown.append(dep['name'])
+    return sorted(packages), unknown
@@ -14,11 +14,68 @@
 
 """Utilities useful for people writing extensions."""
 
+import collections
+import contextlib
+import errno
+import hashlib
 import json
+import mmap
 import os
+import posixpath
+import re
 import shutil
+import stat
+import struct
 import sys
 import tempfile
+import time
+import zlib
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+from sxc import cache
+from sxc import proclib
+from sxc import trace
+
+# Name of the manifest file that sync_files() keeps in the staging directory.
+MANIFEST_NAME = '.sxc-manifest'
+
+# Environment variable pointing to a staging directory shared by all targets
+# of a push.
+SHARED_STAGING_ENV = 'SXC_SHARED_STAGING'
+
+# Environment variable naming the target of a push to several targets, see
+# get_target_label().
+TARGET_LABEL_ENV = 'SXC_TARGET_LABEL'
+
+# Environment variable naming the source tree index of the current
+# invocation, see get_tree_index().
+TREE_INDEX_ENV = 'SXC_TREE_INDEX'
+
+# Ignore patterns that apply to every source tree.  Installed dependencies
+# are never part of an image, the actuators install them from the manifests.
+DEFAULT_IGNORE_PATTERNS = ['.git/', '.hg/', '.svn/', '/.sxc', 'node_modules/',
+                           'venv/', '.venv/']
+
+# Files that mark the directory containing them as ignored, whatever its name
+# (pyvenv.cfg is in the root of every virtualenv).
+DEFAULT_IGNORE_MARKERS = ['pyvenv.cfg']
+
+# Files that contain ignore patterns.  Those in subdirectories of the source
+# tree apply to the contents of their directory, as with git.
+IGNORE_FILES = ['.gitignore', '.sxcignore']
+
+
+# In a worker (see serve_worker()), the id of the call being handled and the
+# stream that replies are written to.
+_worker_call_id = None
+_worker_out = None
 
 
 def send_object(obj):
@@ -28,9 +85,13 @@ def send_object(obj):
         obj: An object that can be dumped using the json module.
             TODO: link to docs on valid message contents.
     """
-    json.dump(obj, sys.stdout)
-    sys.stdout.write('\n')
-    sys.stdout.flush()
+    out = sys.stdout
+    if _worker_call_id is not None:
+        obj = dict(obj, id=_worker_call_id)
+        out = _worker_out
+    json.dump(obj, out)
+    out.write('\n')
+    out.flush()
 
 
 def error(message):
@@ -60,6 +121,31 @@ def warn(message):
     send_object({'type': 'warn', 'message': message})
 
 
+@contextlib.contextmanager
+def span(name, **args):
+    """Reports a timed span covering the body of a 'with' statement.
+
+    Spans are only sent when the framework is tracing.  They can be nested,
+    and appear in the trace nested within the span of the hook itself.
+
+    Usage:
+
+        with extlib.span('upload', host=host):
+            upload(host)
+
+    Args:
+        name: (str) Name of the span.
+        **args: Additional information to attach to the span.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        if os.environ.get(trace.TRACE_ENV):
+            send_object({'type': 'span', 'name': name, 'start': start,
+                         'end': time.time(), 'args': args})
+
+
 class OutputRelay(object):
     """Tool to send the output of a child process to the framework.
 
@@ -94,7 +180,919 @@ class OutputRelay(object):
         error(line)
 
 
-def stage_files(source_dir, image, staging_dir=None):
+def utf8_strings(obj):
+    """Returns a copy of 'obj' with unicode strings encoded as UTF-8.
+
+    json produces unicode strings, which don't mix well with the byte
+    strings used for paths, arguments and environment variables.
+
+    Args:
+        obj: An object as returned by json.load().
+    """
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    elif isinstance(obj, list):
+        return [utf8_strings(item) for item in obj]
+    elif isinstance(obj, dict):
+        return dict((utf8_strings(key), utf8_strings(val))
+                    for key, val in obj.iteritems())
+    return obj
+
+
+def _read_worker_requests(fd, buffer, block):
+    """Reads the complete request lines available on 'fd'.
+
+    Args:
+        fd: (int) The worker's standard input.
+        buffer: (bytearray) Incomplete data from previous reads.
+        block: (bool) Whether to wait for input if there is none.
+
+    Returns:
+        ([dict, ...] or None) The requests, None at the end of the input.
+    """
+    import select
+    requests = []
+    while block or select.select([fd], [], [], 0)[0]:
+        data = os.read(fd, 65536)
+        if not data:
+            return requests or None
+        buffer.extend(data)
+        end = buffer.rfind('\n') + 1
+        if end:
+            lines = str(buffer[:end]).splitlines()
+            del buffer[:end]
+            requests.extend(utf8_strings(json.loads(line))
+                            for line in lines if line)
+            block = False
+    return requests
+
+
+def serve_worker(hooks):
+    """Serves hook calls from the framework until it closes our input.
+
+    This implements a worker program, see sxc.worker for the protocol.  The
+    hook functions are called with the arguments of the hook and its input
+    (None if there is none), with the environment of the call in os.environ,
+    and return the exit status of the hook (None meaning 0).  They can use
+    send_object() and friends and write to sys.stdout just like a hook
+    program would.  Anything written directly to the standard output file
+    descriptor (by child processes, for instance) ends up on standard error
+    so that it can't corrupt the replies.
+
+    Usage:
+
+        def genimage(args, input):
+            source_dir, = args
+            dump_image(make_image(source_dir))
+
+        serve_worker({'genimage': genimage, 'dump': genimage})
+
+    Args:
+        hooks: ({str: callable([str, ...], str or None)}) The hook functions
+            by hook name.
+    """
+    import base64
+    import cStringIO
+    import traceback
+    from sxc import worker
+    global _worker_call_id, _worker_out
+
+    # Keep the original standard output for replies.
+    _worker_out = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    real_stdout = sys.stdout
+    stdin_fd = sys.stdin.fileno()
+
+    buffer = bytearray()
+    pending = collections.deque()
+    cancelled = set()
+    eof = False
+    while True:
+        # Pick up any cancellations before starting the next call.
+        if not eof:
+            requests = _read_worker_requests(stdin_fd, buffer, not pending)
+            if requests is None:
+                eof = True
+            else:
+                for request in requests:
+                    if request.get('type') == 'cancel':
+                        cancelled.add(request['id'])
+                    else:
+                        pending.append(request)
+        if not pending:
+            if eof:
+                break
+            continue
+
+        request = pending.popleft()
+        _worker_call_id = request['id']
+        if _worker_call_id in cancelled:
+            cancelled.discard(_worker_call_id)
+            send_object({'type': 'done', 'status': worker.CANCELLED_STATUS})
+            _worker_call_id = None
+            continue
+
+        saved_environ = None
+        if 'env' in request:
+            saved_environ = dict(os.environ)
+            os.environ.clear()
+            os.environ.update(request['env'])
+        sys.stdout = output = cStringIO.StringIO()
+        try:
+            hook = hooks.get(request.get('hook'))
+            if hook is None:
+                error('Unknown hook {}'.format(request.get('hook')))
+                status = 1
+            else:
+                status = hook(request.get('args', []), request.get('input'))
+        except SystemExit as ex:
+            status = ex.code
+            if status is not None and not isinstance(status, int):
+                sys.stderr.write('{}\n'.format(status))
+                status = 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout = real_stdout
+            if saved_environ is not None:
+                os.environ.clear()
+                os.environ.update(saved_environ)
+        sys.stderr.flush()
+
+        # The output can be any bytes, which JSON strings can't hold.
+        data = output.getvalue()
+        if data:
+            send_object({'type': 'output', 'data': base64.b64encode(data)})
+        send_object({'type': 'done', 'status': status or 0})
+        _worker_call_id = None
+
+
+def dump_image(image, out=None):
+    """Writes an image to 'out' as JSON.
+
+    Unlike json.dump(), the 'files' entry may be an iterator (such as the one
+    returned by walk_source_tree()), in which case the files are written out
+    as they are produced instead of being collected into a list first.
+
+    Args:
+        image: (dict) The intermediate representation object.
+        out: (file) Output stream, defaults to standard output.
+    """
+    out = out or sys.stdout
+    rest = dict((key, val) for key, val in image.iteritems() if key != 'files')
+    out.write(json.dumps(rest)[:-1])
+    out.write(', "files": [' if rest else '"files": [')
+    first = True
+    for file in image.get('files', []):
+        if not first:
+            out.write(', ')
+        out.write(json.dumps(file))
+        first = False
+    out.write(']}')
+
+
+def _translate_pattern(pattern):
+    """Translates a gitignore-style glob into a regular expression."""
+    i = 0
+    result = []
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            result.append('(?:.*/)?')
+            i += 2
+        elif pattern.startswith('**', i):
+            result.append('.*')
+            i += 1
+        elif c == '*':
+            result.append('[^/]*')
+        elif c == '?':
+            result.append('[^/]')
+        elif c == '[' and pattern.find(']', i + 1) != -1:
+            end = pattern.find(']', i + 1)
+            body = pattern[i + 1:end].replace('\\', '\\\\')
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            result.append('[{}]'.format(body))
+            i = end
+        else:
+            result.append(re.escape(c))
+        i += 1
+    return ''.join(result)
+
+
+class IgnoreRules(object):
+    """A list of .gitignore-style patterns.
+
+    Supports the commonly used subset of the gitignore syntax: comments,
+    negation with '!', directory-only patterns with a trailing '/', patterns
+    anchored to the root by a '/' and the '*', '?', '[...]' and '**'
+    wildcards.  As with git, the last matching pattern wins.
+
+    Directories can also be ignored because they contain a marker file,
+    which no pattern can override.
+
+    Attributes:
+        markers: ([str, ...]) Names of the marker files.
+    """
+
+    def __init__(self, patterns=(), markers=()):
+        """Constructor.
+
+        Args:
+            patterns: ([str, ...]) Initial list of patterns.
+            markers: ([str, ...]) Names of marker files.
+        """
+        self.__rules = []
+        self.markers = list(markers)
+        for pattern in patterns:
+            self.add(pattern)
+
+    @classmethod
+    def for_source_dir(cls, source_dir):
+        """Returns the rules for a source tree.
+
+        These are the DEFAULT_IGNORE_PATTERNS and DEFAULT_IGNORE_MARKERS
+        followed by the contents of the IGNORE_FILES in the root of the tree.
+
+        Args:
+            source_dir: (str) Root of the source tree.
+        """
+        rules = cls(DEFAULT_IGNORE_PATTERNS, DEFAULT_IGNORE_MARKERS)
+        for name in IGNORE_FILES:
+            rules.add_file(os.path.join(source_dir, name))
+        return rules
+
+    def copy(self):
+        """Returns a copy of the rules that can be added to separately."""
+        rules = IgnoreRules(markers=self.markers)
+        rules.__rules = list(self.__rules)
+        return rules
+
+    def add_file(self, path, base=''):
+        """Adds the patterns in an ignore file, if it exists.
+
+        Args:
+            path: (str) Path of the file.
+            base: (str) Path of its directory relative to the root of the
+                tree, with a trailing '/' (empty for the root).
+        """
+        try:
+            with open(path) as f:
+                for line in f:
+                    self.add(line, base)
+        except IOError:
+            pass
+
+    def add(self, pattern, base=''):
+        """Adds a pattern.  Blank lines and comments are ignored.
+
+        Args:
+            pattern: (str) The pattern.
+            base: (str) The directory that the pattern applies to, as for
+                add_file().
+        """
+        pattern = pattern.rstrip('\r\n')
+        if not pattern.strip() or pattern.startswith('#'):
+            return
+        negate = pattern.startswith('!')
+        if negate:
+            pattern = pattern[1:]
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+
+        # Patterns containing a slash are relative to the base, the rest can
+        # match at any level below it.
+        if '/' in pattern:
+            regex = _translate_pattern(pattern.lstrip('/'))
+        else:
+            regex = '(?:.*/)?' + _translate_pattern(pattern)
+        regex = '^' + re.escape(base) + regex + '$'
+        self.__rules.append((re.compile(regex), negate, dir_only))
+
+    def is_ignored(self, rel_path, is_dir):
+        """Returns true if the path is ignored.
+
+        Args:
+            rel_path: (str) Path relative to the root of the tree, using '/'
+                as the separator.
+            is_dir: (bool) True if the path is a directory.
+        """
+        ignored = False
+        for regex, negate, dir_only in self.__rules:
+            if (is_dir or not dir_only) and regex.search(rel_path):
+                ignored = not negate
+        return ignored
+
+    def has_marker(self, dir_path):
+        """Returns true if a directory contains any of the marker files.
+
+        Args:
+            dir_path: (str) Path of the directory.
+        """
+        return any(os.path.exists(os.path.join(dir_path, name))
+                   for name in self.markers)
+
+
+class _DirEntry(object):
+    """Stand-in for os.DirEntry when scandir() is not available."""
+
+    def __init__(self, dir_path, name):
+        self.name = name
+        self.path = os.path.join(dir_path, name)
+        self.__lstat = None
+        self.__stat = None
+
+    def stat(self, follow_symlinks=True):
+        if not follow_symlinks:
+            if self.__lstat is None:
+                self.__lstat = os.lstat(self.path)
+            return self.__lstat
+        if self.__stat is None:
+            st = self.stat(follow_symlinks=False)
+            self.__stat = (os.stat(self.path) if stat.S_ISLNK(st.st_mode)
+                           else st)
+        return self.__stat
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+
+
+def _list_dir(dir_path):
+    if _scandir:
+        return list(_scandir(dir_path))
+    return [_DirEntry(dir_path, name) for name in os.listdir(dir_path)]
+
+
+class _IndexedDirEntry(object):
+    """os.DirEntry-like view of a TreeEntry."""
+
+    def __init__(self, source_dir, entry):
+        self.name = entry.path.rpartition('/')[2]
+        self.path = os.path.join(source_dir, entry.path)
+        self.__entry = entry
+
+    def stat(self, follow_symlinks=True):
+        if not follow_symlinks and self.is_symlink():
+            return os.lstat(self.path)
+        if not self.__entry.st_mode:
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), self.path)
+        return self.__entry
+
+    def is_dir(self, follow_symlinks=True):
+        if not follow_symlinks and self.is_symlink():
+            return False
+        return stat.S_ISDIR(self.__entry.st_mode)
+
+    def is_file(self, follow_symlinks=True):
+        if not follow_symlinks and self.is_symlink():
+            return False
+        return stat.S_ISREG(self.__entry.st_mode)
+
+    def is_symlink(self):
+        return bool(self.__entry.flags & TREE_SYMLINK)
+
+
+def walk_source_tree(source_dir, ignore=None):
+    """Walks a source tree, skipping ignored files.
+
+    Ignored directories are pruned: nothing underneath them is ever listed.
+    The ignore files found in subdirectories add to the rules for the rest
+    of the walk.  Entries are produced lazily, the entries in a directory
+    are produced (sorted by name) before the contents of its subdirectories.
+    Symlinks to directories are followed, unless they lead back to a
+    directory above them.
+
+    With the default ignore rules, the entries come from the tree index of
+    the invocation if there is one for 'source_dir' (see get_tree_index()),
+    without touching the file system at all.
+
+    Args:
+        source_dir: (str) Root of the source tree.
+        ignore: (IgnoreRules or None) Rules for the files to skip, defaults
+            to IgnoreRules.for_source_dir(source_dir).
+
+    Yields:
+        (rel_path, entry) for every file and directory in the tree, where
+        'rel_path' is the path relative to 'source_dir' and 'entry' is an
+        os.DirEntry-like object providing name, path, is_dir(), is_file(),
+        is_symlink() and stat().
+    """
+    if ignore is None:
+        index = get_tree_index(source_dir)
+        if index is not None:
+            return ((entry.path, _IndexedDirEntry(source_dir, entry))
+                    for entry in index)
+        ignore = IgnoreRules.for_source_dir(source_dir)
+    return _scan_source_tree(source_dir, ignore)
+
+
+def _scan_source_tree(source_dir, ignore):
+    # Nested ignore files only apply to this walk.
+    ignore = ignore.copy()
+
+    # Symlinked directories are followed, except into the directories above
+    # them: every directory comes with the (st_dev, st_ino) of its ancestors.
+    try:
+        st = os.stat(source_dir)
+        ancestors = frozenset([(st.st_dev, st.st_ino)])
+    except OSError:
+        ancestors = frozenset()
+    stack = [('', source_dir, ancestors)]
+    while stack:
+        prefix, dir_path, ancestors = stack.pop()
+        try:
+            entries = _list_dir(dir_path)
+        except OSError:
+            continue
+        entries.sort(key=lambda entry: entry.name)
+        if prefix:
+            names = set(entry.name for entry in entries)
+            for name in IGNORE_FILES:
+                if name in names:
+                    ignore.add_file(os.path.join(dir_path, name), prefix)
+        subdirs = []
+        for entry in entries:
+            rel_path = prefix + entry.name
+            is_dir = entry.is_dir()
+            if (ignore.is_ignored(rel_path, is_dir) or
+                is_dir and ignore.markers and ignore.has_marker(entry.path)):
+                continue
+            yield rel_path, entry
+            if is_dir:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                key = (st.st_dev, st.st_ino)
+                if key not in ancestors:
+                    subdirs.append((rel_path + '/', entry.path,
+                                    ancestors | frozenset([key])))
+        stack.extend(reversed(subdirs))
+
+
+# Flags of TreeEntry objects: the entry is a symbolic link.
+TREE_SYMLINK = 1
+
+# Describes a file or directory in a source tree index.  'path' is relative
+# to the root of the tree, the st_* fields are as for os.stat() (following
+# symlinks), with an st_mode of 0 if the entry couldn't be stat'ed.  'flags'
+# is a combination of the TREE_* flags.
+TreeEntry = collections.namedtuple(
+    'TreeEntry', 'path st_ino st_size st_mtime st_mode flags')
+
+# Layout of a tree index file:
+#     header      _INDEX_HEADER followed by the root path.
+#     records     one _INDEX_RECORD per entry, in walk_source_tree() order.
+#     order       the record numbers (little endian uint32), sorted by path.
+#     names       the paths of the entries.
+# Offsets in the header are from the start of the file, name offsets in the
+# records are from the start of the names.
+_INDEX_MAGIC = 'SXCIDX1\n'
+_INDEX_HEADER = struct.Struct('<8sIIIII')
+_INDEX_RECORD = struct.Struct('<IIQQdII')
+_INDEX_ORDER = struct.Struct('<I')
+
+
+def write_tree_index(source_dir, path):
+    """Scans a source tree into an index file.
+
+    The entries are those produced by walk_source_tree() with the default
+    ignore rules.  Each is stat'ed once, consumers of the index need no
+    further metadata calls.  The file is replaced atomically, so readers
+    that have already mapped an earlier version are unaffected.
+
+    Args:
+        source_dir: (str) Root of the source tree.
+        path: (str) The index file to write.
+
+    Returns:
+        (int) the number of entries.
+    """
+    records = []
+    names = []
+    names_size = 0
+    for rel_path, entry in _scan_source_tree(
+            source_dir, IgnoreRules.for_source_dir(source_dir)):
+        flags = TREE_SYMLINK if entry.is_symlink() else 0
+        try:
+            st = entry.stat()
+            fields = (st.st_ino, st.st_size, st.st_mtime, st.st_mode)
+        except OSError:
+            fields = (0, 0, 0.0, 0)
+        records.append(_INDEX_RECORD.pack(names_size, len(rel_path),
+                                          *(fields + (flags,))))
+        names.append(rel_path)
+        names_size += len(rel_path)
+
+    root = os.path.abspath(source_dir)
+    order = sorted(xrange(len(names)), key=names.__getitem__)
+    records_offset = _INDEX_HEADER.size + len(root)
+    order_offset = records_offset + len(records) * _INDEX_RECORD.size
+    names_offset = order_offset + len(order) * _INDEX_ORDER.size
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(_INDEX_HEADER.pack(_INDEX_MAGIC, len(records), records_offset,
+                                   order_offset, names_offset, len(root)))
+        f.write(root)
+        f.write(''.join(records))
+        f.write(struct.pack('<{}I'.format(len(order)), *order))
+        f.write(''.join(names))
+    os.rename(tmp_path, path)
+    return len(records)
+
+
+class TreeIndex(object):
+    """A source tree index file written by write_tree_index().
+
+    The file is memory-mapped and entries are decoded as they're accessed,
+    nothing is read up front.
+    """
+
+    def __init__(self, path):
+        """Constructor.
+
+        Raises:
+            IOError: The file can't be read.
+            ValueError: The file isn't a tree index.
+        """
+        with open(path, 'rb') as f:
+            try:
+                self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except mmap.error as ex:
+                raise ValueError('Invalid tree index {}: {}'.format(path, ex))
+        if len(self.__map) < _INDEX_HEADER.size:
+            raise ValueError('Invalid tree index {}'.format(path))
+        (magic, self.__count, self.__records, self.__order, self.__names,
+         root_length) = _INDEX_HEADER.unpack_from(self.__map)
+        if magic != _INDEX_MAGIC:
+            raise ValueError('Invalid tree index {}'.format(path))
+        self.root = self.__map[_INDEX_HEADER.size:
+                               _INDEX_HEADER.size + root_length]
+
+        # The record after the last one found by get().  Images list their
+        # files in index order, so this is usually the next one asked for.
+        self.__next = 0
+
+    def __len__(self):
+        return self.__count
+
+    def __path(self, number):
+        offset, length = _INDEX_RECORD.unpack_from(
+            self.__map, self.__records + number * _INDEX_RECORD.size)[:2]
+        offset += self.__names
+        return self.__map[offset:offset + length]
+
+    def __getitem__(self, number):
+        if not 0 <= number < self.__count:
+            raise IndexError(number)
+        fields = _INDEX_RECORD.unpack_from(
+            self.__map, self.__records + number * _INDEX_RECORD.size)
+        offset = self.__names + fields[0]
+        return TreeEntry(self.__map[offset:offset + fields[1]], *fields[2:])
+
+    def __iter__(self):
+        for number in xrange(self.__count):
+            yield self[number]
+
+    def get(self, path):
+        """Returns the TreeEntry for a path, None if it isn't in the index.
+        """
+        if self.__next < self.__count:
+            entry = self[self.__next]
+            if entry.path == path:
+                self.__next += 1
+                return entry
+
+        low, high = 0, self.__count
+        while low < high:
+            middle = (low + high) // 2
+            number = _INDEX_ORDER.unpack_from(
+                self.__map, self.__order + middle * _INDEX_ORDER.size)[0]
+            entry_path = self.__path(number)
+            if entry_path == path:
+                self.__next = number + 1
+                return self[number]
+            elif entry_path < path:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+
+# The last index opened by get_tree_index(), as (key, TreeIndex).
+_tree_index = None
+
+
+def get_tree_index(source_dir):
+    """Returns the tree index of the invocation for a source directory.
+
+    The core indexes the source directory once it has been recognized and
+    names the index file in $SXC_TREE_INDEX, so every hook (and the core
+    itself) can use it instead of walking and stat'ing the tree again.
+
+    Args:
+        source_dir: (str) The source directory.
+
+    Returns:
+        (TreeIndex or None) The index, None if there is no index or it is
+        for another directory.
+    """
+    global _tree_index
+    path = os.environ.get(TREE_INDEX_ENV)
+    if not path:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (path, st.st_ino, st.st_mtime)
+    if _tree_index is None or _tree_index[0] != key:
+        try:
+            _tree_index = (key, TreeIndex(path))
+        except (IOError, ValueError):
+            return None
+    index = _tree_index[1]
+    return index if index.root == os.path.abspath(source_dir) else None
+
+
+def stat_source_file(file_source, file, index=None):
+    """Resolves a file of an image for staging.
+
+    Args:
+        file_source: (str) The directory that files are staged from (see
+            get_file_source()).
+        file: (str) Path of the file relative to 'file_source'.
+        index: (TreeIndex or None) The index of 'file_source'.  Files found
+            in it that aren't symlinks need no system calls.
+
+    Returns:
+        (path, stat) where 'path' is the file path with any symlinks resolved
+        and 'stat' is an os.stat() result (or TreeEntry) for it.
+
+    Raises:
+        OSError: The file doesn't exist.
+    """
+    entry = index.get(file) if index else None
+    if entry is None or entry.flags & TREE_SYMLINK:
+        path = os.path.realpath(os.path.join(file_source, file))
+        return path, os.stat(path)
+    path = os.path.join(file_source, file)
+    if not entry.st_mode:
+        raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+    return path, entry
+
+
+def get_file_source(source_dir):
+    """Returns the directory that image files should be staged from.
+
+    When pushing to several targets at once the core copies the image once
+    into a shared staging directory (named by $SXC_SHARED_STAGING) so that
+    every target deploys the same snapshot of the source tree.  Files staged
+    from it are cloned with reflinks where the filesystem supports them, so
+    the targets share the blocks of the staged files.  Otherwise, this is
+    just 'source_dir'.
+
+    Args:
+        source_dir: (str) The source directory.
+    """
+    shared_staging_dir = os.environ.get(SHARED_STAGING_ENV)
+    if shared_staging_dir:
+        return os.path.join(shared_staging_dir, 'app')
+    return source_dir
+
+
+def get_target_label(actuator):
+    """Returns the name of the target that an actuator is pushing to.
+
+    This is the actuator name, unless the core is pushing to several targets
+    at once: the targets are then labeled (with "gaemvm#2" for the second
+    target using gaemvm, for instance) and actuators should keep any state
+    that is specific to the target, like persistent staging directories,
+    under the label so that concurrent pushes don't share it.
+
+    Args:
+        actuator: (str) The name of the actuator.
+    """
+    return os.environ.get(TARGET_LABEL_ENV) or actuator
+
+
+# Staging methods, from the cheapest to the most expensive.
+STAGE_LINK = 'link'
+STAGE_CLONE = 'clone'
+STAGE_COPY_RANGE = 'copy_file_range'
+STAGE_SENDFILE = 'sendfile'
+STAGE_COPY = 'copy'
+
+# The FICLONE ioctl, which makes the destination share the blocks of the
+# source on filesystems that support it (btrfs, xfs, ...).
+_FICLONE = 0x40049409
+
+# Errors meaning that a staging method isn't supported for the files.
+_UNSUPPORTED_ERRNOS = frozenset(
+    getattr(errno, name) for name in
+    ('EXDEV', 'EPERM', 'EMLINK', 'EINVAL', 'ENOSYS', 'ENOTTY', 'EOPNOTSUPP',
+     'ENOTSUP', 'EBADF') if hasattr(errno, name))
+
+# Maximum number of bytes per copy_file_range() or sendfile() call.
+_SYSCALL_COPY_SIZE = 1 << 30
+
+# libc, for the system calls that the os module lacks in python 2.
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        for name, argtypes in (
+                ('copy_file_range', [ctypes.c_int, ctypes.c_void_p,
+                                     ctypes.c_int, ctypes.c_void_p,
+                                     ctypes.c_size_t, ctypes.c_uint]),
+                ('sendfile', [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                              ctypes.c_size_t])):
+            function = getattr(libc, name, None)
+            if function is not None:
+                function.argtypes = argtypes
+                function.restype = ctypes.c_ssize_t
+        _libc = libc
+    return _libc
+
+
+def _copy_with_syscall(name, src, dst):
+    """Copies the open file 'src' to 'dst' with a libc copy function.
+
+    Raises:
+        OSError: if the copy fails, with ENOSYS if libc lacks the function.
+    """
+    import ctypes
+    function = getattr(_get_libc(), name, None)
+    if function is None:
+        raise OSError(errno.ENOSYS, '{} is not available'.format(name))
+    src_fd = src.fileno()
+    dst_fd = dst.fileno()
+    while True:
+        if name == 'copy_file_range':
+            count = function(src_fd, None, dst_fd, None, _SYSCALL_COPY_SIZE,
+                             0)
+        else:
+            count = function(dst_fd, src_fd, None, _SYSCALL_COPY_SIZE)
+        if count == 0:
+            return
+        elif count < 0:
+            error = ctypes.get_errno()
+            if error == errno.EINTR:
+                continue
+            raise OSError(error, os.strerror(error))
+
+
+class _Stager(object):
+    """Stages files with the cheapest method that works for them.
+
+    Methods that fail as unsupported (linking across filesystems, cloning on
+    a filesystem without reflinks, ...) aren't tried again for the rest of
+    the files.
+    """
+
+    def __init__(self, link):
+        # The methods found not to work, this is shared by all threads.
+        self.disabled = set() if link else set([STAGE_LINK])
+
+    def link(self, source_path, dest_path):
+        """Tries to hardlink a file.  Returns true if it worked."""
+        if STAGE_LINK in self.disabled:
+            return False
+        try:
+            os.link(source_path, dest_path)
+        except OSError as ex:
+            if ex.errno == errno.EEXIST:
+                # Never write through an existing link to the source.
+                os.unlink(dest_path)
+                return self.link(source_path, dest_path)
+            elif ex.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            self.disabled.add(STAGE_LINK)
+            return False
+        return True
+
+    def copy(self, source_path, dest_path):
+        """Copies a file, with a reflink or in the kernel if possible.
+
+        Returns:
+            (str) The STAGE_* method that was used.
+        """
+        try:
+            os.unlink(dest_path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+        with open(source_path, 'rb') as src, open(dest_path, 'wb') as dst:
+            for method in (STAGE_CLONE, STAGE_COPY_RANGE, STAGE_SENDFILE):
+                if method in self.disabled:
+                    continue
+                try:
+                    if method == STAGE_CLONE:
+                        import fcntl
+                        fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+                    else:
+                        _copy_with_syscall(method, src, dst)
+                except (IOError, OSError) as ex:
+                    if ex.errno not in _UNSUPPORTED_ERRNOS:
+                        raise
+                    self.disabled.add(method)
+                    src.seek(0)
+                    dst.seek(0)
+                    dst.truncate()
+                    continue
+                return method
+            shutil.copyfileobj(src, dst, 1 << 20)
+            return STAGE_COPY
+
+
+def _make_dirs(dirs):
+    """Creates directories, with one system call per missing directory."""
+    made = set()
+    for dir_path in sorted(dirs):
+        if dir_path in made:
+            continue
+        try:
+            os.makedirs(dir_path)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+        while dir_path not in made and dir_path != os.path.dirname(dir_path):
+            made.add(dir_path)
+            dir_path = os.path.dirname(dir_path)
+
+
+def stage_file_list(files, link=False, threads=None):
+    """Makes copies of files as cheaply as the filesystem allows.
+
+    Files are cloned with a reflink where the filesystem supports it, which
+    shares their blocks until either copy is modified.  Otherwise they're
+    copied within the kernel with copy_file_range() or sendfile(), or copied
+    the hard way, in that order of preference.  Real copies are done in a
+    pool of threads.  Existing destination files are replaced, never
+    written through.
+
+    With 'link', files are hardlinked to their source before anything else
+    is tried.  That takes no space or I/O at all, but a hardlink *is* the
+    source file: edits made to the source in place show up in the copy and
+    writes to the copy land in the source.  Only use it for throwaway
+    copies that nothing writes to.
+
+    Args:
+        files: ([(source_path, dest_path), ...]) The files to copy.  The
+            source paths must be regular files.
+        link: (bool) Whether hardlinks may be used.
+        threads: (int or None) Number of threads for real copies, defaults
+            to the number of CPUs.
+
+    Returns:
+        (collections.Counter) The number of files staged with each of the
+        STAGE_* methods.
+    """
+    _make_dirs(set(os.path.dirname(dest_path) for _, dest_path in files))
+    stager = _Stager(link)
+    counts = collections.Counter()
+    to_copy = []
+    for source_path, dest_path in files:
+        if stager.link(source_path, dest_path):
+            counts[STAGE_LINK] += 1
+        else:
+            to_copy.append((source_path, dest_path))
+
+    threads = min(threads or _cpu_count(), len(to_copy))
+    if threads > 1:
+        import multiprocessing.pool
+        pool = multiprocessing.pool.ThreadPool(threads)
+        try:
+            counts.update(pool.imap_unordered(lambda pair: stager.copy(*pair),
+                                              to_copy, 64))
+        finally:
+            pool.terminate()
+    else:
+        counts.update(stager.copy(source_path, dest_path)
+                      for source_path, dest_path in to_copy)
+    return counts
+
+
+def stage_files(source_dir, image, staging_dir=None, link=False,
+                threads=None):
     """Stage files from the intermediate representation.
 
     Args:
@@ -105,23 +1103,977 @@ def stage_files(source_dir, image, staging_dir=None):
             path to use. If not, a temporary staging directory will be
             constructed.  In the latter case, it is the responsibility of the
             caller to delete the staging directory upon completion.
+        link, threads: As for stage_file_list().  Only link files into a
+            temporary staging directory.
     Returns:
         (str) the staging directory path.
     """
     if not staging_dir:
         staging_dir = tempfile.mkdtemp()
 
+    source_dir = get_file_source(source_dir)
+    index = get_tree_index(source_dir)
+    files = []
     for file in image['files']:
-        full_name = os.path.join(staging_dir, 'app', file)
+        # Stage regular files, resolving any symlinks.
+        try:
+            source_path, st = stat_source_file(source_dir, file, index)
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            files.append((source_path,
+                          os.path.join(staging_dir, 'app', file)))
+    stage_file_list(files, link=link, threads=threads)
+    return staging_dir
 
-        # Create the directory if it doesn't exist.
-        my_dir = os.path.dirname(full_name)
-        if not os.path.exists(my_dir):
-            os.makedirs(my_dir)
 
-        # copy the file, resolving any symlinks.
-        source_path = os.path.realpath(os.path.join(source_dir, file))
-        if os.path.isfile(source_path):
-            shutil.copyfile(source_path, full_name)
+def persistent_staging_dir(source_dir, target):
+    """Returns a staging directory that is reused across runs.
 
-    return staging_dir
+    The directory is unique to the combination of source directory and target
+    (usually the actuator name) and lives in the sxc cache.
+
+    Args:
+        source_dir: (str) Source directory being staged.
+        target: (str) Name of the deployment target.
+
+    Returns:
+        (str) the staging directory path.
+    """
+    key = hashlib.sha1(os.path.abspath(source_dir)).hexdigest()[:16]
+    return cache.get_cache_dir('staging', '{}-{}'.format(target, key))
+
+
+def hash_file(path):
+    """Returns the hex SHA-1 digest of the contents of the file at 'path'."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(65536)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# First line of a compact intermediate representation file.
+IR_HEADER = '#sxc-ir 2'
+
+# Describes a file or directory in the intermediate representation.  'type' is
+# 'f' for files and 'd' for directories.  The other fields are None when they
+# are unknown, 'hash' (the hex SHA-1 of the contents) is always None for
+# directories.
+IREntry = collections.namedtuple('IREntry',
+                                 'path type size mode mtime hash')
+
+
+def _escape_name(name):
+    return name.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _unescape_name(name):
+    return re.sub(r'\\(.)',
+                  lambda m: '\n' if m.group(1) == 'n' else m.group(1), name)
+
+
+class IRWriter(object):
+    """Writes the compact intermediate representation format.
+
+    The format is line oriented so that it can be written and read as a
+    stream.  The first line is IR_HEADER, the second is a JSON object
+    containing everything in the image except for the files.  The remaining
+    lines describe the file tree, with paths compressed by only naming each
+    directory once:
+
+        > name                              enter subdirectory 'name'
+        <                                   return to the parent directory
+        D mode mtime name                   directory in the current directory
+        F size mode mtime hash name         file in the current directory
+
+    Modes are octal, hashes are hex SHA-1 digests and names are escaped so
+    that they don't contain newlines.  Entries can be added in any order,
+    but grouping them by directory (as walk_source_tree() does) gives the
+    smallest output.
+    """
+
+    def __init__(self, out, metadata):
+        """Constructor.
+
+        Args:
+            out: (file) Output stream.
+            metadata: (dict) The image, excluding the 'files' entry.
+        """
+        self.__out = out
+        self.__cwd = []
+        out.write(IR_HEADER + '\n')
+        json.dump(metadata, out)
+        out.write('\n')
+
+    def add(self, entry):
+        """Adds an IREntry."""
+        parts = entry.path.split('/')
+        parent = parts[:-1]
+
+        # Move to the parent directory of the entry.
+        common = 0
+        while (common < len(self.__cwd) and common < len(parent) and
+               self.__cwd[common] == parent[common]):
+            common += 1
+        lines = ['<'] * (len(self.__cwd) - common)
+        lines.extend('> ' + _escape_name(part) for part in parent[common:])
+        self.__cwd = parent
+
+        name = _escape_name(parts[-1])
+        if entry.type == 'd':
+            lines.append('D {:o} {!r} {}'.format(entry.mode, entry.mtime,
+                                                 name))
+        else:
+            lines.append('F {} {:o} {!r} {} {}'.format(
+                entry.size, entry.mode, entry.mtime, entry.hash, name))
+        self.__out.write('\n'.join(lines) + '\n')
+
+
+def read_ir(f):
+    """Reads an intermediate representation file.
+
+    Both the compact format written by IRWriter and the plain JSON images of
+    earlier versions are supported.
+
+    Args:
+        f: (file) Input stream.
+
+    Returns:
+        (metadata, entries) where 'metadata' is the image excluding the
+        'files' entry and 'entries' is an iterator over its IREntry objects.
+        For JSON images, only the 'path' of the entries is known.
+    """
+    header = f.readline()
+    if header.startswith('{'):
+        metadata = json.loads(header + f.read())
+        files = metadata.pop('files', [])
+        return metadata, (IREntry(path, None, None, None, None, None)
+                          for path in files)
+    elif header.rstrip('\n') != IR_HEADER:
+        raise ValueError('Unsupported IR format: {!r}'.format(header))
+
+    metadata = json.loads(f.readline())
+
+    def entries():
+        cwd = []
+        for line in f:
+            line = line.rstrip('\n')
+            kind = line[:1]
+            if kind == '>':
+                cwd.append(_unescape_name(line[2:]))
+            elif kind == '<':
+                cwd.pop()
+            elif kind == 'D':
+                mode, mtime, name = line[2:].split(' ', 2)
+                yield IREntry('/'.join(cwd + [_unescape_name(name)]), 'd',
+                              None, int(mode, 8), float(mtime), None)
+            elif kind == 'F':
+                size, mode, mtime, digest, name = line[2:].split(' ', 4)
+                yield IREntry('/'.join(cwd + [_unescape_name(name)]), 'f',
+                              int(size), int(mode, 8), float(mtime), digest)
+    return metadata, entries()
+
+
+def load_ir(path):
+    """Returns the JSON compatible view of the image in an IR file.
+
+    This is the image as produced by the aggregators, with 'files' being the
+    list of paths.
+    """
+    with open(path) as f:
+        metadata, entries = read_ir(f)
+        metadata['files'] = [entry.path for entry in entries]
+    return metadata
+
+
+def load_ir_entries(image):
+    """Returns the IR entries for an image.
+
+    Args:
+        image: (dict) The JSON view of the image.  If it has an 'ir' key, this
+            names the compact IR file that it was loaded from.
+
+    Returns:
+        (dict) maps file paths to IREntry objects.  This will be empty if
+        there is no compact IR file for the image.
+    """
+    try:
+        with open(image['ir']) as f:
+            metadata, entries = read_ir(f)
+            return dict((entry.path, entry) for entry in entries
+                        if entry.type)
+    except (KeyError, IOError, ValueError):
+        return {}
+
+
+def write_ir(source_dir, image, out, previous=None):
+    """Writes an image in the compact IR format.
+
+    Every file in the image is stat'ed (or looked up in the tree index) and
+    hashed.  Paths in the IR are UTF-8 byte strings.  Hashes are reused
+    from 'previous' for files whose size and mtime are unchanged.
+
+    Args:
+        source_dir: (str) The source directory.
+        image: (dict) The JSON view of the image.
+        out: (file) Output stream.
+        previous: (dict or None) IR entries of an earlier version of the
+            image, as returned by load_ir_entries().
+    """
+    previous = previous or {}
+    index = get_tree_index(source_dir)
+    writer = IRWriter(out, dict((key, val) for key, val in image.iteritems()
+                                if key not in ('files', 'ir')))
+    for path in image['files']:
+        if isinstance(path, unicode):
+            # Images from JSON hooks, paths are UTF-8 on disk.
+            path = path.encode('utf-8')
+        entry = index.get(path) if index else None
+        if entry is not None:
+            st = entry
+            if not st.st_mode:
+                continue
+        else:
+            try:
+                st = os.stat(os.path.join(source_dir, path))
+            except OSError:
+                continue
+        mode = stat.S_IMODE(st.st_mode)
+        if stat.S_ISDIR(st.st_mode):
+            writer.add(IREntry(path, 'd', None, mode, st.st_mtime, None))
+        elif stat.S_ISREG(st.st_mode):
+            old = previous.get(path)
+            if old and old.size == st.st_size and old.mtime == st.st_mtime:
+                digest = old.hash
+            else:
+                digest = hash_file(os.path.join(source_dir, path))
+            writer.add(IREntry(path, 'f', st.st_size, mode, st.st_mtime,
+                               digest))
+
+
+def _load_manifest(manifest_path):
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _save_manifest(manifest_path, manifest):
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.rename(tmp_path, manifest_path)
+
+
+def _is_staged(path, size):
+    """Returns true if a staged file is still what the manifest says."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    return stat.S_ISREG(st.st_mode) and st.st_size == size
+
+
+def _remove_staged_file(app_dir, file):
+    full_name = os.path.join(app_dir, file)
+    try:
+        os.unlink(full_name)
+    except OSError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+
+    # Remove any directories that we've left empty.
+    my_dir = os.path.dirname(full_name)
+    while my_dir != app_dir and my_dir.startswith(app_dir):
+        try:
+            os.rmdir(my_dir)
+        except OSError:
+            break
+        my_dir = os.path.dirname(my_dir)
+
+
+def sync_files(source_dir, image, staging_dir, threads=None):
+    """Incrementally stage files from the intermediate representation.
+
+    Like stage_files(), files are copied to the 'app' subdirectory of the
+    staging directory.  Unlike stage_files(), a manifest of the staged tree
+    (path, size, mtime and content hash of every file) is kept in the staging
+    directory so that subsequent calls only copy the files that were added or
+    changed and delete the files that are no longer part of the image.  Files
+    whose size and mtime match the manifest are not read at all, nor are
+    files whose size and mtime match the image's IR entries.  Staged files
+    are stat'ed, those that were removed (or resized) outside of sxc are
+    staged again.
+
+    The staged tree outlives the source files, so files are never hardlinked
+    to them (see stage_file_list()).
+
+    Args:
+        source_dir: (str) Source directory to copy files from.
+        image: (object) The intermediate representation object.
+        staging_dir: (str) The staging directory.  This is typically obtained
+            from persistent_staging_dir() or provided by the user.
+        threads: As for stage_file_list().
+
+    Returns:
+        (dict) A summary of the changes with the keys 'added', 'changed' and
+        'deleted' (lists of paths relative to the source directory) and
+        'unchanged' (the number of files that were left alone).
+    """
+    app_dir = os.path.join(staging_dir, 'app')
+    manifest_path = os.path.join(staging_dir, MANIFEST_NAME)
+    file_source = get_file_source(source_dir)
+    old_manifest = _load_manifest(manifest_path)
+
+    # Hashes from the IR only apply to the source directory itself.  Those of
+    # files in a shared staging directory are in its manifest, the core has
+    # just synchronized it.
+    ir_entries = {}
+    shared_manifest = {}
+    if file_source == source_dir:
+        ir_entries = load_ir_entries(image)
+    else:
+        shared_manifest = _load_manifest(
+            os.path.join(os.path.dirname(file_source), MANIFEST_NAME))
+    index = get_tree_index(file_source)
+
+    new_manifest = {}
+    added = []
+    changed = []
+    unchanged = 0
+    to_stage = []
+
+    for file in image['files']:
+        # Resolve symlinks, we only stage regular files.
+        try:
+            source_path, st = stat_source_file(file_source, file, index)
+        except OSError:
+            continue
+        if not stat.S_ISREG(st.st_mode) or file in new_manifest:
+            continue
+
+        prev = old_manifest.pop(file, None)
+        staged = prev and _is_staged(os.path.join(app_dir, file), prev[0])
+        if staged and prev[0] == st.st_size and prev[1] == st.st_mtime:
+            new_manifest[file] = prev
+            unchanged += 1
+            continue
+
+        # The file has been touched, check whether the contents have changed.
+        ir_entry = ir_entries.get(file)
+        shared_entry = shared_manifest.get(file)
+        if (ir_entry and ir_entry.size == st.st_size and
+            ir_entry.mtime == st.st_mtime):
+            digest = ir_entry.hash
+        elif shared_entry and shared_entry[0] == st.st_size:
+            digest = shared_entry[2]
+        else:
+            digest = hash_file(source_path)
+        new_manifest[file] = [st.st_size, st.st_mtime, digest]
+        if staged and prev[2] == digest:
+            unchanged += 1
+            continue
+
+        to_stage.append((source_path, os.path.join(app_dir, file)))
+        (changed if prev else added).append(file)
+    stage_file_list(to_stage, threads=threads)
+
+    # Anything left in the old manifest is no longer part of the image.
+    deleted = sorted(old_manifest)
+    for file in deleted:
+        _remove_staged_file(app_dir, file)
+
+    _save_manifest(manifest_path, new_manifest)
+    return {'added': added, 'changed': changed, 'deleted': deleted,
+            'unchanged': unchanged}
+
+
+# Compression codecs for streamed archives, mapping the codec name to the
+# command that compresses the archive locally (None if it is compressed
+# in-process) and the shell command that unpacks it on the receiving end.
+# '{threads}' in the compression command is replaced by the thread count.
+ARCHIVE_CODECS = {
+    'gzip': (None, 'tar -xzf -'),
+    'zstd': (['zstd', '-q', '-T{threads}', '-c'], 'zstd -dcq | tar -xf -'),
+    'lz4': (['lz4', '-q', '-c'], 'lz4 -dcq | tar -xf -'),
+    'none': (None, 'tar -xf -'),
+}
+
+_ARCHIVE_READ_SIZE = 65536
+
+# Sizes of tar blocks and records.
+_TAR_BLOCK_SIZE = 512
+_TAR_RECORD_SIZE = 20 * _TAR_BLOCK_SIZE
+
+
+def _cpu_count():
+    # multiprocessing (like tarfile) is imported on demand, it's slow to
+    # import and most sxc commands never need it.
+    import multiprocessing
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 2
+
+
+def _rechunk(chunks, size):
+    """Joins a stream of small strings into strings of at least 'size' bytes.
+    """
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= size:
+            yield ''.join(pending)
+            pending = []
+            pending_size = 0
+    if pending:
+        yield ''.join(pending)
+
+
+def _tar_header(name, size, mode, mtime):
+    import tarfile
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = mode
+    info.mtime = int(mtime)
+    info.uname = info.gname = 'root'
+    return info.tobuf(tarfile.GNU_FORMAT)
+
+
+def archive_chunks(source_dir, image, extra_files=None, prefix='app'):
+    """Generates an uncompressed tar archive of the files in an image.
+
+    The archive is produced directly from the source files as it is consumed,
+    nothing is staged or written to disk.  Files that are not regular files
+    (after resolving symlinks) are skipped, like stage_files() does.
+
+    Args:
+        source_dir: (str) Source directory to read files from.
+        image: (object) The intermediate representation object.
+        extra_files: ([(str, int, str), ...] or None) Additional files to
+            add to the archive as (name, mode, contents) tuples.
+        prefix: (str) Directory in the archive that the image files are
+            stored under.
+
+    Returns:
+        (iterator of str) the archive data.
+    """
+    file_source = get_file_source(source_dir)
+    index = get_tree_index(file_source)
+    offset = 0
+    for file in image['files']:
+        try:
+            source_path, st = stat_source_file(file_source, file, index)
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            f = open(source_path, 'rb')
+        except (IOError, OSError):
+            continue
+        with f:
+            header = _tar_header(posixpath.join(prefix, file), st.st_size,
+                                 stat.S_IMODE(st.st_mode), st.st_mtime)
+            yield header
+            remaining = st.st_size
+            while remaining:
+                block = f.read(min(remaining, _ARCHIVE_READ_SIZE))
+                if not block:
+                    # The file shrank while we were reading it, pad it out to
+                    # the size recorded in the header.
+                    block = '\0' * min(remaining, _ARCHIVE_READ_SIZE)
+                remaining -= len(block)
+                yield block
+        padding = -st.st_size % _TAR_BLOCK_SIZE
+        yield '\0' * padding
+        offset += len(header) + st.st_size + padding
+
+    for name, mode, contents in extra_files or []:
+        header = _tar_header(name, len(contents), mode, time.time())
+        padding = -len(contents) % _TAR_BLOCK_SIZE
+        yield header + contents + '\0' * padding
+        offset += len(header) + len(contents) + padding
+
+    # End of archive marker, padded out to a full record.
+    offset += 2 * _TAR_BLOCK_SIZE
+    yield '\0' * (2 * _TAR_BLOCK_SIZE + -offset % _TAR_RECORD_SIZE)
+
+
+def _gzip_block(block, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush()
+
+
+def gzip_chunks(chunks, threads=None, level=6, block_size=1 << 20):
+    """Compresses a stream of data with gzip using several threads.
+
+    The data is split into blocks of about 'block_size' bytes which are
+    compressed independently and emitted in order as consecutive gzip members,
+    which gzip (and tar -z) decompress as a single stream.  At most a couple
+    of blocks per thread are in flight at any time.  Empty data still gives
+    a (single, empty) gzip member, so the output is always valid gzip.
+
+    Args:
+        chunks: (iterable of str) The data to compress.
+        threads: (int or None) Number of compression threads, defaults to the
+            number of CPUs.
+        level: (int) zlib compression level.
+        block_size: (int) Approximate size of the independently compressed
+            blocks.
+
+    Returns:
+        (iterator of str) the compressed data.
+    """
+    import multiprocessing.pool
+    threads = threads or _cpu_count()
+    pool = multiprocessing.pool.ThreadPool(threads)
+    try:
+        pending = collections.deque()
+        empty = True
+        for block in _rechunk(chunks, block_size):
+            empty = False
+            pending.append(pool.apply_async(_gzip_block, (block, level)))
+            if len(pending) > 2 * threads:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        if empty:
+            yield _gzip_block('', level)
+    finally:
+        pool.terminate()
+
+
+def send_archive(chunks, args, codec='gzip', threads=None, relay=None):
+    """Streams a compressed archive into the standard input of a command.
+
+    Reading, compression and transfer all overlap: the archive is compressed
+    as it is produced and written to the command as it is compressed.  The
+    command would typically be an ssh session running the codec's unpack
+    command from ARCHIVE_CODECS on the remote host.
+
+    Args:
+        chunks: (iterable of str) The uncompressed archive, typically from
+            archive_chunks().
+        args: ([str, ...]) Command line of the receiving process.
+        codec: (str) Name of the compression codec (a key of ARCHIVE_CODECS).
+        threads: (int or None) Number of compression threads, defaults to the
+            number of CPUs.
+        relay: (OutputRelay or None) If provided, the output of the processes
+            is sent to the framework through this relay.
+
+    Returns:
+        (int) the exit code of the receiving process, or that of the
+        compressor if it failed.
+    """
+    threads = threads or _cpu_count()
+    compress_args = ARCHIVE_CODECS[codec][0]
+    output = {}
+    if relay:
+        output = {'stdout_callback': relay.stdout_callback,
+                  'stderr_callback': relay.stderr_callback}
+
+    runner = proclib.Runner()
+    try:
+        compressor = None
+        if codec == 'gzip':
+            receiver = runner.spawn(
+                *args, stdin=gzip_chunks(chunks, threads=threads), **output)
+        elif compress_args is None:
+            receiver = runner.spawn(
+                *args, stdin=_rechunk(chunks, _ARCHIVE_READ_SIZE), **output)
+        else:
+            # Connect the compressor directly to the receiver.
+            read_fd, write_fd = os.pipe()
+            try:
+                compressor = runner.spawn(
+                    *[arg.format(threads=threads) for arg in compress_args],
+                    stdin=_rechunk(chunks, _ARCHIVE_READ_SIZE),
+                    stdout_file=write_fd,
+                    stderr_callback=output.get('stderr_callback'))
+                receiver = runner.spawn(*args, stdin_file=read_fd, **output)
+            finally:
+                os.close(read_fd)
+                os.close(write_fd)
+        runner.run()
+    finally:
+        runner.close()
+
+    if compressor and compressor.returncode:
+        return compressor.returncode
+    return receiver.returncode
+
+
+class Transport(object):
+    """Runs shell commands on a (usually remote) host.
+
+    Transports are context managers: the connection, if there is one, is
+    opened on entry and closed on exit.
+
+    Usage:
+
+        with SSHTransport('host', user='root') as transport:
+            transport.run('mkdir -p /app')
+            runner = proclib.Runner()
+            procs = [transport.spawn(runner, command) for command in commands]
+            runner.run()
+    """
+
+    def argv(self, command):
+        """Returns the command line that runs a shell command on the host.
+
+        Args:
+            command: (str) The shell command.
+
+        Returns:
+            ([str, ...])
+        """
+        raise NotImplementedError()
+
+    def open(self):
+        """Opens the connection to the host, if the transport has one."""
+        pass
+
+    def close(self):
+        """Closes the connection to the host."""
+        pass
+
+    def run(self, command, **kwargs):
+        """Runs a shell command on the host and waits for it.
+
+        Args:
+            command: (str) The shell command.
+            **kwargs: As for proclib.run().
+
+        Returns:
+            (int) The exit code of the command.
+        """
+        return proclib.run(*self.argv(command), **kwargs)
+
+    def spawn(self, runner, command, **kwargs):
+        """Starts a shell command on the host.
+
+        Any number of commands can be running on the host at once.
+
+        Args:
+            runner: (proclib.Runner) The runner to run the command in.
+            command: (str) The shell command.
+            **kwargs: As for proclib.Runner.spawn().
+
+        Returns:
+            (proclib.Process)
+        """
+        return runner.spawn(*self.argv(command), **kwargs)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class CommandTransport(Transport):
+    """Runs shell commands by passing them to a command.
+
+    For example, CommandTransport(['sh', '-c']) runs commands on the local
+    host, which is handy for testing.
+    """
+
+    def __init__(self, prefix):
+        """Constructor.
+
+        Args:
+            prefix: ([str, ...]) The command, shell commands are passed to
+                it as an additional final argument.
+        """
+        self.prefix = list(prefix)
+
+    def argv(self, command):
+        return self.prefix + [command]
+
+
+class SSHTransport(Transport):
+    """Runs shell commands on a host over a single ssh connection.
+
+    Opening the transport starts an OpenSSH control master, and every
+    command is then run as a new session multiplexed over its connection,
+    so there's only one key exchange and authentication per host no matter
+    how many commands are run (in parallel or not).  Without open(), every
+    command makes its own connection.
+    """
+
+    def __init__(self, host, user=None, port=None, key_file=None,
+                 options=(), ssh='ssh', persist=60):
+        """Constructor.
+
+        Args:
+            host: (str) The host to connect to.
+            user: (str or None) The user to log in as.
+            port: (int or None) The port to connect to.
+            key_file: (str or None) The private key to authenticate with.
+            options: ([str, ...]) Additional ssh options, such as
+                'StrictHostKeyChecking no'.
+            ssh: (str) The ssh program.
+            persist: (int) Seconds that the connection stays up once idle,
+                in case we exit without closing it.
+        """
+        self.host = host
+        self.__target = '{}@{}'.format(user, host) if user else host
+        self.__ssh = [ssh]
+        if port:
+            self.__ssh.extend(['-p', str(port)])
+        if key_file:
+            self.__ssh.extend(['-i', key_file])
+        for option in options:
+            self.__ssh.extend(['-o', option])
+        self.__persist = persist
+        self.__control_dir = None
+
+    def __control_args(self, master):
+        return ['-o', 'ControlMaster={}'.format('yes' if master else 'no'),
+                '-o', 'ControlPath=' + os.path.join(self.__control_dir,
+                                                    'control')]
+
+    def argv(self, command):
+        args = list(self.__ssh)
+        if self.__control_dir:
+            args.extend(self.__control_args(False))
+        return args + [self.__target, command]
+
+    def open(self):
+        """Connects to the host.
+
+        Raises:
+            IOError: if the connection fails.
+        """
+        if self.__control_dir:
+            return
+
+        # The control socket path must be short, so it goes in its own
+        # temporary directory rather than the cache.
+        self.__control_dir = tempfile.mkdtemp(prefix='sxc-ssh-')
+        log_path = os.path.join(self.__control_dir, 'master.log')
+
+        # With -f, ssh goes into the background once the connection is up.
+        with open(log_path, 'w') as log, open(os.devnull, 'r+') as null:
+            returncode = proclib.run(
+                *(self.__ssh + self.__control_args(True) +
+                  ['-o', 'ControlPersist={}'.format(self.__persist),
+                   '-N', '-f', self.__target]),
+                stdin_file=null, stdout_file=null, stderr_file=log)
+        if returncode:
+            with open(log_path) as log:
+                message = log.read().strip()
+            shutil.rmtree(self.__control_dir, ignore_errors=True)
+            self.__control_dir = None
+            raise IOError('Unable to connect to {}: {}'.format(
+                self.__target, message or 'ssh exited with status {}'.format(
+                    returncode)))
+
+    def close(self):
+        if not self.__control_dir:
+            return
+        with open(os.devnull, 'r+') as null:
+            proclib.run(*(self.__ssh + self.__control_args(False) +
+                          ['-O', 'exit', self.__target]),
+                        stdin_file=null, stdout_file=null, stderr_file=null)
+        shutil.rmtree(self.__control_dir, ignore_errors=True)
+        self.__control_dir = None
+
+
+class Probe(object):
+    """A readiness check that is retried until it passes.
+
+    See wait_until_ready().  Subclasses implement attempt().  Failed
+    attempts are retried with exponential backoff and "decorrelated"
+    jitter, so that many probes don't all retry in lockstep.
+
+    Attributes:
+        name: (str) Name of the probe, for messages.
+        ready: (bool) True once an attempt has passed.
+        attempts: (int) The number of attempts made.
+        last_error: (str or None) Why the last attempt failed, if known.
+        ready_time: (float or None) When the probe passed.
+    """
+
+    def __init__(self, name, initial_delay=0.1, max_delay=5.0,
+                 attempt_timeout=10.0):
+        """Constructor.
+
+        Args:
+            name: (str) Name of the probe.
+            initial_delay: (float) Minimum delay between attempts, in
+                seconds.
+            max_delay: (float) Maximum delay between attempts, in seconds.
+            attempt_timeout: (float) Maximum time for a single attempt, in
+                seconds.
+        """
+        self.name = name
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.attempt_timeout = attempt_timeout
+        self.ready = False
+        self.attempts = 0
+        self.last_error = None
+        self.ready_time = None
+
+    def attempt(self, timeout):
+        """Checks for readiness once.
+
+        Args:
+            timeout: (float) Seconds that the attempt may take.
+
+        Returns:
+            (bool) True if ready.  Exceptions count as not being ready.
+        """
+        raise NotImplementedError()
+
+    def run(self, deadline, stop):
+        """Makes attempts until one passes, the deadline or 'stop' is set.
+
+        Args:
+            deadline: (float or None) Time to give up at.
+            stop: (threading.Event) Set to abandon the probe.
+        """
+        import random
+        delay = self.initial_delay
+        while not stop.is_set():
+            timeout = self.attempt_timeout
+            if deadline is not None:
+                timeout = min(timeout, deadline - time.time())
+                if timeout <= 0:
+                    return
+            self.attempts += 1
+            try:
+                if self.attempt(timeout):
+                    self.ready = True
+                    self.ready_time = time.time()
+                    return
+            except Exception as ex:
+                self.last_error = str(ex) or ex.__class__.__name__
+            delay = min(self.max_delay,
+                        random.uniform(self.initial_delay, delay * 3))
+            if deadline is not None:
+                delay = min(delay, deadline - time.time())
+            if delay > 0:
+                stop.wait(delay)
+
+
+class FunctionProbe(Probe):
+    """A probe that calls a function, such as an API status check."""
+
+    def __init__(self, name, function, **kwargs):
+        """Constructor.
+
+        Args:
+            name: (str) Name of the probe.
+            function: (callable()) Returns true when ready.  It should not
+                block for longer than the attempt timeout.
+            **kwargs: As for Probe.
+        """
+        super(FunctionProbe, self).__init__(name, **kwargs)
+        self.__function = function
+
+    def attempt(self, timeout):
+        return self.__function()
+
+
+class TCPProbe(Probe):
+    """A probe that connects to a TCP port and optionally reads a banner.
+
+    With a banner, the port only counts as ready once the server greets the
+    client with it, which (for ssh, say) means that the server is actually
+    accepting sessions rather than just that the port is open.
+    """
+
+    def __init__(self, name, host, port, banner=None, **kwargs):
+        """Constructor.
+
+        Args:
+            name: (str) Name of the probe.
+            host: (str or callable()) The host to connect to, or a function
+                returning it (None while it isn't known yet).
+            port: (int) The port to connect to.
+            banner: (str or None) Prefix of the first line that the server
+                must send, for instance 'SSH-'.
+            **kwargs: As for Probe.
+        """
+        super(TCPProbe, self).__init__(name, **kwargs)
+        self.__host = host
+        self.port = port
+        self.banner = banner
+
+    def attempt(self, timeout):
+        import socket
+        host = self.__host() if callable(self.__host) else self.__host
+        if not host:
+            self.last_error = 'address not known yet'
+            return False
+        sock = socket.create_connection((host, self.port), timeout)
+        try:
+            if not self.banner:
+                return True
+            data = ''
+            while len(data) < len(self.banner):
+                chunk = sock.recv(256)
+                if not chunk:
+                    self.last_error = 'connection closed without a banner'
+                    return False
+                data += chunk
+            if not data.startswith(self.banner):
+                self.last_error = 'unexpected banner {!r}'.format(data)
+                return False
+            return True
+        finally:
+            sock.close()
+
+
+def wait_until_ready(probes, timeout=None):
+    """Runs readiness probes concurrently until all of them pass.
+
+    Each probe is retried in its own thread, so slow checks (like API calls)
+    don't hold up the others, and this returns as soon as the last one
+    passes.
+
+    Usage:
+
+        ssh = TCPProbe('ssh', get_ip_address, 22, banner='SSH-')
+        api = FunctionProbe('droplet', droplet_is_active)
+        pending = wait_until_ready([api, ssh], timeout=600)
+
+    Args:
+        probes: ([Probe, ...]) The probes.
+        timeout: (float or None) Seconds to wait for, None to wait forever.
+
+    Returns:
+        ([Probe, ...]) The probes that didn't pass in time, empty if all of
+        them are ready.
+    """
+    import threading
+    deadline = time.time() + timeout if timeout is not None else None
+    stop = threading.Event()
+    threads = []
+    for probe in probes:
+        thread = threading.Thread(target=probe.run, args=(deadline, stop),
+                                  name='probe ' + probe.name)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    try:
+        for thread in threads:
+            # Joining with a timeout keeps us interruptible.
+            while thread.is_alive():
+                wait = 1.0
+                if deadline is not None:
+                    wait = min(wait, deadline - time.time())
+                    if wait <= 0:
+                        break
+                thread.join(wait)
+    finally:
+        stop.set()
+    return [probe for probe in probes if not probe.ready]
@@ -0,0 +1,192 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Declarative aggregator match rules.
+
+Instead of a matches hook, an aggregator can declare the rules that a source
+directory must satisfy in the 'match' key of its data/info.json file.  The
+rules are evaluated in-process, so detecting the aggregator takes no
+subprocesses at all.  'match' is a list of rules, all of which must hold:
+
+    {"exists": "path"}
+        The file or directory exists.
+    {"glob": "dir/*.py"}
+        An entry of the directory matches the pattern.  Only the last
+        component of the pattern may contain wildcards.
+    {"regex": "pattern", "file": "path", "bytes": 4096}
+        The regular expression matches somewhere in the first 'bytes'
+        (default DEFAULT_HEAD_SIZE) bytes of the file.
+    {"json": "path", "key": "a.b"}
+        The file contains JSON with the (optional) key present.  The key is
+        a dotted path or a list of keys.
+
+Paths are relative to the source directory.  The rules of all aggregators
+are evaluated against a single SourceScan, so each directory is listed and
+each file is read at most once per detection.
+"""
+
+import fnmatch
+import json
+import os
+import re
+
+# How much of a file regex rules look at by default.
+DEFAULT_HEAD_SIZE = 4096
+
+# Files larger than this never satisfy json rules.
+MAX_JSON_SIZE = 1 << 20
+
+
+class SourceScan(object):
+    """A lazily populated view of a source directory.
+
+    Directory listings and file contents are cached, so they are shared
+    between all the rules that are evaluated against the scan.
+    """
+
+    def __init__(self, source_dir):
+        self.source_dir = source_dir
+        self.__listings = {}
+        self.__heads = {}
+        self.__json = {}
+
+    def listdir(self, rel_dir):
+        """Returns the names in a directory, empty if it doesn't exist."""
+        rel_dir = os.path.normpath(rel_dir) if rel_dir else ''
+        names = self.__listings.get(rel_dir)
+        if names is None:
+            try:
+                names = frozenset(
+                    os.listdir(os.path.join(self.source_dir, rel_dir)))
+            except OSError:
+                names = frozenset()
+            self.__listings[rel_dir] = names
+        return names
+
+    def exists(self, rel_path):
+        """Returns true if the file or directory exists."""
+        rel_dir, name = os.path.split(os.path.normpath(rel_path))
+        return name in self.listdir(rel_dir)
+
+    def head(self, rel_path, size):
+        """Returns up to the first 'size' bytes of a file.
+
+        Returns None if the file doesn't exist or can't be read.
+        """
+        cached = self.__heads.get(rel_path)
+        if cached and (cached[1] >= size or len(cached[0]) < cached[1]):
+            # We have read at least as much, or all of the file.
+            return cached[0][:size]
+        if not self.exists(rel_path):
+            return None
+        try:
+            with open(os.path.join(self.source_dir, rel_path), 'rb') as f:
+                data = f.read(size)
+        except IOError:
+            return None
+        self.__heads[rel_path] = (data, size)
+        return data
+
+    def json(self, rel_path):
+        """Returns the parsed contents of a JSON file.
+
+        Returns None if the file doesn't exist, isn't valid JSON or is
+        larger than MAX_JSON_SIZE.
+        """
+        if rel_path not in self.__json:
+            data = self.head(rel_path, MAX_JSON_SIZE + 1)
+            value = None
+            if data is not None and len(data) <= MAX_JSON_SIZE:
+                try:
+                    value = json.loads(data)
+                except ValueError:
+                    pass
+            self.__json[rel_path] = value
+        return self.__json[rel_path]
+
+
+def _has_key(value, key):
+    keys = key.split('.') if isinstance(key, basestring) else key
+    for key in keys:
+        if not isinstance(value, dict) or key not in value:
+            return False
+        value = value[key]
+    return True
+
+
+def _check_rule(rule, scan):
+    if 'exists' in rule:
+        return scan.exists(rule['exists'])
+    elif 'glob' in rule:
+        rel_dir, pattern = os.path.split(rule['glob'])
+        return any(fnmatch.fnmatchcase(name, pattern)
+                   for name in scan.listdir(rel_dir))
+    elif 'regex' in rule:
+        data = scan.head(rule['file'], rule.get('bytes', DEFAULT_HEAD_SIZE))
+        return (data is not None and
+                re.search(rule['regex'], data, re.MULTILINE) is not None)
+    elif 'json' in rule:
+        value = scan.json(rule['json'])
+        return value is not None and _has_key(value, rule.get('key', []))
+    raise ValueError('unknown match rule {}'.format(json.dumps(rule)))
+
+
+def check_rules(rules, scan):
+    """Returns true if a source directory satisfies all of the rules.
+
+    Args:
+        rules: ([dict, ...]) The 'match' rules of an aggregator.
+        scan: (SourceScan) The source directory.
+
+    Raises:
+        ValueError: The rules are invalid.
+    """
+    try:
+        return all(_check_rule(rule, scan) for rule in rules)
+    except (KeyError, TypeError, AttributeError, re.error) as ex:
+        raise ValueError('invalid match rule: {}'.format(ex))
+
+
+def get_match_files(info):
+    """Returns the files that an aggregator's matches check looks at.
+
+    Args:
+        info: (dict) The aggregator info.
+
+    Returns:
+        ([str, ...]) The 'match_files' of the info followed by the files
+        named in its 'match' rules, as paths relative to a source directory.
+    """
+    files = list(info.get('match_files', []))
+    for rule in info.get('match', []):
+        for key in ('exists', 'file', 'json'):
+            path = rule.get(key)
+            if path and path not in files:
+                files.append(path)
+    return files
+
+
+def get_match_dirs(info):
+    """Returns the directories listed by an aggregator's glob rules.
+
+    Args:
+        info: (dict) The aggregator info.
+
+    Returns:
+        ([str, ...]) Paths relative to a source directory, '' for the source
+        directory itself.
+    """
+    return sorted(set(os.path.dirname(rule['glob'])
+                      for rule in info.get('match', []) if 'glob' in rule))
@@ -12,39 +12,119 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+
 """Utilities for dealing with child processes."""
 
+import collections
+import errno
 import fcntl
 import os
-import subprocess
+import re
 import select
+import time
+
+# Size of the reads from the child's output pipes.
+_READ_SIZE = 65536
+
+# Size of the writes to the child's input pipe.
+_WRITE_SIZE = 65536
+
+# Matches a complete line, including its newline.
+_LINE_RE = re.compile(r'[^\n]*\n')
 
 
 class _LineAccumulator(object):
-    """Accumulates data and calls a callback for every line."""
+    """Accumulates data and calls a callback for every line.
+
+    Data is collected in a bytearray, lines are split out of it in bulk every
+    time a chunk with a newline comes in.
+    """
 
-    def __init__(self, lineCallback):
-        self.__buffer = []
-        self.__cb = lineCallback
+    def __init__(self, line_callback=None, batch_callback=None):
+        """Constructor.
+
+        Args:
+            line_callback: (callable(str)) Called for every line.
+            batch_callback: (callable([str, ...])) If provided, this is called
+                with a list of all of the complete lines in a chunk of data
+                instead of calling 'line_callback' for each of them.
+        """
+        self.__buffer = bytearray()
+        self.__line_cb = line_callback
+        self.__batch_cb = batch_callback
+
+    def __emit(self, lines):
+        if self.__batch_cb:
+            self.__batch_cb(lines)
+        else:
+            for line in lines:
+                self.__line_cb(line)
 
     def add(self, data):
-        # If there is a newline, call the callback on the data we've got so
-        # far plus the newline.
-        newline_pos = data.find('\n') + 1
-        while newline_pos > 0:
-            line = ''.join(self.__buffer) + data[:newline_pos]
-            self.__buffer = []
-            self.__cb(line)
-            data = data[newline_pos:]
-            newline_pos = data.find('\n') + 1
-
-        # add whatever's leftover to the buffer.
-        if data:
-            self.__buffer.append(data)
+        buffer = self.__buffer
+        buffer.extend(data)
+
+        # Split out everything up to and including the last newline, leave
+        # the rest in the buffer.
+        end = buffer.rfind('\n') + 1
+        if end:
+            chunk = str(buffer[:end])
+            del buffer[:end]
+            self.__emit(_LINE_RE.findall(chunk))
 
     def finish(self):
-        self.__cb(''.join(self.__buffer))
-        self.__buffer = []
+        # Flush the final line if it wasn't newline terminated.
+        if self.__buffer:
+            self.__emit([str(self.__buffer)])
+            self.__buffer = bytearray()
+
+
+class _Poller(object):
+    """Minimal wrapper around epoll, falling back to poll."""
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.__impl = select.epoll()
+            self.__scale = 1
+            self.IN = select.EPOLLIN
+            self.OUT = select.EPOLLOUT
+            self.ERR = select.EPOLLERR | select.EPOLLHUP
+        else:
+            self.__impl = select.poll()
+            self.__scale = 1000
+            self.IN = select.POLLIN
+            self.OUT = select.POLLOUT
+            self.ERR = select.POLLERR | select.POLLHUP
+
+    def register(self, fd, events):
+        self.__impl.register(fd, events)
+
+    def modify(self, fd, events):
+        self.__impl.modify(fd, events)
+
+    def unregister(self, fd):
+        self.__impl.unregister(fd)
+
+    def poll(self, timeout=None):
+        """Returns a list of (fd, events) tuples.
+
+        Args:
+            timeout: (float or None) Seconds to wait, None to wait forever.
+        """
+        if timeout is None:
+            timeout = -1
+        else:
+            timeout *= self.__scale
+        while True:
+            try:
+                return self.__impl.poll(timeout)
+            except (IOError, select.error) as ex:
+                if ex.args[0] != errno.EINTR:
+                    raise
+
+    def close(self):
+        if hasattr(self.__impl, 'close'):
+            self.__impl.close()
 
 
 def _set_nonblocking(f):
@@ -52,65 +132,445 @@ def _set_nonblocking(f):
     flags = fcntl.fcntl(fd, fcntl.F_GETFL)
     fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
 
-def run(*args, **kwargs):
-    stdout_callback = kwargs.get('stdout_callback')
-    stderr_callback = kwargs.get('stderr_callback')
-    pipe_error = kwargs.get('pipe_error_callback')
-    stdin = kwargs.get('stdin')
-
-    # Define the accumulators to help us manage the process output.
-    stdout_accumulator = _LineAccumulator(stdout_callback)
-    stderr_accumulator = _LineAccumulator(stderr_callback)
-
-    proc = subprocess.Popen(args,
-                            stdout=subprocess.PIPE if stdout_callback else None,
-                            stderr=subprocess.PIPE if stderr_callback else
-                            None,
-                            stdin=subprocess.PIPE if stdin else None)
-    inputs = [proc.stdout, proc.stderr]
-    outputs = [proc.stdin] if stdin else []
-
-    # Make the inputs non-blocking
-    if stdout_callback:
-        _set_nonblocking(proc.stdout)
-    if stderr_callback:
-        _set_nonblocking(proc.stderr)
-
-    while inputs or outputs:
-        rdx, wrx, erx = select.select(inputs, outputs, inputs + outputs)
-
-        # Remove any error pipes from consideration.
-        for p in erx:
-            if pipe_error:
-                if p is proc.stderr:
-                    name = 'stderr'
-                elif p is proc.stdout:
-                    name = 'stdout'
-                elif p is proc.stdin:
-                    name = 'stdin'
-                pipe_error(name)
-            inputs.remove(p)
-
-        # Feed in the next chunk of standard input.
-        if wrx:
-            if stdin:
-                wrx[0].write(stdin[:1024])
-                wrx[0].flush()
-                stdin = stdin[1024:]
+
+class _Pipe(object):
+    """One of the pipes connected to a child process."""
+
+    def __init__(self, process, name, f, accumulator=None, data=None):
+        self.process = process
+        self.name = name
+        self.file = f
+        self.accumulator = accumulator
+
+        # For stdin, an iterator over the chunks of data to be written, the
+        # current chunk and our position in it.  We write from a memoryview
+        # so that we never have to copy what's left of a chunk.
+        if isinstance(data, basestring):
+            data = [data]
+        self.chunks = iter(data) if data is not None else None
+        self.chunk = memoryview('')
+        self.pos = 0
+
+        # For stdin that is kept open (see Process.write()), the chunks that
+        # have been written but not yet sent, and whether the pipe should be
+        # closed once they have been.
+        self.queue = None
+        self.closing = False
+
+    def next_data(self):
+        """Returns the next piece of input to write, None if there's no more.
+        """
+        while self.pos >= len(self.chunk):
+            if self.queue is not None:
+                if not self.queue:
+                    return None
+                self.chunk = memoryview(self.queue.popleft())
+            else:
+                try:
+                    self.chunk = memoryview(next(self.chunks))
+                except StopIteration:
+                    return None
+            self.pos = 0
+        return self.chunk[self.pos:self.pos + _WRITE_SIZE]
+
+
+class Process(object):
+    """A child process being run by a Runner.
+
+    The interface is similar to that of subprocess.Popen.  Polling or waiting
+    on a process runs the event loop of its Runner, so the output of all of
+    the other processes in the Runner continues to be processed.
+
+    Attributes:
+        args: ([str, ...]) The command line of the process.
+        pid: (int) The process id.
+        returncode: (int or None) The exit code of the process, None while it
+            is still running.  Negative for processes killed by a signal.
+        timed_out: (bool) True if the process was killed because it ran past
+            its timeout.
+        cancelled: (bool) True if the process was cancelled.
+        start_time: (float) When the process was started.
+        end_time: (float or None) When the process was found to have
+            completed.
+    """
+
+    def __init__(self, runner, popen, args, deadline):
+        self.__runner = runner
+        self.popen = popen
+        self.args = args
+        self.pid = popen.pid
+        self.deadline = deadline
+        self.returncode = None
+        self.timed_out = False
+        self.cancelled = False
+        self.open_pipes = 0
+        self.start_time = time.time()
+        self.end_time = None
+
+        # The standard input pipe of a 'stdin_open' process.
+        self.stdin_pipe = None
+
+    def poll(self):
+        """Returns the exit code of the process, None if it is still running.
+        """
+        if self.returncode is None:
+            self.__runner.step(0)
+        return self.returncode
+
+    def wait(self):
+        """Waits for the process to complete and returns its exit code."""
+        self.__runner.run_until(self)
+        return self.returncode
+
+    def cancel(self):
+        """Kills the process if it is still running."""
+        if self.returncode is None and not self.cancelled:
+            self.cancelled = True
+            self.__runner.kill(self)
+
+    kill = cancel
+
+    def write(self, data):
+        """Queues 'data' to be written to the standard input of the process.
+
+        Only valid for processes spawned with 'stdin_open'.  The data is
+        written by the event loop as the process consumes its input.
+
+        Args:
+            data: (str)
+        """
+        self.__runner.write(self, data)
+
+    def close_stdin(self):
+        """Closes standard input once everything written has been sent.
+
+        Only valid for processes spawned with 'stdin_open'.
+        """
+        self.__runner.close_stdin(self)
+
+
+class Runner(object):
+    """Runs any number of child processes concurrently.
+
+    All of the processes are driven from a single epoll based event loop
+    which feeds their input, splits their output into lines and enforces
+    their timeouts.
+
+    Usage:
+
+        runner = Runner()
+        procs = [runner.spawn('command', arg, stdout_callback=on_line)
+                 for arg in args]
+        runner.run()
+        codes = [proc.returncode for proc in procs]
+    """
+
+    # How often we check for the exit of processes that have closed all of
+    # their pipes.
+    _REAP_INTERVAL = 0.01
+
+    def __init__(self, output_callback=None):
+        """Constructor.
+
+        Args:
+            output_callback: (callable(Process, str, str)) If provided, the
+                output of all processes that don't have their own callbacks
+                is captured and this is called with the process, the stream
+                name ('stdout' or 'stderr') and the line for every line of
+                it, multiplexing the output of all of the processes.
+                Otherwise the output of such processes is inherited from
+                this process.
+        """
+        self.__output_callback = output_callback
+        self.__poller = _Poller()
+        self.__pipes = {}
+        self.__processes = []
+
+    def spawn(self, *args, **kwargs):
+        """Starts a child process.
+
+        Args:
+            *args: The command line of the process.
+            **kwargs: keyword arguments:
+                stdin, stdout_callback, stderr_callback,
+                stdout_batch_callback, stderr_batch_callback,
+                pipe_error_callback: As for run().  In addition to a
+                    string, 'stdin' may be an iterable of strings which are
+                    written as the process is ready to consume them.  The
+                    iterable may block, but that will stall the event loop.
+                stdin_file: (file or int) If provided instead of 'stdin',
+                    the process reads its standard input from this file.
+                stdout_file: (file or int) If provided instead of the stdout
+                    callbacks, the process writes its standard output to
+                    this file.
+                stderr_file: (file or int) Like 'stdout_file' for standard
+                    error.
+                stdin_open: (bool) If true, the standard input of the
+                    process is kept open, 'stdin' (if any) is written first
+                    and more can be written with Process.write() until
+                    Process.close_stdin() is called.
+                timeout: (float) If provided, the process is killed after
+                    this many seconds.
+                env: (dict) Environment of the process.
+                cwd: (str) Working directory of the process.
+
+        Returns:
+            (Process)
+        """
+        stdin = kwargs.get('stdin')
+        stdin_open = kwargs.get('stdin_open')
+
+        # The process object doesn't exist until we've started the process,
+        # the output callback gets it from here.
+        process_holder = []
+
+        callbacks = {}
+        for name in ('stdout', 'stderr'):
+            line_cb = kwargs.get(name + '_callback')
+            batch_cb = kwargs.get(name + '_batch_callback')
+            if not (line_cb or batch_cb) and self.__output_callback:
+                line_cb = self.__make_output_callback(process_holder, name)
+            if line_cb or batch_cb:
+                callbacks[name] = (line_cb, batch_cb)
+
+        # subprocess is imported on demand, it's slow to import and not every
+        # sxc command starts processes.
+        import subprocess
+        popen = subprocess.Popen(
+            args,
+            stdout=(subprocess.PIPE if 'stdout' in callbacks else
+                    kwargs.get('stdout_file')),
+            stderr=(subprocess.PIPE if 'stderr' in callbacks else
+                    kwargs.get('stderr_file')),
+            stdin=(subprocess.PIPE if stdin or stdin_open else
+                   kwargs.get('stdin_file')),
+            env=kwargs.get('env'),
+            cwd=kwargs.get('cwd'),
+            close_fds=True)
+        timeout = kwargs.get('timeout')
+        process = Process(self, popen, args,
+                          time.time() + timeout if timeout else None)
+        process.pipe_error_callback = kwargs.get('pipe_error_callback')
+        process_holder.append(process)
+        self.__processes.append(process)
+
+        poller = self.__poller
+        if 'stdout' in callbacks:
+            self.__add_pipe(
+                _Pipe(process, 'stdout', popen.stdout,
+                      accumulator=_LineAccumulator(*callbacks['stdout'])),
+                poller.IN | poller.ERR)
+        if 'stderr' in callbacks:
+            self.__add_pipe(
+                _Pipe(process, 'stderr', popen.stderr,
+                      accumulator=_LineAccumulator(*callbacks['stderr'])),
+                poller.IN | poller.ERR)
+        if stdin_open:
+            pipe = _Pipe(process, 'stdin', popen.stdin)
+            pipe.queue = collections.deque([stdin] if stdin else [])
+            self.__add_pipe(pipe, poller.OUT | poller.ERR)
+            process.stdin_pipe = pipe
+        elif stdin:
+            self.__add_pipe(_Pipe(process, 'stdin', popen.stdin, data=stdin),
+                            poller.OUT | poller.ERR)
+        return process
+
+    def __make_output_callback(self, process_holder, name):
+        output_callback = self.__output_callback
+        def callback(line):
+            output_callback(process_holder[0], name, line)
+        return callback
+
+    def __add_pipe(self, pipe, events):
+        _set_nonblocking(pipe.file)
+        fd = pipe.file.fileno()
+        self.__pipes[fd] = pipe
+        self.__poller.register(fd, events)
+        pipe.process.open_pipes += 1
+
+    def __close_pipe(self, fd):
+        pipe = self.__pipes.pop(fd)
+        self.__poller.unregister(fd)
+        if pipe.accumulator:
+            pipe.accumulator.finish()
+        pipe.file.close()
+        pipe.process.open_pipes -= 1
+
+    def __pipe_error(self, fd):
+        pipe = self.__pipes[fd]
+        if pipe.process.pipe_error_callback:
+            pipe.process.pipe_error_callback(pipe.name)
+        self.__close_pipe(fd)
+
+    def write(self, process, data):
+        """Queues data for the standard input of a 'stdin_open' process."""
+        pipe = process.stdin_pipe
+        if pipe.closing or pipe.file.closed:
+            raise IOError(errno.EPIPE, 'Standard input of {} is closed'.format(
+                process.args[0]))
+        if data:
+            pipe.queue.append(data)
+            self.__poller.modify(pipe.file.fileno(),
+                                 self.__poller.OUT | self.__poller.ERR)
+
+    def close_stdin(self, process):
+        """Closes the standard input of a 'stdin_open' process when drained.
+        """
+        pipe = process.stdin_pipe
+        if pipe.file.closed:
+            return
+        pipe.closing = True
+        self.__poller.modify(pipe.file.fileno(),
+                             self.__poller.OUT | self.__poller.ERR)
+
+    def __handle_stdin(self, fd, events):
+        pipe = self.__pipes[fd]
+        if not events & self.__poller.OUT:
+            # The other end has gone away.
+            self.__close_pipe(fd)
+            return
+        data = pipe.next_data()
+        if data is None:
+            if pipe.queue is not None and not pipe.closing:
+                # Wait for more to be written, but still notice hangups.
+                self.__poller.modify(fd, self.__poller.ERR)
             else:
-                wrx[0].close()
-                outputs = []
-
-        # Read everything from the process.
-        for p in rdx:
-            data = os.read(p.fileno(), 1024)
-            if p is proc.stdout:
-                stdout_accumulator.add(data)
+                self.__close_pipe(fd)
+            return
+        try:
+            pipe.pos += os.write(fd, data)
+        except OSError as ex:
+            if ex.errno == errno.EAGAIN:
+                return
+            elif ex.errno == errno.EPIPE:
+                # The process won't take any more input.
+                self.__close_pipe(fd)
             else:
-                stderr_accumulator.add(data)
-            if not data:
-                inputs.remove(p)
+                self.__pipe_error(fd)
+
+    def __handle_output(self, fd):
+        # Read whatever's available, hangups still leave data in the pipe.
+        try:
+            data = os.read(fd, _READ_SIZE)
+        except OSError as ex:
+            if ex.errno != errno.EAGAIN:
+                self.__pipe_error(fd)
+            return
+        if data:
+            self.__pipes[fd].accumulator.add(data)
+        else:
+            self.__close_pipe(fd)
+
+    def kill(self, process):
+        """Kills a process and stops processing its input and output."""
+        try:
+            process.popen.kill()
+        except OSError:
+            # Already gone.
+            pass
+
+        # Don't wait for EOF, the process may have children holding its
+        # pipes open.
+        for fd, pipe in self.__pipes.items():
+            if pipe.process is process:
+                self.__close_pipe(fd)
+
+    def __get_poll_timeout(self, timeout):
+        """Returns how long the next poll may block."""
+        now = time.time()
+        for process in self.__processes:
+            if process.deadline is not None:
+                remaining = max(process.deadline - now, 0)
+                timeout = (remaining if timeout is None else
+                           min(timeout, remaining))
+            if not process.open_pipes:
+                timeout = (self._REAP_INTERVAL if timeout is None else
+                           min(timeout, self._REAP_INTERVAL))
+        return timeout
+
+    def step(self, timeout=None):
+        """Runs a single iteration of the event loop.
+
+        Args:
+            timeout: (float or None) Maximum number of seconds to wait for
+                something to happen, None to wait indefinitely.
+        """
+        timeout = self.__get_poll_timeout(timeout)
+        if self.__pipes:
+            for fd, events in self.__poller.poll(timeout):
+                if fd not in self.__pipes:
+                    continue
+                elif self.__pipes[fd].name == 'stdin':
+                    self.__handle_stdin(fd, events)
+                else:
+                    self.__handle_output(fd)
+        elif timeout:
+            time.sleep(timeout)
+
+        # Enforce timeouts and collect the processes that have finished.
+        now = time.time()
+        for process in list(self.__processes):
+            if (process.deadline is not None and now >= process.deadline and
+                not process.timed_out):
+                process.timed_out = True
+                self.kill(process)
+            if not process.open_pipes:
+                returncode = process.popen.poll()
+                if returncode is not None:
+                    process.returncode = returncode
+                    process.end_time = now
+                    self.__processes.remove(process)
+
+    def run_until(self, process):
+        """Runs the event loop until 'process' has completed."""
+        while process.returncode is None:
+            self.step()
+
+    def run(self):
+        """Runs the event loop until all processes have completed."""
+        while self.__processes:
+            self.step()
+
+    def close(self):
+        """Kills any remaining processes and releases the event loop."""
+        for process in list(self.__processes):
+            process.cancel()
+            process.popen.wait()
+        self.__processes = []
+        self.__poller.close()
+
+
+def run(*args, **kwargs):
+    """Runs a child process, feeding it input and relaying its output.
+
+    Args:
+        *args: The command line of the process.
+        **kwargs: keyword arguments:
+            stdin: (str) If provided, this is written to the process' standard
+                input.
+            stdout_callback: (callable(str)) If provided, this is called for
+                every line that the process writes to standard output
+                (including the newline).  Otherwise standard output is
+                inherited from this process.
+            stderr_callback: (callable(str)) Like 'stdout_callback' for
+                standard error.
+            stdout_batch_callback: (callable([str, ...])) If provided, this
+                is called with lists of lines instead of calling
+                'stdout_callback' for every line.  This is considerably
+                cheaper for chatty processes.
+            stderr_batch_callback: (callable([str, ...])) Like
+                'stdout_batch_callback' for standard error.
+            pipe_error_callback: (callable(str)) Called with the name of the
+                pipe ('stdin', 'stdout' or 'stderr') if there is an error on
+                it.
+            timeout, env, cwd, stdin_file, stdout_file, stderr_file: As for
+                Runner.spawn().
 
-    stdout_accumulator.finish()
-    stderr_accumulator.finish()
-    return proc.wait()
+    Returns:
+        (int) The exit code of the process.
+    """
+    runner = Runner()
+    try:
+        return runner.spawn(*args, **kwargs).wait()
+    finally:
+        runner.close()
@@ -0,0 +1,431 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""The sxc server and the client that forwards commands to it.
+
+The server ('sxc serve') is an opt-in, long-lived process that keeps the
+python interpreter, the sxc modules, the extension registry and a core per
+source directory warm.  While it's running, the sxc script forwards commands
+to it over a Unix domain socket instead of running them itself.
+
+Every command runs in a child forked from the server, in the directory and
+with the environment of the client, so commands are isolated from each other
+and any number of them can run at once.  The standard output and error of
+the child are pipes, and everything written to them (by the command or by
+the hooks that it runs) is streamed back to the client.
+
+Protocol: the client sends a single line containing a JSON request:
+{"argv": [...], "cwd": ..., "env": {...}, "tty": [<stdout>, <stderr>]}
+where 'tty' says whether the client's stdout and stderr are terminals.  The
+server replies with frames consisting of a one byte channel ('o' for stdout,
+'e' for stderr and 'x' for the exit status), a four byte big-endian length
+and the payload.  The exit status frame is the last one.
+
+This module is imported by every sxc invocation, so it only imports what the
+client needs.
+"""
+
+import errno
+import json
+import os
+import socket
+import struct
+import sys
+
+from sxc import cache
+
+# Environment variable that overrides the path of the server socket.
+SOCKET_ENV = 'SXC_SERVER_SOCKET'
+
+# Environment variable that disables forwarding commands to the server.
+NO_SERVER_ENV = 'SXC_NO_SERVER'
+
+_FRAME_HEADER = struct.Struct('!cI')
+
+# The SO_PEERCRED socket option, which the socket module of python 2 doesn't
+# define.  It's only available on Linux.
+_SO_PEERCRED = getattr(socket, 'SO_PEERCRED',
+                       17 if sys.platform.startswith('linux') else None)
+_PEERCRED = struct.Struct('3i')
+
+
+def get_socket_path():
+    """Returns the path of the server socket."""
+    return (os.environ.get(SOCKET_ENV) or
+            os.path.join(cache.get_cache_root(), 'server.sock'))
+
+
+def _recv_exactly(sock, size):
+    """Returns 'size' bytes read from 'sock', less at the end of the stream.
+    """
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _send_frame(sock, channel, data):
+    sock.sendall(_FRAME_HEADER.pack(channel, len(data)) + data)
+
+
+def _connect(socket_path):
+    """Returns a socket connected to the server, None if it isn't running."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        # Whatever the reason (no server, or a socket path that can't be
+        # used at all), the command can still run without the server.
+        sock.close()
+        return None
+    return sock
+
+
+def _get_peer_uid(conn):
+    """Returns the user id of the process at the other end of 'conn'.
+
+    Returns:
+        (int or None) the uid, None if the platform can't tell.
+    """
+    if _SO_PEERCRED is None:
+        return None
+    creds = conn.getsockopt(socket.SOL_SOCKET, _SO_PEERCRED, _PEERCRED.size)
+    return _PEERCRED.unpack(creds)[1]
+
+
+def forward(argv):
+    """Runs a command in the server, if it's running.
+
+    Args:
+        argv: ([str, ...]) The command line of the sxc script.
+
+    Returns:
+        (int or None) the exit status of the command, None if the command
+        wasn't forwarded because there is no server (or it's disabled or
+        this is the command that starts it).
+    """
+    if (os.environ.get(NO_SERVER_ENV) or
+        (len(argv) > 1 and argv[1] == 'serve')):
+        return None
+    sock = _connect(get_socket_path())
+    if sock is None:
+        return None
+
+    try:
+        # The server locates the extensions relative to the script, which
+        # has to be resolved in our directory.
+        argv = [os.path.abspath(argv[0])] + list(argv[1:])
+        request = {'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ),
+                   'tty': [sys.stdout.isatty(), sys.stderr.isatty()]}
+        sock.sendall(json.dumps(request) + '\n')
+        streams = {'o': sys.stdout, 'e': sys.stderr}
+        while True:
+            header = _recv_exactly(sock, _FRAME_HEADER.size)
+            if len(header) < _FRAME_HEADER.size:
+                sys.stderr.write('sxc: lost connection to the server\n')
+                return 1
+            channel, size = _FRAME_HEADER.unpack(header)
+            data = _recv_exactly(sock, size)
+            if channel == 'x':
+                return int(data)
+            stream = streams[channel]
+            stream.write(data)
+            stream.flush()
+    finally:
+        sock.close()
+
+
+class _ClientStream(object):
+    """sys.stdout or sys.stderr of a command run by the server.
+
+    This writes straight to the underlying file descriptor, which is
+    forwarded to the client by an _OutputPump, and reports whether the
+    client's stream is a terminal.
+    """
+
+    def __init__(self, fd, tty):
+        self.__fd = fd
+        self.__tty = tty
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        while data:
+            data = data[os.write(self.__fd, data):]
+
+    def flush(self):
+        pass
+
+    def fileno(self):
+        return self.__fd
+
+    def isatty(self):
+        return self.__tty
+
+
+class _OutputPump(object):
+    """Forwards the standard output and error of a command to the client.
+
+    File descriptors 1 and 2 are replaced with pipes that a thread copies
+    to the client as 'o' and 'e' frames, so the output of the hooks that
+    inherit them is forwarded too.
+    """
+
+    def __init__(self, sock):
+        import threading
+        self.__sock = sock
+        self.__channels = {}
+        for fd, channel in ((1, 'o'), (2, 'e')):
+            read_fd, write_fd = os.pipe()
+            os.dup2(write_fd, fd)
+            os.close(write_fd)
+            self.__channels[read_fd] = channel
+        self.__wake_read, self.__wake_write = os.pipe()
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __forward(self, fd):
+        """Forwards what can be read from 'fd', returns false at EOF."""
+        data = os.read(fd, 65536)
+        if data:
+            _send_frame(self.__sock, self.__channels[fd], data)
+        return bool(data)
+
+    def __run(self):
+        import fcntl
+        import select
+        fds = list(self.__channels) + [self.__wake_read]
+        while True:
+            try:
+                readable = select.select(fds, [], [])[0]
+            except select.error as ex:
+                if ex.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self.__wake_read in readable:
+                break
+            for fd in readable:
+                if not self.__forward(fd):
+                    fds.remove(fd)
+
+        # The command has completed.  Forward what's left, without waiting
+        # for any processes that it has left running to close the pipes.
+        for fd in self.__channels:
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            try:
+                while self.__forward(fd):
+                    pass
+            except OSError as ex:
+                if ex.errno != errno.EAGAIN:
+                    raise
+
+    def close(self):
+        """Forwards everything written so far and stops forwarding."""
+        os.write(self.__wake_write, 'x')
+        self.__thread.join()
+
+
+class Server(object):
+    """Runs commands on behalf of clients.
+
+    The server keeps a core for every (extensions dir, source dir, cache)
+    combination that it has seen, with its extensions loaded, and forks a
+    child to run each command with it.
+    """
+
+    def __init__(self, socket_path=None):
+        """Constructor.
+
+        Args:
+            socket_path: (str or None) Path of the socket to listen on,
+                defaults to get_socket_path().
+        """
+        self.socket_path = socket_path or get_socket_path()
+        self.__cores = {}
+        self.__sock = None
+
+    def __get_core(self, extensions_dir, source_dir):
+        from sxc.core import StandardCore
+        key = (extensions_dir, source_dir, cache.get_cache_root())
+        core = self.__cores.get(key)
+        if core is None:
+            core = self.__cores[key] = StandardCore(extensions_dir,
+                                                    source_dir=source_dir)
+        else:
+            core.refresh()
+
+        # Load the extensions now so that the children don't have to.
+        core.load_plugins()
+        return core
+
+    def listen(self):
+        """Binds the server socket.
+
+        Commands run with the privileges of the server, so only its user may
+        connect: the socket is only accessible to them, and so is its
+        directory when the server creates it.
+
+        Raises:
+            socket.error: if another server is already listening on it.
+        """
+        existing = _connect(self.socket_path)
+        if existing:
+            existing.close()
+            raise socket.error(errno.EADDRINUSE,
+                               'A server is already running on {}'.format(
+                                   self.socket_path))
+        if os.path.exists(self.socket_path):
+            # Left over from a server that didn't exit cleanly.
+            os.unlink(self.socket_path)
+        socket_dir = os.path.dirname(os.path.abspath(self.socket_path))
+        if not os.path.isdir(socket_dir):
+            os.makedirs(socket_dir, 0700)
+        self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Create the socket without any permissions for others, there would
+        # be a window between bind() and chmod() otherwise.
+        umask = os.umask(0177)
+        try:
+            self.__sock.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        self.__sock.listen(64)
+
+    def serve_forever(self):
+        """Accepts and runs commands until interrupted."""
+        import signal
+
+        # Let the kernel reap the children, and remove the socket when
+        # terminated.
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while True:
+                try:
+                    conn, addr = self.__sock.accept()
+                except socket.error as ex:
+                    if ex.errno == errno.EINTR:
+                        continue
+                    raise
+                try:
+                    self.__handle(conn)
+                finally:
+                    conn.close()
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops listening and removes the socket."""
+        if self.__sock:
+            self.__sock.close()
+            self.__sock = None
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+    def __read_request(self, conn):
+        data = []
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                return None
+            data.append(chunk)
+            if chunk.endswith('\n'):
+                return json.loads(''.join(data))
+
+    def __handle(self, conn):
+        # The socket permissions should keep other users out, but don't rely
+        # on them alone (the socket's directory may be shared).
+        peer_uid = _get_peer_uid(conn)
+        if peer_uid is not None and peer_uid != os.getuid():
+            sys.stderr.write('sxc server: refused a connection from '
+                             'uid {}\n'.format(peer_uid))
+            return
+        request = self.__read_request(conn)
+        if request is None:
+            return
+        from sxc import command
+        from sxc import extlib
+        request = extlib.utf8_strings(request)
+
+        # Prepare the core in the server so that it stays warm.
+        saved_environ = dict(os.environ)
+        os.environ.clear()
+        os.environ.update(request['env'])
+        argv = request['argv']
+        argv[0] = os.path.join(request['cwd'], argv[0])
+        try:
+            core = self.__get_core(command.get_extensions_dir(argv),
+                                   request['cwd'])
+        except Exception as ex:
+            _send_frame(conn, 'e', 'sxc server: {}\n'.format(ex))
+            _send_frame(conn, 'x', '1')
+            return
+        finally:
+            os.environ.clear()
+            os.environ.update(saved_environ)
+
+        if os.fork():
+            return
+
+        # The child runs the command.
+        import signal
+        import traceback
+        status = 1
+        try:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            self.__sock.close()
+            os.environ.clear()
+            os.environ.update(request['env'])
+            os.chdir(request['cwd'])
+            pump = _OutputPump(conn)
+            sys.stdout = _ClientStream(1, request['tty'][0])
+            sys.stderr = _ClientStream(2, request['tty'][1])
+            try:
+                status = command.run(core, argv) or 0
+            except Exception:
+                sys.stderr.write(traceback.format_exc())
+            pump.close()
+            _send_frame(conn, 'x', str(status))
+        finally:
+            os._exit(status)
+
+
+def serve(socket_path=None):
+    """Runs the server until it's interrupted.
+
+    Returns:
+        (int) the exit status for the server process.
+    """
+    server = Server(socket_path)
+    try:
+        server.listen()
+    except socket.error as ex:
+        sys.stderr.write('sxc: {}\n'.format(ex))
+        return 1
+    sys.stderr.write('sxc server listening on {}\n'.format(
+        server.socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
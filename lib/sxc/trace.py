@@ -0,0 +1,119 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Tracing of sxc runs.
+
+When tracing is enabled, the core and its extensions record timed spans which
+can be written out in the Chrome trace event format and viewed with
+chrome://tracing or Perfetto.  Extensions record spans with extlib.span(),
+which reports them to the core as 'span' messages.
+
+Spans are recorded with wall clock timestamps so that spans from different
+processes line up.  Every process (the core and each hook) gets its own track.
+"""
+
+import contextlib
+import json
+import os
+import time
+
+# Environment variable that is set for hooks when tracing is enabled.
+TRACE_ENV = 'SXC_TRACE'
+
+# The recorded trace events, None when tracing is disabled.
+_events = None
+
+
+def enable():
+    """Starts recording spans.
+
+    This also enables tracing in all hooks started after this.
+    """
+    global _events
+    if _events is None:
+        _events = []
+        os.environ[TRACE_ENV] = '1'
+        set_track_name(os.getpid(), 'sxc')
+
+
+def disable():
+    """Stops recording spans and discards the recorded ones."""
+    global _events
+    _events = None
+    os.environ.pop(TRACE_ENV, None)
+
+
+def is_enabled():
+    """Returns true if spans are being recorded."""
+    return _events is not None
+
+
+def add_span(name, start, end, track=None, args=None):
+    """Records a span.
+
+    Does nothing if tracing is disabled.
+
+    Args:
+        name: (str) Name of the span.
+        start: (float) Start time in seconds since the epoch.
+        end: (float) End time in seconds since the epoch.
+        track: (int or None) Track to record the span on, usually the pid of
+            the process that it belongs to.  Defaults to this process.
+        args: (dict or None) Additional information to attach to the span.
+    """
+    if _events is None:
+        return
+    _events.append({'name': name, 'ph': 'X', 'pid': os.getpid(),
+                    'tid': track or os.getpid(),
+                    'ts': int(start * 1000000),
+                    'dur': int((end - start) * 1000000),
+                    'args': args or {}})
+
+
+def set_track_name(track, name):
+    """Sets the display name of a track.
+
+    Args:
+        track: (int) The track, usually a pid.
+        name: (str) The name.
+    """
+    if _events is None:
+        return
+    _events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                    'tid': track, 'args': {'name': name}})
+
+
+@contextlib.contextmanager
+def span(name, track=None, **args):
+    """Records a span covering the body of a 'with' statement.
+
+    Args:
+        name: (str) Name of the span.
+        track: (int or None) As for add_span().
+        **args: Additional information to attach to the span.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_span(name, start, time.time(), track=track, args=args)
+
+
+def write(path):
+    """Writes the recorded trace to 'path' in the Chrome trace event format.
+    """
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': _events or [],
+                   'displayTimeUnit': 'ms'}, f)
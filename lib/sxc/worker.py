@@ -0,0 +1,288 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Long-lived extension workers.
+
+An extension can serve some of its hooks from a single long-lived process
+instead of having a program started for every call.  It declares the hooks
+that its worker serves in the 'worker' key of its data/info.json file:
+
+    "worker": ["matches", "genimage", "dump"]
+
+and provides a bin/worker program, normally built on extlib.serve_worker().
+The core starts the worker the first time that one of these hooks is called
+and sends it all subsequent calls.  Any other hooks are run as programs.
+
+The protocol is newline-delimited JSON.  The core writes requests to the
+standard input of the worker:
+
+    {"type": "call", "id": <int>, "hook": <hook name>, "args": [...],
+     "input": <standard input of the hook, optional>,
+     "env": <environment of the hook, optional>}
+    {"type": "cancel", "id": <int>}
+
+The worker handles calls one at a time, in the order they were sent.  It
+replies on its standard output with the messages that the hook program
+would have written ('info', 'warn', 'error', 'result' and 'span'), each
+with the "id" of the call, followed by:
+
+    {"type": "output", "id": <int>, "data": <any other output of the hook>}
+    {"type": "done", "id": <int>, "status": <exit status of the hook>}
+
+where "output" is optional and "done" is the last reply to a call.  The
+"data" of "output" is base64 encoded since hooks may write any bytes.  What
+the worker writes to standard error is attributed to the call being handled.
+Calls that are cancelled before the worker starts them complete with a
+status of CANCELLED_STATUS without being run, calls that are already running
+are left to finish but their replies are dropped.  The worker exits when its
+standard input is closed.
+"""
+
+import base64
+import collections
+import json
+import os
+import signal
+import sys
+import time
+
+# Exit status of cancelled calls, the same as for a killed hook program.
+CANCELLED_STATUS = -signal.SIGKILL
+
+
+def _emit(callbacks, lines):
+    """Passes lines of output to (line_callback, batch_callback)."""
+    line_callback, batch_callback = callbacks
+    if batch_callback:
+        batch_callback(lines)
+    else:
+        for line in lines:
+            line_callback(line)
+
+
+class WorkerCall(object):
+    """A hook call being handled by a worker.
+
+    This has the interface of .proclib.Process, so callers don't need to
+    know whether a hook is run by a worker or as a program.  The output of
+    the call is passed to the callbacks as the output of the hook program
+    would be.
+
+    Attributes:
+        args: ([str, ...]) The path of the hook followed by its arguments.
+        pid: (int) The process id of the worker.
+        returncode: (int or None) The exit status of the hook, None while it
+            is still running.
+        timed_out: (bool) True if the worker was killed because the call ran
+            past its timeout.
+        cancelled: (bool) True if the call was cancelled.
+        start_time: (float) When the call was sent.
+        end_time: (float or None) When the call was found to have completed.
+    """
+
+    def __init__(self, worker, id, args, callbacks, deadline):
+        self.__worker = worker
+        self.id = id
+        self.args = args
+        self.pid = worker.process.pid
+        self.returncode = None
+        self.timed_out = False
+        self.cancelled = False
+        self.start_time = time.time()
+        self.end_time = None
+        self.deadline = deadline
+        self.callbacks = callbacks
+
+    def complete(self, status):
+        """Records the exit status of the call, if it isn't done already."""
+        if self.returncode is None:
+            self.returncode = status
+            self.end_time = time.time()
+
+    def handle_reply(self, reply):
+        """Handles a reply from the worker other than 'done'."""
+        if self.returncode is not None:
+            return
+        if reply.get('type') == 'output':
+            lines = base64.b64decode(reply.get('data', '')).splitlines(True)
+            if lines:
+                _emit(self.callbacks['stdout'], lines)
+        else:
+            # Pass the message on as the hook program would have written it.
+            del reply['id']
+            _emit(self.callbacks['stdout'], [json.dumps(reply) + '\n'])
+
+    def handle_stderr(self, lines):
+        if self.returncode is None:
+            _emit(self.callbacks['stderr'], lines)
+
+    def poll(self):
+        """Returns the exit status of the call, None if it is still running.
+        """
+        if self.returncode is None:
+            self.__worker.step(0)
+        return self.returncode
+
+    def wait(self):
+        """Waits for the call to complete and returns its exit status."""
+        while self.returncode is None:
+            timeout = None
+            if self.deadline is not None:
+                timeout = self.deadline - time.time()
+                if timeout <= 0:
+                    # The worker is stuck on this call, kill it.  The next
+                    # call will start a new one.
+                    self.timed_out = True
+                    self.__worker.kill()
+                    break
+            self.__worker.step(timeout)
+        return self.returncode
+
+    def cancel(self):
+        """Cancels the call if it is still running."""
+        if self.returncode is None and not self.cancelled:
+            self.cancelled = True
+            self.__worker.cancel(self)
+            self.complete(CANCELLED_STATUS)
+
+    kill = cancel
+
+
+class Worker(object):
+    """A running worker program and the calls that it has been sent."""
+
+    def __init__(self, runner, path, error_callback=None, env=None):
+        """Constructor.
+
+        Args:
+            runner: (.proclib.Runner) Runs the worker process.
+            path: (str) Path to the worker program.
+            error_callback: (callable(str)) Called for lines of output from
+                the worker that aren't replies to a call.  They're written
+                to standard error if this isn't provided.
+            env: (dict or None) Environment of the worker process.
+        """
+        self.path = path
+        self.__runner = runner
+        self.__error_callback = error_callback or sys.stderr.write
+        self.__next_id = 1
+
+        # The calls that haven't been completed by the worker, in the order
+        # they were sent, and the same calls by id.
+        self.__calls = collections.deque()
+        self.__calls_by_id = {}
+
+        self.process = runner.spawn(path, stdin_open=True,
+                                    stdout_callback=self.__on_stdout_line,
+                                    stderr_batch_callback=self.__on_stderr,
+                                    env=env)
+
+    def is_running(self):
+        """Returns true if the worker process is still running."""
+        return self.process.poll() is None and not self.process.cancelled
+
+    def call(self, hook_name, args, **kwargs):
+        """Sends a hook call to the worker.
+
+        Args:
+            hook_name: (str) The name of the hook.
+            args: ([str, ...]) The arguments of the hook.
+            **kwargs: The keyword arguments of .proclib.Runner.spawn(),
+                'stdin', 'env', 'timeout' and the stdout and stderr
+                callbacks are supported.  Output without callbacks is
+                written to our own standard output or error.
+
+        Returns:
+            (WorkerCall)
+        """
+        callbacks = {}
+        for name, stream in (('stdout', sys.stdout), ('stderr', sys.stderr)):
+            callbacks[name] = (kwargs.get(name + '_callback') or stream.write,
+                               kwargs.get(name + '_batch_callback'))
+        timeout = kwargs.get('timeout')
+        id = self.__next_id
+        self.__next_id += 1
+        call = WorkerCall(
+            self, id,
+            [os.path.join(os.path.dirname(self.path), hook_name)] + list(args),
+            callbacks, time.time() + timeout if timeout else None)
+
+        request = {'type': 'call', 'id': id, 'hook': hook_name,
+                   'args': list(args)}
+        if kwargs.get('stdin') is not None:
+            request['input'] = kwargs['stdin']
+        if kwargs.get('env') is not None:
+            request['env'] = kwargs['env']
+        self.__calls.append(call)
+        self.__calls_by_id[id] = call
+        self.__send(request)
+        return call
+
+    def __send(self, request):
+        try:
+            self.process.write(json.dumps(request) + '\n')
+        except IOError:
+            # The worker has exited, step() will fail the pending calls.
+            pass
+
+    def cancel(self, call):
+        """Tells the worker not to run 'call' if it hasn't started it."""
+        self.__send({'type': 'cancel', 'id': call.id})
+
+    def kill(self):
+        """Kills the worker, failing all calls in progress."""
+        self.process.kill()
+        self.__fail_calls(CANCELLED_STATUS)
+
+    def close(self):
+        """Lets the worker exit once it has handled all calls."""
+        if self.process.stdin_pipe and not self.process.stdin_pipe.closing:
+            self.process.close_stdin()
+
+    def step(self, timeout=None):
+        """Runs the event loop, completing calls as the worker replies."""
+        self.__runner.step(timeout)
+        if self.process.returncode is not None:
+            self.__fail_calls(self.process.returncode or 1)
+
+    def __fail_calls(self, status):
+        while self.__calls:
+            call = self.__calls.popleft()
+            del self.__calls_by_id[call.id]
+            call.complete(status)
+
+    def __on_stdout_line(self, line):
+        try:
+            obj = json.loads(line)
+        except ValueError:
+            obj = None
+        call = (self.__calls_by_id.get(obj.get('id'))
+                if isinstance(obj, dict) else None)
+        if call is None:
+            self.__error_callback('{}: {}'.format(self.path, line))
+        elif obj.get('type') == 'done':
+            self.__calls.remove(call)
+            del self.__calls_by_id[call.id]
+            call.complete(obj.get('status', 1))
+        else:
+            call.handle_reply(obj)
+
+    def __on_stderr(self, lines):
+        # Calls are handled in order, so this is from the first one.
+        if self.__calls:
+            self.__calls[0].handle_stderr(lines)
+        else:
+            self.__error_callback(''.join(
+                '{}: {}'.format(self.path, line) for line in lines))
@@ -0,0 +1,143 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Tests for running sxc over many projects at once."""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from sxc import batch
+
+EXTENSIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              os.pardir, 'extensions')
+
+
+def _describe(core, tag):
+    source_dir = core.get_source_directory()
+    if os.path.basename(source_dir) == 'broken':
+        raise ValueError('broken project')
+    return {'status': 'ok', 'tag': tag, 'pid': os.getpid(),
+            'source_dir': source_dir}
+
+
+class FindProjectsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, contents=''):
+        path = os.path.join(self.tmp, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def find(self):
+        return [os.path.relpath(path, self.tmp) for path in
+                batch.find_projects(self.tmp, ['package.json', 'app.yaml'])]
+
+    def test_nested_projects(self):
+        self.write('package.json')
+        self.write('services/api/app.yaml')
+        self.write('services/api/worker/package.json')
+        self.write('services/web/package.json')
+        self.write('services/README')
+        self.assertEqual(['.', 'services/api', 'services/api/worker',
+                          'services/web'], self.find())
+
+    def test_ignored_dirs(self):
+        self.write('.gitignore', 'build/\n')
+        self.write('build/package.json')
+        self.write('.hidden/package.json')
+        self.write('web/package.json')
+        self.write('web/node_modules/dep/package.json')
+        self.write('web/.sxcignore', 'fixtures/\n')
+        self.write('web/fixtures/package.json')
+        self.write('env/pyvenv.cfg')
+        self.write('env/lib/app.yaml')
+        # Nested ignore files only apply below their directory.
+        self.write('other/fixtures/app.yaml')
+        self.assertEqual(['other/fixtures', 'web'], self.find())
+
+    def test_symlinked_dirs(self):
+        self.write('web/package.json')
+        os.symlink(os.path.join(self.tmp, 'web'),
+                   os.path.join(self.tmp, 'link'))
+        self.assertEqual(['web'], self.find())
+
+
+class RunTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['SXC_CACHE_DIR'] = os.path.join(self.tmp, 'cache')
+        self.projects = []
+        for name in ('a', 'b', 'c', 'broken'):
+            path = os.path.join(self.tmp, name)
+            os.mkdir(path)
+            self.projects.append(path)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp)
+
+    def check_results(self, results):
+        self.assertEqual(sorted(self.projects), sorted(results))
+        for source_dir, summary in results.iteritems():
+            self.assertIn('time', summary)
+            if source_dir.endswith('broken'):
+                self.assertEqual('error', summary['status'])
+                self.assertEqual('ValueError: broken project',
+                                 summary['error'])
+            else:
+                self.assertEqual('ok', summary['status'])
+                self.assertEqual('tag', summary['tag'])
+                self.assertEqual(source_dir, summary['source_dir'])
+
+    def test_pool(self):
+        results = dict(batch.run(EXTENSIONS_DIR, self.projects, _describe,
+                                 ('tag',), jobs=2))
+        self.check_results(results)
+        # The projects ran in worker processes.
+        self.assertNotIn(os.getpid(), [summary.get('pid')
+                                       for summary in results.itervalues()])
+
+    def test_single_job(self):
+        results = dict(batch.run(EXTENSIONS_DIR, self.projects, _describe,
+                                 ('tag',), jobs=1))
+        self.check_results(results)
+        self.assertEqual(set([os.getpid(), None]),
+                         set(summary.get('pid')
+                             for summary in results.itervalues()))
+
+    def test_write_summary(self):
+        path = batch.write_summary(self.tmp, {'a': {'status': 'ok'}})
+        self.assertEqual(os.path.join(self.tmp, batch.SUMMARY_NAME), path)
+        with open(path) as f:
+            self.assertEqual({'root': self.tmp,
+                              'projects': {'a': {'status': 'ok'}}},
+                             json.load(f))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Tests for the argument handling of sxc commands."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from sxc import command
+from sxc.core import StandardCore
+
+
+class ParseTargetsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['SXC_CACHE_DIR'] = os.path.join(self.tmp, 'cache')
+        root = os.path.join(self.tmp, 'extensions')
+        for name in ('gaemvm', 'dovm'):
+            os.makedirs(os.path.join(root, 'actuators', name))
+        os.mkdir(os.path.join(root, 'aggregators'))
+        self.core = StandardCore(root, source_dir=self.tmp)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp)
+
+    def parse(self, args):
+        targets = command._parse_targets(self.core, args)
+        return targets and [(label, actuator.name, actuator_args)
+                            for label, actuator, actuator_args in targets]
+
+    def test_single_target(self):
+        self.assertEqual([('gaemvm', 'gaemvm', ['-n'])],
+                         self.parse(['gaemvm', '-n']))
+
+    def test_actuator_names_as_arguments(self):
+        self.assertEqual([('gaemvm', 'gaemvm', ['-s', 'dovm'])],
+                         self.parse(['gaemvm', '-s', 'dovm']))
+
+    def test_several_targets(self):
+        self.assertEqual(
+            [('gaemvm', 'gaemvm', ['-i']), ('dovm', 'dovm', ['-f']),
+             ('gaemvm#2', 'gaemvm', ['-i'])],
+            self.parse(['gaemvm', '-i', '+', 'dovm', '-f', '+', 'gaemvm',
+                        '-i']))
+
+    def test_bad_targets(self):
+        self.assertEqual(None, self.parse(['nope']))
+        self.assertEqual(None, self.parse(['gaemvm', '+']))
+        self.assertEqual(None, self.parse(['gaemvm', '+', '-n']))
+
+
+if __name__ == '__main__':
+    unittest.main()
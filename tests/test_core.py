@@ -0,0 +1,356 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for sxc.core."""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from sxc import cache
+from sxc import core
+from sxc import extlib
+from sxc import trace
+from sxc.core import HookError
+from sxc.core import StandardCore
+from sxc.core import StandardOutput
+from sxc.core import StandardUtils
+
+
+class DetectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['SXC_CACHE_DIR'] = os.path.join(self.tmp, 'cache')
+        self.root = os.path.join(self.tmp, 'extensions')
+        os.makedirs(os.path.join(self.root, 'actuators'))
+        self.source_dir = os.path.join(self.tmp, 'src')
+        os.mkdir(self.source_dir)
+        open(os.path.join(self.source_dir, 'both'), 'w').close()
+
+    def tearDown(self):
+        trace.disable()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp)
+
+    def add_aggregator(self, name, info=None, matches=None):
+        """Adds an aggregator with the given info and matches hook."""
+        root = os.path.join(self.root, 'aggregators', name)
+        os.makedirs(os.path.join(root, 'data'))
+        with open(os.path.join(root, 'data', 'info.json'), 'w') as f:
+            json.dump(dict(info or {}, name=name), f)
+        if matches is not None:
+            os.mkdir(os.path.join(root, 'bin'))
+            path = os.path.join(root, 'bin', 'matches')
+            with open(path, 'w') as f:
+                f.write('#!/bin/sh\n' + matches + '\n')
+            os.chmod(path, 0755)
+
+    def detect(self, hits):
+        cache.JSONStore('detection.json').save({'hits': hits})
+        core = StandardCore(self.root, source_dir=self.source_dir)
+        aggregator = core.find_aggregator()
+        return aggregator and aggregator.get_info(core)['name']
+
+    def test_history_does_not_change_the_winner(self):
+        rules = {'match': [{'exists': 'both'}]}
+        self.add_aggregator('alpha', rules)
+        self.add_aggregator('beta', rules)
+        self.assertEqual('alpha', self.detect({}))
+        self.assertEqual('alpha', self.detect({'beta': 100}))
+
+    def test_history_does_not_change_the_winner_of_hooks(self):
+        self.add_aggregator('alpha', matches='sleep 0.2; exit 0')
+        self.add_aggregator('beta', matches='exit 0')
+        self.add_aggregator('gamma', matches='exit 1')
+        self.assertEqual('alpha', self.detect({'beta': 100}))
+        self.assertEqual('alpha', self.detect({'gamma': 100}))
+
+    def test_priority_wins(self):
+        self.add_aggregator('alpha', {'match': [{'exists': 'both'}]})
+        self.add_aggregator('beta', {'priority': 1}, matches='exit 0')
+        self.assertEqual('beta', self.detect({'alpha': 100}))
+
+    def test_matches_hooks_are_traced(self):
+        self.add_aggregator('alpha', matches='exit 1')
+        self.add_aggregator('beta', matches='exit 0')
+        trace.enable()
+        self.assertEqual('beta', self.detect({}))
+        path = os.path.join(self.tmp, 'trace.json')
+        trace.write(path)
+        with open(path) as f:
+            spans = dict((event['name'], event['args'])
+                         for event in json.load(f)['traceEvents']
+                         if event['ph'] == 'X')
+        self.assertEqual(1, spans['alpha:matches']['returncode'])
+        self.assertEqual(0, spans['beta:matches']['returncode'])
+        self.assertEqual([self.source_dir], spans['beta:matches']['args'])
+
+    def test_dirs_are_bounded(self):
+        self.add_aggregator('alpha', {'match': [{'exists': 'both'}]})
+        dirs = {}
+        for name in ('a', 'b', 'c'):
+            dirs[name] = os.path.join(self.tmp, name)
+            os.mkdir(dirs[name])
+            open(os.path.join(dirs[name], 'both'), 'w').close()
+        store = cache.JSONStore('detection.json')
+        def detect(name):
+            StandardCore(self.root, source_dir=dirs[name]).find_aggregator()
+            return store.load()['dirs']
+        def set_used(name, used):
+            def update(state):
+                state['dirs'][dirs[name]]['used'] = used
+            store.update(update)
+
+        max_dirs = core._MAX_DETECTION_DIRS
+        core._MAX_DETECTION_DIRS = 2
+        try:
+            detect('a')
+            detect('b')
+            set_used('a', 1)
+            set_used('b', 2)
+
+            # Using the cached result of 'a' makes it the most recently used,
+            # so 'b' is forgotten first.
+            self.assertLess(2, detect('a')[dirs['a']]['used'])
+            self.assertEqual(sorted([dirs['a'], dirs['c']]),
+                             sorted(detect('c')))
+
+            # Recent results aren't marked again.
+            used = time.time() - 10
+            set_used('a', used)
+            self.assertEqual(used, detect('a')[dirs['a']]['used'])
+        finally:
+            core._MAX_DETECTION_DIRS = max_dirs
+
+    def test_no_match(self):
+        self.add_aggregator('alpha', {'match': [{'exists': 'missing'}]})
+        self.add_aggregator('beta', matches='exit 1')
+        self.assertEqual(None, self.detect({}))
+
+
+class IndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['SXC_CACHE_DIR'] = os.path.join(self.tmp, 'cache')
+        os.environ.pop(extlib.TREE_INDEX_ENV, None)
+        self.source_dir = os.path.join(self.tmp, 'src')
+        os.mkdir(self.source_dir)
+        open(os.path.join(self.source_dir, 'app.js'), 'w').close()
+        root = os.path.join(self.tmp, 'extensions')
+        os.makedirs(os.path.join(root, 'actuators'))
+        os.makedirs(os.path.join(root, 'aggregators', 'js', 'data'))
+        with open(os.path.join(root, 'aggregators', 'js', 'data',
+                               'info.json'), 'w') as f:
+            json.dump({'name': 'js', 'match': [{'exists': 'app.js'}]}, f)
+        self.core = StandardCore(root, source_dir=self.source_dir)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp)
+
+    def test_detection_does_not_index(self):
+        self.assertEqual('js', self.core.find_aggregator().get_info(
+            self.core)['name'])
+        self.assertNotIn(extlib.TREE_INDEX_ENV, os.environ)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.tmp, 'cache', 'index')))
+
+    def test_index(self):
+        index_dir = cache.get_cache_dir('index')
+        stale = os.path.join(index_dir, 'stale')
+        recent = os.path.join(index_dir, 'recent')
+        for path in (stale, recent):
+            open(path, 'w').close()
+        expired = time.time() - core._INDEX_MAX_AGE - 60
+        os.utime(stale, (expired, expired))
+
+        self.core.index_source_tree()
+        index = extlib.get_tree_index(self.source_dir)
+        self.assertEqual(['app.js'], [entry.path for entry in index])
+        self.assertEqual(
+            sorted(['recent', os.path.basename(
+                os.environ[extlib.TREE_INDEX_ENV])]),
+            sorted(os.listdir(index_dir)))
+
+
+PLUGIN = """
+import os
+from sxc import aggregator
+
+with open(os.path.join(os.path.dirname(__file__), 'loads'), 'a') as f:
+    f.write('loaded\\n')
+
+
+class Plugin(aggregator.AggregatorPlugin):
+
+    def generate_image(self, core):
+        return {{'files': [], 'run': 'plugin'}}
+
+
+def create(extension_root_dir):
+    return Plugin(extension_root_dir)
+
+{error}
+"""
+
+
+class PluginTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['SXC_CACHE_DIR'] = os.path.join(self.tmp, 'cache')
+        os.environ.pop(extlib.TREE_INDEX_ENV, None)
+        self.source_dir = os.path.join(self.tmp, 'src')
+        os.mkdir(self.source_dir)
+        open(os.path.join(self.source_dir, 'app.js'), 'w').close()
+        self.root = os.path.join(self.tmp, 'extensions')
+        os.makedirs(os.path.join(self.root, 'actuators'))
+        self.extension_dir = os.path.join(self.root, 'aggregators', 'js')
+        for name in ('bin', 'data', 'lib'):
+            os.makedirs(os.path.join(self.extension_dir, name))
+        with open(os.path.join(self.extension_dir, 'data', 'info.json'),
+                  'w') as f:
+            json.dump({'name': 'js', 'plugin': 'lib/plugin.py',
+                       'match': [{'exists': 'app.js'}]}, f)
+        hook = os.path.join(self.extension_dir, 'bin', 'genimage')
+        with open(hook, 'w') as f:
+            f.write('#!/bin/sh\necho \'{"files": [], "run": "hook"}\'\n')
+        os.chmod(hook, 0755)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp)
+
+    def write_plugin(self, error=''):
+        with open(os.path.join(self.extension_dir, 'lib', 'plugin.py'),
+                  'w') as f:
+            f.write(PLUGIN.format(error=error))
+
+    def loads(self):
+        try:
+            with open(os.path.join(self.extension_dir, 'lib', 'loads')) as f:
+                return len(f.readlines())
+        except IOError:
+            return 0
+
+    def generate_image(self):
+        core = StandardCore(self.root, source_dir=self.source_dir)
+        aggregator = core.find_aggregator()
+        self.assertEqual('js', aggregator.get_info(core)['name'])
+        self.assertEqual(0, self.loads())
+        return aggregator.generate_image(core)['run']
+
+    def test_in_process(self):
+        self.write_plugin()
+        self.assertEqual('plugin', self.generate_image())
+        self.assertEqual(1, self.loads())
+        self.assertEqual(['loads', 'plugin.py'],
+                         sorted(os.listdir(os.path.join(self.extension_dir,
+                                                        'lib'))))
+
+    def test_load_plugins(self):
+        self.write_plugin()
+        core = StandardCore(self.root, source_dir=self.source_dir)
+        self.assertEqual(['js'], [aggregator.get_info(core)['name']
+                                  for aggregator in core.get_aggregators()])
+        self.assertEqual(0, self.loads())
+        core.load_plugins()
+        core.load_plugins()
+        self.assertEqual(1, self.loads())
+
+    def test_fallback_to_hooks(self):
+        self.write_plugin(error='raise ImportError("no such module")')
+        self.assertEqual('hook', self.generate_image())
+        self.assertEqual(1, self.loads())
+
+    def test_create_fails(self):
+        self.write_plugin(error='Plugin = None')
+        self.assertEqual('hook', self.generate_image())
+
+
+class HookOutputTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp, 'bin'))
+        self.utils = StandardUtils(StandardOutput())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def add_hook(self, name, script):
+        path = os.path.join(self.tmp, 'bin', name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n' + script + '\n')
+        os.chmod(path, 0755)
+
+    def test_output(self):
+        self.add_hook('dump', 'echo \'{"args": "\'$1\'"}\'')
+        self.assertEqual({'args': 'a'},
+                         self.utils.get_hook_output(self.tmp, 'dump', 'a'))
+        self.assertEqual(None, self.utils.get_hook_output(self.tmp, 'nope'))
+
+    def test_timeout(self):
+        # The partial output would be valid JSON so far.
+        self.add_hook('dump', 'echo \'{"files": ["a"\'; exec sleep 10')
+        start = time.time()
+        with self.assertRaises(HookError) as context:
+            self.utils.get_hook_output(self.tmp, 'dump', timeout=0.2)
+        self.assertTrue(time.time() - start < 5)
+        self.assertIn('timed out after 0.2 seconds', str(context.exception))
+
+    def test_failure(self):
+        self.add_hook('dump', 'echo \'{"files": \'; exit 2')
+        with self.assertRaises(HookError) as context:
+            self.utils.get_hook_output(self.tmp, 'dump')
+        self.assertIn('failed with exit status 2', str(context.exception))
+
+
+class RenderDataTest(unittest.TestCase):
+
+    def render(self, object, max_items=None):
+        return ''.join(core._render_data(object, False, max_items))
+
+    def test_list_limit(self):
+        self.assertEqual('\nfiles: \n  - a\n  - b\n  ... 3 more files\n',
+                         self.render({'files': list('abcde')}, 2))
+        self.assertEqual('\n- a\n- b\n', self.render(['a', 'b'], 2))
+
+    def test_iterator_limit(self):
+        consumed = []
+
+        def files():
+            for i in xrange(1000):
+                consumed.append(i)
+                yield 'f{}'.format(i)
+
+        self.assertEqual('\nfiles: \n  - f0\n  - f1\n  ... more files\n',
+                         self.render({'files': files()}, 2))
+        self.assertEqual(3, len(consumed))
+        self.assertEqual(1001, len(self.render(files()).splitlines()))
+
+
+if __name__ == '__main__':
+    unittest.main()
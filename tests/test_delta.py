@@ -0,0 +1,136 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for sxc.delta, using a local shell as the remote end."""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from sxc import cache
+from sxc import delta
+from sxc import extlib
+
+
+class DeltaPushTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp, 'src')
+        self.root = os.path.join(self.tmp, 'remote')
+        os.mkdir(self.source_dir)
+        os.mkdir(self.root)
+        self.record = cache.JSONStore(os.path.join(self.tmp, 'record.json'))
+        self.environ = dict(os.environ)
+        os.environ.pop(extlib.TREE_INDEX_ENV, None)
+        os.environ.pop(extlib.SHARED_STAGING_ENV, None)
+
+        rand = random.Random(42)
+        self.big = ''.join(chr(rand.randrange(256)) for i in xrange(65536))
+        self.write('big.bin', self.big)
+        self.write('small.txt', 'hello\n')
+        self.write('sub/other.txt', 'other\n')
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, contents):
+        path = os.path.join(self.source_dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(contents)
+
+    def push(self, files):
+        return delta.push(['sh', '-c'], self.source_dir, {'files': files},
+                          self.record, root=self.root)
+
+    def remote(self, name):
+        with open(os.path.join(self.root, 'app', name), 'rb') as f:
+            return f.read()
+
+    def test_first_push(self):
+        files = ['big.bin', 'small.txt', 'sub/other.txt']
+        result = self.push(files)
+        self.assertEqual(0, result['returncode'])
+        self.assertEqual(files, result['changed'])
+        self.assertEqual(0, result['matched_bytes'])
+        self.assertEqual(self.big, self.remote('big.bin'))
+        self.assertEqual('other\n', self.remote('sub/other.txt'))
+
+        # Nothing has changed, so nothing is sent.
+        result = self.push(files)
+        self.assertEqual(0, result['returncode'])
+        self.assertEqual([], result['changed'])
+        self.assertEqual(3, result['unchanged'])
+        self.assertEqual(0, result['literal_bytes'])
+
+    def test_small_edit_sends_changed_blocks(self):
+        files = ['big.bin', 'small.txt']
+        self.assertEqual(0, self.push(files)['returncode'])
+
+        edited = self.big[:30000] + 'EDITED' + self.big[30006:]
+        self.write('big.bin', edited)
+        os.utime(os.path.join(self.source_dir, 'big.bin'), (1, 1))
+        result = self.push(files)
+        self.assertEqual(0, result['returncode'])
+        self.assertEqual(['big.bin'], result['changed'])
+        self.assertTrue(result['matched_bytes'] >= len(edited) * 3 / 4)
+        self.assertTrue(result['literal_bytes'] < len(edited) / 4)
+        self.assertEqual(edited, self.remote('big.bin'))
+
+    def test_deletion(self):
+        self.assertEqual(
+            0, self.push(['big.bin', 'small.txt', 'sub/other.txt'])
+            ['returncode'])
+        result = self.push(['big.bin'])
+        self.assertEqual(0, result['returncode'])
+        self.assertEqual(['small.txt', 'sub/other.txt'], result['deleted'])
+        self.assertFalse(
+            os.path.exists(os.path.join(self.root, 'app', 'small.txt')))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.root, 'app', 'sub/other.txt')))
+        self.assertEqual(self.big, self.remote('big.bin'))
+
+    def test_mode_change(self):
+        files = ['big.bin', 'small.txt']
+        self.assertEqual(0, self.push(files)['returncode'])
+        def mode(path):
+            return os.stat(path).st_mode & 0777
+
+        os.chmod(os.path.join(self.source_dir, 'small.txt'), 0700)
+        result = self.push(files)
+        self.assertEqual(['small.txt'], result['changed'])
+        self.assertEqual(0700, mode(os.path.join(self.root, 'app',
+                                                 'small.txt')))
+
+        # The host doesn't have the recorded deployment, and the mode of one
+        # of its files has been changed there.
+        os.chmod(os.path.join(self.root, 'app', 'big.bin'), 0600)
+        self.record.save(dict(self.record.load(), id='other'))
+        result = self.push(files)
+        self.assertEqual(0, result['returncode'])
+        self.assertEqual(['big.bin'], result['changed'])
+        self.assertEqual(len(self.big), result['matched_bytes'])
+        self.assertEqual(
+            mode(os.path.join(self.source_dir, 'big.bin')),
+            mode(os.path.join(self.root, 'app', 'big.bin')))
+
+
+if __name__ == '__main__':
+    unittest.main()
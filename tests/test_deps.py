@@ -0,0 +1,82 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Tests for sxc.deps."""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from sxc import deps
+
+
+class ResolveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        self.cache_dir = os.path.join(self.tmp, 'cache')
+        os.environ['SXC_CACHE_DIR'] = self.cache_dir
+        self.source_dir = os.path.join(self.tmp, 'src')
+        os.mkdir(self.source_dir)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp)
+
+    def write_json(self, name, obj):
+        with open(os.path.join(self.source_dir, name), 'w') as f:
+            json.dump(obj, f)
+
+    def cache_entries(self):
+        return os.listdir(os.path.join(self.cache_dir, 'deps'))
+
+    def test_lockfile(self):
+        self.write_json('package.json', {'dependencies': {'a': '^1'}})
+        graph = deps.resolve(self.source_dir, 'npm')
+        self.assertFalse(graph['locked'])
+        self.assertEqual('cd /app && npm install --production',
+                         deps.install_command('npm', graph))
+
+        self.write_json('package-lock.json', {
+            'lockfileVersion': 3,
+            'packages': {'': {'dependencies': {'a': '^1'}},
+                         'node_modules/a': {'version': '1.2.0'}}})
+        graph = deps.resolve(self.source_dir, 'npm')
+        self.assertTrue(graph['locked'])
+        self.assertEqual('1.2.0', deps.get_version(graph, 'a'))
+        self.assertEqual('cd /app && npm ci --production',
+                         deps.install_command('npm', graph))
+        self.assertEqual('pip install -r /app/requirements.txt',
+                         deps.install_command('pypi', graph))
+
+    def test_cache_entry_is_replaced(self):
+        self.write_json('package.json', {'dependencies': {'a': '1.0.0'}})
+        first = deps.resolve(self.source_dir, 'npm')
+        self.assertEqual(first, deps.resolve(self.source_dir, 'npm'))
+        entries = self.cache_entries()
+        self.assertEqual(1, len(entries))
+
+        self.write_json('package.json', {'dependencies': {'a': '2.0.0'}})
+        self.assertEqual({'a': '2.0.0'},
+                         deps.resolve(self.source_dir, 'npm')['direct'])
+        self.assertEqual(entries, self.cache_entries())
+
+
+if __name__ == '__main__':
+    unittest.main()
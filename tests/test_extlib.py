@@ -0,0 +1,681 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Tests for sxc.extlib."""
+
+import errno
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import socket
+import StringIO
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+
+from sxc import extlib
+from sxc import proclib
+
+# A stand-in for ssh that logs its arguments and runs the commands locally.
+# Connecting fails if the host is "unreachable".
+FAKE_SSH = """#!/bin/sh
+printf '%s\\0' "$@" >> "$0.log"
+printf '\\n' >> "$0.log"
+for last; do :; done
+case " $* " in
+*" -O exit "*) exit 0;;
+*" -N -f unreachable "*) echo "connection refused" >&2; exit 255;;
+*" -N -f "*) exit 0;;
+esac
+exec sh -c "$last"
+"""
+
+
+class WalkSourceTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ.pop(extlib.TREE_INDEX_ENV, None)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, contents=''):
+        path = os.path.join(self.tmp, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def walk(self):
+        return [rel_path for rel_path, entry
+                in extlib.walk_source_tree(self.tmp)]
+
+    def test_installed_dependencies_are_ignored(self):
+        self.write('app.js')
+        self.write('node_modules/express/index.js')
+        self.write('client/node_modules/react/index.js')
+        self.write('venv/bin/python')
+        self.write('.venv/bin/python')
+        self.write('env/pyvenv.cfg')
+        self.write('env/lib/site.py')
+        self.write('environment/settings.py')
+        self.assertEqual(['app.js', 'client', 'environment',
+                          'environment/settings.py'], self.walk())
+
+    def test_nested_ignore_files(self):
+        self.write('.gitignore', '*.tmp\n')
+        self.write('a.log')
+        self.write('a.tmp')
+        self.write('sub/.gitignore', '*.log\n/build/\n!keep.tmp\n')
+        self.write('sub/b.log')
+        self.write('sub/keep.tmp')
+        self.write('sub/other.tmp')
+        self.write('sub/build/out.js')
+        self.write('sub/deep/build/c.js')
+        self.write('sub/deep/c.log')
+        self.assertEqual(
+            ['.gitignore', 'a.log', 'sub', 'sub/.gitignore', 'sub/deep',
+             'sub/keep.tmp', 'sub/deep/build', 'sub/deep/build/c.js'],
+            self.walk())
+
+        # The rules of a walk don't leak into the next one.
+        rules = extlib.IgnoreRules.for_source_dir(self.tmp)
+        list(extlib.walk_source_tree(self.tmp, rules))
+        self.assertFalse(rules.is_ignored('sub/b.log', False))
+
+
+    def test_symlink_cycles(self):
+        self.write('app.js')
+        self.write('lib/util.js')
+        self.write('shared/common.js')
+        os.symlink(self.tmp, os.path.join(self.tmp, 'lib', 'root'))
+        os.symlink('..', os.path.join(self.tmp, 'lib', 'parent'))
+        os.symlink('.', os.path.join(self.tmp, 'lib', 'self'))
+        # Links to directories elsewhere in the tree are followed.
+        os.symlink(os.path.join(self.tmp, 'shared'),
+                   os.path.join(self.tmp, 'lib', 'shared'))
+        self.assertEqual(
+            ['app.js', 'lib', 'shared', 'lib/parent', 'lib/root', 'lib/self',
+             'lib/shared', 'lib/util.js', 'lib/shared/common.js',
+             'shared/common.js'],
+            self.walk())
+
+
+class IRTest(unittest.TestCase):
+
+    NAMES = ['plain.txt', 'with space.txt', 'new\nline', 'back\\slash\\n',
+             'caf\xc3\xa9.txt', 'sub dir/\xe2\x98\x83 x/deep.txt']
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ.pop(extlib.TREE_INDEX_ENV, None)
+        for name in self.NAMES:
+            path = os.path.join(self.tmp, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(name)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp)
+
+    def write_ir(self, files, previous=None):
+        out = StringIO.StringIO()
+        extlib.write_ir(self.tmp, {'files': files, 'run': 'x',
+                                   'ir': 'ignored'}, out, previous)
+        out.seek(0)
+        metadata, entries = extlib.read_ir(out)
+        return metadata, dict((entry.path, entry) for entry in entries)
+
+    def test_round_trip(self):
+        files = sorted(self.NAMES + ['sub dir', 'sub dir/\xe2\x98\x83 x',
+                                     'missing'])
+        metadata, entries = self.write_ir(files)
+        self.assertEqual({'run': 'x'}, metadata)
+        self.assertEqual(sorted(set(files) - set(['missing'])),
+                         sorted(entries))
+        for name in self.NAMES:
+            st = os.stat(os.path.join(self.tmp, name))
+            self.assertEqual(
+                extlib.IREntry(name, 'f', len(name), st.st_mode & 0777,
+                               st.st_mtime, hashlib.sha1(name).hexdigest()),
+                entries[name])
+        for name in ('sub dir', 'sub dir/\xe2\x98\x83 x'):
+            st = os.stat(os.path.join(self.tmp, name))
+            self.assertEqual(
+                extlib.IREntry(name, 'd', None, st.st_mode & 0777,
+                               st.st_mtime, None),
+                entries[name])
+
+    def test_unicode_paths(self):
+        # Images decoded from JSON have unicode paths.
+        files = [name.decode('utf-8') for name in self.NAMES]
+        metadata, entries = self.write_ir(files)
+        self.assertEqual(sorted(self.NAMES), sorted(entries))
+
+    def test_hashes_are_reused(self):
+        name = 'plain.txt'
+        previous = self.write_ir([name])[1]
+        stale = previous[name]._replace(hash='0' * 40)
+        entries = self.write_ir([name], {name: stale})[1]
+        self.assertEqual('0' * 40, entries[name].hash)
+
+        # The file is hashed again when its size or mtime changes.
+        path = os.path.join(self.tmp, name)
+        os.utime(path, (stale.mtime + 1, stale.mtime + 1))
+        entries = self.write_ir([name], {name: stale})[1]
+        self.assertEqual(hashlib.sha1(name).hexdigest(), entries[name].hash)
+
+    def test_legacy_json(self):
+        path = os.path.join(self.tmp, '.sxc')
+        with open(path, 'w') as f:
+            json.dump({'files': ['a', 'b/c'], 'run': 'x'}, f, indent=2)
+        self.assertEqual({'files': ['a', 'b/c'], 'run': 'x'},
+                         extlib.load_ir(path))
+        with open(path) as f:
+            metadata, entries = extlib.read_ir(f)
+            self.assertEqual({'run': 'x'}, metadata)
+            self.assertEqual(
+                [extlib.IREntry('a', None, None, None, None, None),
+                 extlib.IREntry('b/c', None, None, None, None, None)],
+                list(entries))
+        # There is nothing to reuse from a JSON image.
+        self.assertEqual({}, extlib.load_ir_entries({'ir': path}))
+
+    def test_unsupported_format(self):
+        with self.assertRaises(ValueError):
+            extlib.read_ir(StringIO.StringIO('#sxc-ir 3\n{}\n'))
+
+
+class TreeIndexTest(unittest.TestCase):
+
+    # Files whose paths sort between a directory and its contents.
+    FILES = ['a b', 'a-b', 'a.b', 'a/b/c', 'a/b.c', 'a0', 'ab', 'z/last']
+    DIRS = ['a', 'a/b', 'z']
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp, 'src')
+        for name in self.FILES:
+            path = os.path.join(self.source_dir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(name)
+        self.path = os.path.join(self.tmp, 'index')
+        extlib.write_tree_index(self.source_dir, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_entries(self):
+        index = extlib.TreeIndex(self.path)
+        self.assertEqual(self.source_dir, index.root)
+        self.assertEqual(sorted(self.FILES + self.DIRS),
+                         sorted(entry.path for entry in index))
+        self.assertEqual(len(self.FILES + self.DIRS), len(index))
+        st = os.stat(os.path.join(self.source_dir, 'a/b/c'))
+        entry = index.get('a/b/c')
+        self.assertEqual((st.st_ino, st.st_size, st.st_mtime, st.st_mode),
+                         (entry.st_ino, entry.st_size, entry.st_mtime,
+                          entry.st_mode))
+
+    def test_lookups(self):
+        index = extlib.TreeIndex(self.path)
+        paths = sorted(entry.path for entry in index)
+        # Look the paths up out of walk order so that they are found by the
+        # binary search, the first and last ones included.
+        for path in [paths[-1], paths[0]] + paths[1:-1][::-1]:
+            entry = index.get(path)
+            self.assertEqual(path, entry and entry.path)
+        for path in ['', '0', 'a/', 'a/b/', 'a/b/c/d', 'a c', 'aa', 'b',
+                     'z/', 'z/last/x', 'zz']:
+            self.assertIsNone(index.get(path), path)
+
+    def test_walk_order(self):
+        index = extlib.TreeIndex(self.path)
+        for entry in index:
+            self.assertEqual(entry, index.get(entry.path))
+
+    def test_invalid(self):
+        with open(self.path, 'w') as f:
+            f.write('not an index')
+        with self.assertRaises(ValueError):
+            extlib.TreeIndex(self.path)
+
+
+class ArchiveTest(unittest.TestCase):
+
+    FILES = {'a.txt': 'a' * 10, 'empty': '', 'sub/b.bin': '\0\xff' * 70000,
+             'sub/block': 'c' * 512}
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ.pop(extlib.TREE_INDEX_ENV, None)
+        os.environ.pop(extlib.SHARED_STAGING_ENV, None)
+        self.source_dir = os.path.join(self.tmp, 'src')
+        for name, contents in self.FILES.iteritems():
+            path = os.path.join(self.source_dir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(contents)
+        os.chmod(os.path.join(self.source_dir, 'a.txt'), 0751)
+        self.image = {'files': sorted(self.FILES) + ['sub', 'missing']}
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp)
+
+    def read_tar(self, data, mode='r:'):
+        archive = tarfile.open(fileobj=StringIO.StringIO(data), mode=mode)
+        return dict((info.name, (info.mode, archive.extractfile(info).read()))
+                    for info in archive)
+
+    def expected(self):
+        return dict(('app/' + name, (os.stat(os.path.join(
+                         self.source_dir, name)).st_mode & 0777, contents))
+                    for name, contents in self.FILES.iteritems())
+
+    def test_archive(self):
+        data = ''.join(extlib.archive_chunks(
+            self.source_dir, self.image,
+            extra_files=[('app.yaml', 0600, 'runtime: x\n')]))
+        self.assertEqual(0, len(data) % (20 * 512))
+        expected = self.expected()
+        self.assertEqual(0751, expected['app/a.txt'][0])
+        expected['app.yaml'] = (0600, 'runtime: x\n')
+        self.assertEqual(expected, self.read_tar(data))
+
+    def test_empty_image(self):
+        data = ''.join(extlib.archive_chunks(self.source_dir, {'files': []}))
+        self.assertEqual('\0' * 20 * 512, data)
+        self.assertEqual({}, self.read_tar(data))
+        compressed = ''.join(extlib.gzip_chunks(
+            extlib.archive_chunks(self.source_dir, {'files': []})))
+        self.assertEqual({}, self.read_tar(compressed, 'r:gz'))
+
+    def test_gzip_chunks(self):
+        # Blocks end in the middle of chunks, and the last one is short.
+        data = ''.join(chr(i % 251) for i in xrange(25000))
+        chunks = [data[i:i + 777] for i in xrange(0, len(data), 777)]
+        for threads in (1, 3):
+            compressed = ''.join(extlib.gzip_chunks(chunks, threads=threads,
+                                                    block_size=4096))
+            self.assertEqual(data, gzip.GzipFile(
+                fileobj=StringIO.StringIO(compressed)).read())
+        self.assertEqual('', gzip.GzipFile(fileobj=StringIO.StringIO(
+            ''.join(extlib.gzip_chunks([])))).read())
+
+    def test_gzip_archive(self):
+        compressed = ''.join(extlib.gzip_chunks(
+            extlib.archive_chunks(self.source_dir, self.image),
+            threads=2, block_size=50000))
+        self.assertEqual(self.expected(), self.read_tar(compressed, 'r:gz'))
+
+    def test_send_archive(self):
+        for codec in ('gzip', 'none'):
+            dest = os.path.join(self.tmp, codec)
+            os.mkdir(dest)
+            unpack = extlib.ARCHIVE_CODECS[codec][1]
+            status = extlib.send_archive(
+                extlib.archive_chunks(self.source_dir, self.image),
+                ['sh', '-c', 'cd {} && {}'.format(dest, unpack)],
+                codec=codec, threads=2)
+            self.assertEqual(0, status)
+            for name, contents in self.FILES.iteritems():
+                with open(os.path.join(dest, 'app', name), 'rb') as f:
+                    self.assertEqual(contents, f.read())
+
+        status = extlib.send_archive(
+            extlib.archive_chunks(self.source_dir, self.image),
+            ['sh', '-c', 'cat >/dev/null; exit 3'])
+        self.assertEqual(3, status)
+
+
+class SyncFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ.pop(extlib.TREE_INDEX_ENV, None)
+        os.environ.pop(extlib.SHARED_STAGING_ENV, None)
+        self.source_dir = os.path.join(self.tmp, 'src')
+        self.staging_dir = os.path.join(self.tmp, 'staging')
+        os.mkdir(self.source_dir)
+        os.mkdir(self.staging_dir)
+        for name in ('a', 'b', 'sub/c'):
+            self.write(name, name)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, contents, mtime=None):
+        path = os.path.join(self.source_dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(contents)
+        mtime = mtime or time.time() - 100
+        os.utime(path, (mtime, mtime))
+
+    def sync(self):
+        files = []
+        for dir_path, dir_names, names in os.walk(self.source_dir):
+            files.extend(os.path.relpath(os.path.join(dir_path, name),
+                                         self.source_dir)
+                         for name in names)
+        return extlib.sync_files(self.source_dir, {'files': sorted(files)},
+                                 self.staging_dir)
+
+    def staged(self):
+        app_dir = os.path.join(self.staging_dir, 'app')
+        contents = {}
+        for dir_path, dir_names, names in os.walk(app_dir):
+            for name in names:
+                path = os.path.join(dir_path, name)
+                with open(path) as f:
+                    contents[os.path.relpath(path, app_dir)] = f.read()
+        return contents
+
+    def test_sync(self):
+        self.assertEqual({'added': ['a', 'b', 'sub/c'], 'changed': [],
+                          'deleted': [], 'unchanged': 0}, self.sync())
+        self.assertEqual({'a': 'a', 'b': 'b', 'sub/c': 'sub/c'},
+                         self.staged())
+
+        self.assertEqual({'added': [], 'changed': [], 'deleted': [],
+                          'unchanged': 3}, self.sync())
+
+        # 'b' is touched but not changed, 'sub' is removed altogether.
+        self.write('a', 'new a')
+        self.write('b', 'b', time.time() - 50)
+        self.write('d', 'd')
+        shutil.rmtree(os.path.join(self.source_dir, 'sub'))
+        self.assertEqual({'added': ['d'], 'changed': ['a'],
+                          'deleted': ['sub/c'], 'unchanged': 1}, self.sync())
+        self.assertEqual({'a': 'new a', 'b': 'b', 'd': 'd'}, self.staged())
+        self.assertFalse(os.path.exists(
+            os.path.join(self.staging_dir, 'app', 'sub')))
+
+    def test_staged_file_removed(self):
+        self.sync()
+        os.unlink(os.path.join(self.staging_dir, 'app', 'sub', 'c'))
+        with open(os.path.join(self.staging_dir, 'app', 'b'), 'a') as f:
+            f.write('appended')
+        self.assertEqual({'added': [], 'changed': ['b', 'sub/c'],
+                          'deleted': [], 'unchanged': 1}, self.sync())
+        self.assertEqual({'a': 'a', 'b': 'b', 'sub/c': 'sub/c'},
+                         self.staged())
+
+
+class StageFileListTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.files = []
+        for i in range(3):
+            source_path = os.path.join(self.tmp, 'src', str(i))
+            if not os.path.isdir(os.path.dirname(source_path)):
+                os.makedirs(os.path.dirname(source_path))
+            with open(source_path, 'wb') as f:
+                f.write('file {}\n'.format(i) * 1000)
+            self.files.append(
+                (source_path, os.path.join(self.tmp, 'dest', 'sub', str(i))))
+
+        # Stand-ins for the system calls, which fail with the errors in
+        # self.errors.
+        self.errors = {}
+        self.calls = []
+        self.saved = (os.link, fcntl.ioctl, extlib._copy_with_syscall)
+        os.link = self.fake_link
+        fcntl.ioctl = self.fake_ioctl
+        extlib._copy_with_syscall = self.fake_copy
+
+    def tearDown(self):
+        os.link, fcntl.ioctl, extlib._copy_with_syscall = self.saved
+        shutil.rmtree(self.tmp)
+
+    def record(self, method):
+        self.calls.append(method)
+        if method in self.errors:
+            error = self.errors[method]
+            raise OSError(error, os.strerror(error))
+
+    def fake_link(self, source_path, dest_path):
+        self.record(extlib.STAGE_LINK)
+        self.saved[0](source_path, dest_path)
+
+    def fake_ioctl(self, fd, request, arg):
+        self.assertEqual(extlib._FICLONE, request)
+        self.record(extlib.STAGE_CLONE)
+        os.lseek(arg, 0, os.SEEK_SET)
+        os.write(fd, os.read(arg, 1 << 20))
+
+    def fake_copy(self, name, src, dst):
+        self.record(name)
+        dst.write(src.read())
+
+    def stage(self, **kwargs):
+        counts = extlib.stage_file_list(self.files, threads=1, **kwargs)
+        for source_path, dest_path in self.files:
+            with open(source_path, 'rb') as a, open(dest_path, 'rb') as b:
+                self.assertEqual(a.read(), b.read())
+        return dict(counts)
+
+    def test_link(self):
+        self.assertEqual({extlib.STAGE_LINK: 3}, self.stage(link=True))
+        for source_path, dest_path in self.files:
+            self.assertTrue(os.path.samefile(source_path, dest_path))
+
+    def test_no_links_by_default(self):
+        self.assertEqual({extlib.STAGE_CLONE: 3}, self.stage())
+        self.assertNotIn(extlib.STAGE_LINK, self.calls)
+        for source_path, dest_path in self.files:
+            self.assertFalse(os.path.samefile(source_path, dest_path))
+
+    def test_fallbacks(self):
+        # Each method is given up on after failing once.
+        chain = [(extlib.STAGE_LINK, errno.EXDEV),
+                 (extlib.STAGE_CLONE, errno.EOPNOTSUPP),
+                 (extlib.STAGE_COPY_RANGE, errno.ENOSYS),
+                 (extlib.STAGE_SENDFILE, errno.EINVAL)]
+        for i, (method, error) in enumerate(chain):
+            self.errors[method] = error
+            del self.calls[:]
+            expected = chain[i + 1][0] if i + 1 < len(chain) else (
+                extlib.STAGE_COPY)
+            self.assertEqual({expected: 3}, self.stage(link=True))
+            for failed, _ in chain[:i + 1]:
+                self.assertEqual(1, self.calls.count(failed))
+
+    def test_replaces_existing_files(self):
+        source_path, dest_path = self.files[0]
+        os.makedirs(os.path.dirname(dest_path))
+        self.saved[0](source_path, dest_path)
+        self.stage()
+        self.assertFalse(os.path.samefile(source_path, dest_path))
+        with open(source_path, 'rb') as f:
+            self.assertEqual('file 0\n', f.read(7))
+
+    def test_other_errors_are_raised(self):
+        self.errors[extlib.STAGE_CLONE] = errno.EIO
+        with self.assertRaises(EnvironmentError):
+            extlib.stage_file_list(self.files, threads=1)
+
+
+class ProbeTest(unittest.TestCase):
+
+    def test_function_probe(self):
+        calls = []
+
+        def ready():
+            calls.append(time.time())
+            return len(calls) >= 3
+
+        probe = extlib.FunctionProbe('function', ready, initial_delay=0.01,
+                                     max_delay=0.05)
+        self.assertEqual([], extlib.wait_until_ready([probe], timeout=5))
+        self.assertTrue(probe.ready)
+        self.assertEqual(3, probe.attempts)
+        self.assertEqual(3, len(calls))
+        self.assertTrue(probe.ready_time >= calls[-1])
+
+    def test_tcp_probe_banner(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        port = listener.getsockname()[1]
+
+        def serve():
+            # Greet the client late, like a server that is still starting.
+            conn, _ = listener.accept()
+            time.sleep(0.3)
+            conn.sendall('SSH-2.0-test\r\n')
+            conn.close()
+
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+
+        # The address isn't known on the first attempt.
+        hosts = [None, '127.0.0.1']
+        probe = extlib.TCPProbe(
+            'ssh', lambda: hosts.pop(0) if len(hosts) > 1 else hosts[0],
+            port, banner='SSH-', initial_delay=0.01, max_delay=0.05)
+        try:
+            self.assertEqual([], extlib.wait_until_ready([probe], timeout=5))
+        finally:
+            listener.close()
+        self.assertTrue(probe.ready)
+        self.assertEqual(2, probe.attempts)
+        self.assertEqual('address not known yet', probe.last_error)
+
+    def test_deadline(self):
+        def fail():
+            raise ValueError('not yet')
+
+        ready = extlib.FunctionProbe('ready', lambda: True)
+        failing = extlib.FunctionProbe('failing', fail, initial_delay=0.01,
+                                       max_delay=0.05)
+        start = time.time()
+        pending = extlib.wait_until_ready([ready, failing], timeout=0.3)
+        self.assertTrue(0.3 <= time.time() - start < 2)
+        self.assertEqual([failing], pending)
+        self.assertTrue(ready.ready)
+        self.assertFalse(failing.ready)
+        self.assertTrue(failing.attempts > 1)
+        self.assertEqual('not yet', failing.last_error)
+
+
+class TransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.ssh = os.path.join(self.tmp, 'ssh')
+        with open(self.ssh, 'w') as f:
+            f.write(FAKE_SSH)
+        os.chmod(self.ssh, 0755)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def ssh_calls(self):
+        """Returns the argument lists that the fake ssh was run with."""
+        with open(self.ssh + '.log') as f:
+            return [line.split('\0')[:-1] for line in f.read().splitlines()]
+
+    def test_command_transport_run(self):
+        transport = extlib.CommandTransport(['sh', '-c'])
+        self.assertEqual(['sh', '-c', 'exit 3'], transport.argv('exit 3'))
+        lines = []
+        with transport:
+            self.assertEqual(0, transport.run('echo "$0"',
+                                              stdout_callback=lines.append))
+            self.assertEqual(3, transport.run('exit 3'))
+        self.assertEqual(['sh\n'], lines)
+
+    def test_command_transport_spawn(self):
+        lines = []
+        runner = proclib.Runner(
+            output_callback=lambda proc, stream, line: lines.append(line))
+        transport = extlib.CommandTransport(['sh', '-c'])
+        start = time.time()
+        procs = [transport.spawn(runner, 'sleep 0.5; echo {}'.format(i))
+                 for i in range(4)]
+        runner.run()
+        runner.close()
+        self.assertTrue(time.time() - start < 1.5)
+        self.assertEqual([0] * 4, [proc.returncode for proc in procs])
+        self.assertEqual(['0\n', '1\n', '2\n', '3\n'], sorted(lines))
+
+    def test_ssh_transport(self):
+        transport = extlib.SSHTransport(
+            'host', user='root', port=22, key_file='key',
+            options=['StrictHostKeyChecking no'], ssh=self.ssh)
+        prefix = [self.ssh, '-p', '22', '-i', 'key', '-o',
+                  'StrictHostKeyChecking no']
+        self.assertEqual(prefix + ['root@host', 'ls'], transport.argv('ls'))
+
+        lines = []
+        with transport:
+            argv = transport.argv('ls')
+            self.assertEqual(prefix + ['-o', 'ControlMaster=no'], argv[:9])
+            self.assertTrue(argv[10].startswith('ControlPath='))
+            control_dir = os.path.dirname(argv[10][len('ControlPath='):])
+            self.assertTrue(os.path.isdir(control_dir))
+            self.assertEqual(0, transport.run('echo hello',
+                                              stdout_callback=lines.append))
+        self.assertEqual(['hello\n'], lines)
+        self.assertFalse(os.path.exists(control_dir))
+        self.assertEqual(prefix + ['root@host', 'ls'], transport.argv('ls'))
+
+        master, command, close = self.ssh_calls()
+        control = ['-o', 'ControlPath=' + os.path.join(control_dir,
+                                                       'control')]
+        self.assertEqual(prefix[1:] + ['-o', 'ControlMaster=yes'] + control +
+                         ['-o', 'ControlPersist=60', '-N', '-f', 'root@host'],
+                         master)
+        self.assertEqual(argv[1:-1] + ['echo hello'], command)
+        self.assertEqual(prefix[1:] + ['-o', 'ControlMaster=no'] + control +
+                         ['-O', 'exit', 'root@host'], close)
+
+    def test_ssh_transport_connection_failure(self):
+        transport = extlib.SSHTransport('unreachable', ssh=self.ssh)
+        with self.assertRaises(IOError) as context:
+            transport.open()
+        self.assertIn('connection refused', str(context.exception))
+        self.assertEqual([self.ssh, 'unreachable', 'ls'],
+                         transport.argv('ls'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Tests for the Dockerfile generator of the gaemvm actuator."""
+
+import imp
+import os
+import shutil
+import tempfile
+import unittest
+
+from sxc import deps
+
+dockerfile = imp.load_source(
+    'gaemvm_dockerfile',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                 'extensions', 'actuators', 'gaemvm', 'lib', 'dockerfile.py'))
+
+
+class DockerfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['SXC_CACHE_DIR'] = os.path.join(self.tmp, 'cache')
+        self.source_dir = os.path.join(self.tmp, 'src')
+        self.staging_dir = os.path.join(self.tmp, 'staging')
+        os.mkdir(self.source_dir)
+        os.mkdir(self.staging_dir)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, contents):
+        path = os.path.join(self.source_dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def django_image(self):
+        return {'files': ['manage.py', 'requirements.txt', 'reqs/base.txt',
+                          'constraints.txt', 'app/views.py'],
+                'deps': [{'name': 'django', 'version': '1.8'}],
+                'packages': deps.resolve(self.source_dir, 'pypi'),
+                'on_install': ['/usr/bin/python /app/manage.py syncdb'],
+                'run': '/usr/bin/python /app/manage.py runserver'}
+
+    def test_includes_are_staged(self):
+        self.write('requirements.txt', '-r reqs/base.txt\n'
+                   '-c constraints.txt\nrequests\n')
+        self.write('reqs/base.txt', 'django==1.8\n')
+        self.write('constraints.txt', 'requests<3\n')
+        image = self.django_image()
+        manifests = dockerfile.get_dep_manifests(image)
+        self.assertEqual(['constraints.txt', 'reqs/base.txt',
+                          'requirements.txt'], manifests)
+
+        # A stale file from an earlier push is removed.
+        os.makedirs(os.path.join(self.staging_dir, 'deps', 'old'))
+        open(os.path.join(self.staging_dir, 'deps', 'old', 'x'), 'w').close()
+        dockerfile.stage_dep_manifests(self.source_dir, self.staging_dir,
+                                       manifests)
+        staged = []
+        for dir_path, _, names in os.walk(
+                os.path.join(self.staging_dir, 'deps')):
+            staged.extend(os.path.relpath(os.path.join(dir_path, name),
+                                          self.staging_dir)
+                          for name in names)
+        self.assertEqual(['deps/' + name for name in manifests],
+                         sorted(staged))
+
+        # Every file that the install command refers to is in the context.
+        with open(os.path.join(self.staging_dir, 'deps',
+                               'requirements.txt')) as f:
+            for line in f:
+                if line.startswith('-'):
+                    self.assertTrue(os.path.exists(os.path.join(
+                        self.staging_dir, 'deps', line.split()[1])))
+
+    def test_layer_order(self):
+        self.write('requirements.txt', 'django==1.8\n')
+        image = self.django_image()
+        lines = dockerfile.make_dockerfile(
+            image, dockerfile.get_dep_manifests(image)).splitlines()
+        self.assertEqual(
+            ['FROM ubuntu',
+             'RUN apt-get -y update && apt-get -y upgrade && '
+             'apt-get install -y python-django python-pip',
+             'COPY deps /app',
+             'RUN pip install -r /app/requirements.txt',
+             'COPY app /app',
+             'RUN /usr/bin/python /app/manage.py syncdb',
+             'CMD /usr/bin/python /app/manage.py runserver'],
+            lines)
+
+    def test_locked_npm_install_is_not_repeated(self):
+        self.write('package.json', '{"dependencies": {"a": "^1"}}')
+        self.write('package-lock.json', '{"lockfileVersion": 3, "packages":'
+                   ' {"node_modules/a": {"version": "1.0.0"}}}')
+        packages = deps.resolve(self.source_dir, 'npm')
+        image = {'files': ['package.json', 'package-lock.json', 'index.js'],
+                 'deps': [{'name': 'node.js'}, {'name': 'npm'}],
+                 'packages': packages,
+                 'on_install': [deps.install_command('npm', packages)],
+                 'run': '/usr/bin/nodejs /app/index.js'}
+        manifests = dockerfile.get_dep_manifests(image)
+        self.assertEqual(['package-lock.json', 'package.json'], manifests)
+        lines = dockerfile.make_dockerfile(image, manifests).splitlines()
+        self.assertEqual(['COPY deps /app',
+                          'RUN cd /app && npm ci --production',
+                          'COPY app /app'], lines[2:5])
+        self.assertEqual(1, lines.count('RUN cd /app && npm ci --production'))
+
+    def test_without_dependencies(self):
+        image = {'files': ['index.js'], 'deps': [{'name': 'node.js'}],
+                 'run': '/usr/bin/nodejs /app/index.js'}
+        self.assertEqual([], dockerfile.get_dep_manifests(image))
+        lines = dockerfile.make_dockerfile(image, []).splitlines()
+        self.assertEqual(['FROM ubuntu', 'COPY app /app'],
+                         [lines[0], lines[2]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Tests for the declarative aggregator match rules."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from sxc import match
+
+
+class CheckRulesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.write('app.yaml', 'runtime: python27\n')
+        self.write('app/main.py', '#!/usr/bin/python\nimport webapp2\n')
+        self.write('app/README', 'not python')
+        self.write('package.json', '{"engines": {"node": "4"}, "main": 1}')
+        self.write('broken.json', '{"engines": ')
+        self.scan = match.SourceScan(self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, contents):
+        path = os.path.join(self.tmp, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def check(self, *rules):
+        return match.check_rules(list(rules), self.scan)
+
+    def test_exists(self):
+        self.assertTrue(self.check({'exists': 'app.yaml'}))
+        self.assertTrue(self.check({'exists': 'app'}))
+        self.assertTrue(self.check({'exists': 'app/main.py'}))
+        self.assertFalse(self.check({'exists': 'app/main.pyc'}))
+        self.assertFalse(self.check({'exists': 'missing/main.py'}))
+
+    def test_glob(self):
+        self.assertTrue(self.check({'glob': '*.yaml'}))
+        self.assertTrue(self.check({'glob': 'app/*.py'}))
+        self.assertTrue(self.check({'glob': 'app/[RS]EAD*'}))
+        self.assertFalse(self.check({'glob': '*.py'}))
+        self.assertFalse(self.check({'glob': 'app/*.PY'}))
+        self.assertFalse(self.check({'glob': 'missing/*'}))
+
+    def test_regex(self):
+        self.assertTrue(self.check({'regex': '^import webapp2$',
+                                    'file': 'app/main.py'}))
+        self.assertTrue(self.check({'regex': 'runtime: python',
+                                    'file': 'app.yaml'}))
+        self.assertFalse(self.check({'regex': '^webapp2',
+                                     'file': 'app/main.py'}))
+        self.assertFalse(self.check({'regex': 'python',
+                                     'file': 'missing.py'}))
+
+    def test_regex_bytes(self):
+        # Only the head of the file is searched, and shorter reads of the
+        # same file don't get in the way of longer ones.
+        rule = {'regex': 'webapp2', 'file': 'app/main.py'}
+        self.assertFalse(self.check(dict(rule, bytes=20)))
+        self.assertTrue(self.check(rule))
+        self.assertFalse(self.check(dict(rule, bytes=20)))
+
+    def test_json(self):
+        self.assertTrue(self.check({'json': 'package.json'}))
+        self.assertTrue(self.check({'json': 'package.json',
+                                    'key': 'engines.node'}))
+        self.assertTrue(self.check({'json': 'package.json',
+                                    'key': ['engines', 'node']}))
+        self.assertFalse(self.check({'json': 'package.json',
+                                     'key': 'engines.npm'}))
+        # 'main' isn't an object.
+        self.assertFalse(self.check({'json': 'package.json',
+                                     'key': 'main.x'}))
+        self.assertFalse(self.check({'json': 'broken.json'}))
+        self.assertFalse(self.check({'json': 'app.yaml'}))
+        self.assertFalse(self.check({'json': 'missing.json'}))
+
+    def test_all_rules_must_hold(self):
+        self.assertTrue(self.check())
+        self.assertTrue(self.check({'exists': 'app.yaml'},
+                                   {'glob': 'app/*.py'}))
+        self.assertFalse(self.check({'exists': 'app.yaml'},
+                                    {'glob': 'app/*.js'}))
+
+    def test_invalid_rules(self):
+        with self.assertRaises(ValueError):
+            self.check({'unknown': 'app.yaml'})
+        with self.assertRaises(ValueError):
+            self.check({'regex': 'x'})
+        with self.assertRaises(ValueError):
+            self.check({'regex': '(', 'file': 'app.yaml'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Tests for the node.js aggregator."""
+
+import imp
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from sxc import extlib
+
+plugin = imp.load_source(
+    'nodejs_plugin',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                 'extensions', 'aggregators', 'node.js', 'lib', 'plugin.py'))
+
+
+class MakeImageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['SXC_CACHE_DIR'] = os.path.join(self.tmp, 'cache')
+        os.environ.pop(extlib.TREE_INDEX_ENV, None)
+        self.source_dir = os.path.join(self.tmp, 'src')
+        os.mkdir(self.source_dir)
+        open(os.path.join(self.source_dir, 'index.js'), 'w').close()
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp)
+
+    def node_version(self, package_json):
+        with open(os.path.join(self.source_dir, 'package.json'), 'w') as f:
+            json.dump(dict(package_json, main='index.js'), f)
+        image = plugin.make_image(self.source_dir)
+        self.assertEqual(['index.js', 'package.json'], sorted(image['files']))
+        return image['deps'][0]['version']
+
+    def test_node_version(self):
+        self.assertEqual('v4.2.1',
+                         self.node_version({'engines': {'node': '4.2.1'}}))
+        self.assertEqual('v4.2.1',
+                         self.node_version({'engines': {'node': ' v4.2.1'}}))
+
+    def test_default_node_version(self):
+        for package_json in ({}, {'engines': {'node': '>=4'}},
+                             {'engines': {'npm': '2.x'}},
+                             {'engines': ['node >= 4']},
+                             {'engines': 'node'},
+                             {'engines': None},
+                             {'engines': {'node': 4}},
+                             {'engines': {'node': None}}):
+            self.assertEqual(plugin.DEFAULT_NODE_VERSION,
+                             self.node_version(package_json), package_json)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Tests for sxc.proclib."""
+
+import signal
+import time
+import unittest
+
+from sxc import proclib
+
+
+class LineAccumulatorTest(unittest.TestCase):
+
+    def test_lines_split_across_reads(self):
+        lines = []
+        accumulator = proclib._LineAccumulator(lines.append)
+        for data in ('ab', 'c\nd', 'e\n\nf', '', 'g\n'):
+            accumulator.add(data)
+        self.assertEqual(['abc\n', 'de\n', '\n', 'fg\n'], lines)
+
+    def test_batches(self):
+        batches = []
+        accumulator = proclib._LineAccumulator(batch_callback=batches.append)
+        accumulator.add('a\nb\nc')
+        accumulator.add('d')
+        accumulator.add('\ne\n')
+        self.assertEqual([['a\n', 'b\n'], ['cd\n', 'e\n']], batches)
+
+    def test_finish(self):
+        lines = []
+        accumulator = proclib._LineAccumulator(lines.append)
+        accumulator.add('a\nno newline')
+        self.assertEqual(['a\n'], lines)
+        accumulator.finish()
+        self.assertEqual(['a\n', 'no newline'], lines)
+
+        # Nothing is left to flush.
+        accumulator.finish()
+        self.assertEqual(['a\n', 'no newline'], lines)
+
+    def test_finish_after_newline(self):
+        batches = []
+        accumulator = proclib._LineAccumulator(batch_callback=batches.append)
+        accumulator.add('a\n')
+        accumulator.finish()
+        self.assertEqual([['a\n']], batches)
+
+
+class RunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.runner = proclib.Runner()
+
+    def tearDown(self):
+        self.runner.close()
+
+    def test_output(self):
+        out = []
+        err = []
+        process = self.runner.spawn(
+            'sh', '-c', 'printf a; sleep 0.1; printf "b\\nc"; '
+            'echo err >&2; sleep 0.1; printf "d\\n\\ne"',
+            stdout_callback=out.append, stderr_callback=err.append)
+        self.assertEqual(0, process.wait())
+        self.assertEqual(['ab\n', 'cd\n', '\n', 'e'], out)
+        self.assertEqual(['err\n'], err)
+
+    def test_stdin(self):
+        out = []
+        process = self.runner.spawn('cat', stdin=iter(['a\n', 'b', '\n']),
+                                    stdout_callback=out.append)
+        self.assertEqual(0, process.wait())
+        self.assertEqual(['a\n', 'b\n'], out)
+
+        out = []
+        process = self.runner.spawn('cat', stdin='a\n', stdin_open=True,
+                                    stdout_callback=out.append)
+        process.write('b\n')
+        process.close_stdin()
+        self.assertEqual(0, process.wait())
+        self.assertEqual(['a\n', 'b\n'], out)
+        with self.assertRaises(IOError):
+            process.write('c\n')
+
+    def test_exit_status(self):
+        self.assertEqual(3, proclib.run('sh', '-c', 'exit 3'))
+        self.assertEqual(-signal.SIGTERM,
+                         proclib.run('sh', '-c', 'kill -TERM $$'))
+
+        processes = [self.runner.spawn('sh', '-c', 'exit {}'.format(code),
+                                       stdout_callback=lambda line: None)
+                     for code in range(4)]
+        self.runner.run()
+        self.assertEqual([0, 1, 2, 3],
+                         [process.returncode for process in processes])
+        for process in processes:
+            self.assertFalse(process.timed_out)
+            self.assertTrue(process.end_time >= process.start_time)
+
+    def test_timeout(self):
+        out = []
+        start = time.time()
+        # The grandchild keeps the output pipe open, that mustn't keep the
+        # process from completing.
+        process = self.runner.spawn(
+            'sh', '-c', 'echo started; sleep 5 & sleep 5', timeout=0.3,
+            stdout_callback=out.append)
+        fast = self.runner.spawn('true')
+        self.assertEqual(-signal.SIGKILL, process.wait())
+        self.assertTrue(time.time() - start < 4)
+        self.assertTrue(process.timed_out)
+        self.assertFalse(process.cancelled)
+        self.assertEqual(['started\n'], out)
+        self.assertEqual(0, fast.wait())
+        self.assertFalse(fast.timed_out)
+
+    def test_cancel(self):
+        process = self.runner.spawn('sleep', '5',
+                                    stdout_callback=lambda line: None)
+        self.assertIsNone(process.poll())
+        process.cancel()
+        self.assertEqual(-signal.SIGKILL, process.wait())
+        self.assertTrue(process.cancelled)
+        self.assertFalse(process.timed_out)
+
+
+if __name__ == '__main__':
+    unittest.main()
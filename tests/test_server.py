@@ -0,0 +1,110 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Tests for the sxc server and the client that forwards commands to it."""
+
+import errno
+import os
+import shutil
+import socket
+import stat
+import StringIO
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import sxc
+from sxc import server
+
+SXC = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                   'scripts', 'sxc')
+
+
+class ServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['PYTHONPATH'] = os.path.dirname(
+            os.path.dirname(os.path.abspath(sxc.__file__)))
+        os.environ['SXC_CACHE_DIR'] = os.path.join(self.tmp, 'cache')
+        os.environ.pop(server.NO_SERVER_ENV, None)
+        self.socket_path = os.path.join(self.tmp, 'run', 'server.sock')
+        os.environ[server.SOCKET_ENV] = self.socket_path
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp)
+
+    def test_listen(self):
+        first = server.Server(self.socket_path)
+        first.listen()
+        try:
+            self.assertEqual(0700, stat.S_IMODE(
+                os.stat(os.path.dirname(self.socket_path)).st_mode))
+            self.assertEqual(0600, stat.S_IMODE(
+                os.stat(self.socket_path).st_mode))
+
+            second = server.Server(self.socket_path)
+            with self.assertRaises(socket.error) as cm:
+                second.listen()
+            self.assertEqual(errno.EADDRINUSE, cm.exception.errno)
+        finally:
+            first.close()
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def test_peer_uid(self):
+        client, conn = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            uid = server._get_peer_uid(conn)
+            if uid is not None:
+                self.assertEqual(os.getuid(), uid)
+        finally:
+            client.close()
+            conn.close()
+
+    def test_forward(self):
+        # Nothing to forward to yet.
+        self.assertIsNone(server.forward([SXC, 'list_aggregators']))
+
+        process = subprocess.Popen([sys.executable, SXC, 'serve'],
+                                   stderr=subprocess.PIPE)
+        try:
+            # The server says so once it's listening.
+            self.assertIn('listening', process.stderr.readline())
+            stdout = sys.stdout
+            sys.stdout = StringIO.StringIO()
+            try:
+                status = server.forward([SXC, 'list_aggregators'])
+                output = sys.stdout.getvalue()
+            finally:
+                sys.stdout = stdout
+            self.assertEqual(0, status)
+            self.assertIn('node.js', output)
+
+            # The server refuses to start a second time.
+            status = subprocess.call([sys.executable, SXC, 'serve'],
+                                     stderr=open(os.devnull, 'w'))
+            self.assertEqual(1, status)
+        finally:
+            process.terminate()
+            process.wait()
+        self.assertFalse(os.path.exists(self.socket_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
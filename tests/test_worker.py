@@ -0,0 +1,110 @@
+# Copyright 2015 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""End-to-end tests of extension workers built on extlib.serve_worker()."""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import sxc
+from sxc import core
+from sxc import proclib
+from sxc import worker
+
+WORKER = """#!{python}
+import json
+import os
+import sys
+from sxc import extlib
+
+def echo(args, input):
+    json.dump({{'args': args, 'input': input, 'pid': os.getpid()}},
+              sys.stdout)
+
+def binary(args, input):
+    sys.stdout.write('\\xff\\xfe\\x00 not utf-8\\n')
+    sys.stdout.write('second line\\n')
+
+def push(args, input):
+    extlib.info('pushing')
+    extlib.send_object({{'type': 'result', 'args': args}})
+
+def fail(args, input):
+    sys.stderr.write('failing\\n')
+    sys.exit(3)
+
+extlib.serve_worker({{'echo': echo, 'binary': binary, 'push': push,
+                     'fail': fail}})
+"""
+
+
+class WorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['PYTHONPATH'] = os.path.dirname(
+            os.path.dirname(os.path.abspath(sxc.__file__)))
+        os.mkdir(os.path.join(self.tmp, 'bin'))
+        self.path = os.path.join(self.tmp, 'bin', 'worker')
+        with open(self.path, 'w') as f:
+            f.write(WORKER.format(python=sys.executable))
+        os.chmod(self.path, 0755)
+        self.utils = core.StandardUtils(core.StandardOutput())
+        self.utils.add_worker(self.tmp, ['echo', 'binary', 'push', 'fail'])
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp)
+
+    def test_calls_share_the_worker(self):
+        first = self.utils.get_hook_output(self.tmp, 'echo', 'a',
+                                           input='some input')
+        self.assertEqual(['a'], first['args'])
+        self.assertEqual('some input', first['input'])
+        second = self.utils.get_hook_output(self.tmp, 'echo', 'b')
+        self.assertEqual(['b'], second['args'])
+        self.assertEqual(first['pid'], second['pid'])
+
+    def test_messages(self):
+        result = self.utils.run_hook(self.tmp, 'push', 'target')
+        self.assertEqual({'type': 'result', 'args': ['target']}, result)
+
+    def test_binary_output(self):
+        runner = proclib.Runner()
+        hook_worker = worker.Worker(runner, self.path)
+        try:
+            out = []
+            call = hook_worker.call('binary', [], stdout_callback=out.append)
+            self.assertEqual(0, call.wait())
+            self.assertEqual(['\xff\xfe\x00 not utf-8\n', 'second line\n'],
+                             out)
+
+            err = []
+            call = hook_worker.call('fail', [], stderr_callback=err.append)
+            self.assertEqual(3, call.wait())
+            self.assertEqual(['failing\n'], err)
+        finally:
+            hook_worker.close()
+            runner.run()
+            runner.close()
+
+
+if __name__ == '__main__':
+    unittest.main()